@@ -1,68 +1,75 @@
-import os
 import secrets
 from datetime import datetime, timedelta, timezone
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
-from dotenv import load_dotenv
 
+from app.config import get_settings
 from app.crud import user_service
 from app.database import SessionLocal, get_database_session
+from app.passwords import get_password_context
 
 
-
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Retrieve configuration values
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
-ACCESS_TOKEN_EXPIRES_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRES_MINUTES", "30"))
-
-# Password hashing context
-password_hasher = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 # OAuth2 password bearer scheme for token retrieval
 def verify_password(plain_password, hashed_password):
-    return password_hasher.verify(plain_password, hashed_password)
+    return get_password_context().verify(plain_password, hashed_password)
 
 
 def get_password_hash(password):
-    return password_hasher.hash(password)
+    return get_password_context().hash(password)
 
  # Authenticate a user based on credentials and password
 def verify_user_credentials(db: Session, credentials: str, password: str):
+    context = get_password_context()
     user = user_service.get_user_by_email_or_username(db, credentials)
     if not user:
+        # Take as long as a real check, so unknown users can't be told apart by latency
+        context.dummy_verify()
+        return False
+    try:
+        verified, new_hash = context.verify_and_update(password, user.hashed_password)
+    except ValueError:
+        # Not a hash of any configured scheme
         return False
-    if not verify_password(password, user.hashed_password):
+    if not verified:
         return False
+    if new_hash:
+        # Hashed with an older scheme or cost, store the upgraded hash while we have the password
+        user_service.update_password_hash(db, user, new_hash)
     return user
 
 
 def generate_access_token(data: dict, expires_delta: timedelta | None = None):
+    settings = get_settings()
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.now(timezone.utc) + expires_delta
     else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRES_MINUTES)
+        expire = datetime.now(timezone.utc) + timedelta(minutes=settings.access_token_expires_minutes)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
     return encoded_jwt
 
 
-async def get_current_user(db: Session = Depends(get_database_session), token: str = Depends(oauth2_scheme)):
+# Set on the scope of /batch sub-requests, whose token the batch already resolved
+CURRENT_USER_SCOPE_KEY = "checkflix.current_user"
+
+
+async def get_current_user(request: Request, db: Session = Depends(get_database_session), token: str = Depends(oauth2_scheme)):
+    resolved = request.scope.get(CURRENT_USER_SCOPE_KEY)
+    if resolved is not None:
+        return resolved
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        settings = get_settings()
+        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -71,4 +78,13 @@ async def get_current_user(db: Session = Depends(get_database_session), token: s
     user = user_service.get_user_by_email_or_username(db, username)
     if user is None:
         raise credentials_exception
-    return user
\ No newline at end of file
+    return user
+
+
+async def get_optional_user(request: Request, db: Session = Depends(get_database_session)):
+    # The user of a bearer token if one was sent, None for anonymous requests
+    authorization = request.headers.get("authorization")
+    if not authorization:
+        return None
+    token = await oauth2_scheme(request)
+    return await get_current_user(request, db, token)
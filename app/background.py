@@ -0,0 +1,93 @@
+import asyncio
+from starlette.concurrency import run_in_threadpool
+from app.config import Settings, get_settings
+from app.logger import custom_logger
+from app.crud import ranking_crud_service
+import app.database as database
+from app.database import SessionLocal
+from app.idempotency import purge_expired
+from app.outbox import relay_once
+import app.movie_cards  # registers the projection's outbox handlers
+from app.partitions import maintain_partitions
+from app.invalidation import listen_for_changes
+
+
+def refresh_rankings_once():
+    # Background jobs write, so they always use the primary
+    db = SessionLocal()
+    try:
+        return ranking_crud_service.refresh_rankings(db)
+    finally:
+        db.close()
+
+
+def refresh_similarity_index_once():
+    # numpy is loaded by the first run, not by importing the app
+    from app.recommendations import refresh_similarity_index
+    db = SessionLocal()
+    try:
+        return refresh_similarity_index(db)
+    finally:
+        db.close()
+
+
+def build_content_index_once():
+    from app.content_index import content_index
+    db = SessionLocal()
+    try:
+        return content_index.build(db)
+    finally:
+        db.close()
+
+
+def purge_idempotency_keys_once():
+    return purge_expired()
+
+
+def relay_outbox_once():
+    # Drain the outbox, a batch per transaction
+    batch_size = get_settings().outbox_batch_size
+    while relay_once(batch_size) == batch_size:
+        pass
+
+
+def maintain_partitions_once():
+    return maintain_partitions(database.engine, get_settings())
+
+
+async def run_once(job):
+    try:
+        await run_in_threadpool(job)
+    except Exception:
+        custom_logger.exception(f"Background job {job.__name__} failed")
+
+
+async def run_periodically(job, interval: float):
+    # Run a blocking job every interval seconds without blocking the event loop
+    while True:
+        try:
+            await run_in_threadpool(job)
+        except Exception:
+            custom_logger.exception(f"Background job {job.__name__} failed")
+        await asyncio.sleep(interval)
+
+
+def start_background_jobs(settings: Settings):
+    tasks = [
+        asyncio.create_task(run_once(build_content_index_once)),
+        asyncio.create_task(listen_for_changes(settings.invalidation_poll_seconds)),
+        asyncio.create_task(run_periodically(refresh_rankings_once, settings.ranking_refresh_seconds)),
+        asyncio.create_task(run_periodically(refresh_similarity_index_once, settings.recommendation_refresh_seconds)),
+        asyncio.create_task(run_periodically(relay_outbox_once, settings.outbox_relay_seconds)),
+    ]
+    if settings.idempotency_enabled:
+        tasks.append(asyncio.create_task(run_periodically(purge_idempotency_keys_once, settings.idempotency_purge_seconds)))
+    if settings.partitioning == "time":
+        tasks.append(asyncio.create_task(run_periodically(maintain_partitions_once, settings.partition_maintenance_seconds)))
+    return tasks
+
+
+async def stop_background_jobs(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,106 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+# Small in-process caches. Entries expire after a TTL and are evicted early
+# when another worker reports a change (see app/invalidation.py).
+#
+# A value read before an eviction must not be stored after it: a reader takes version()
+# before it reads the source and passes it to set, which drops the value if the key was
+# evicted in between. The versions of the last max_entries evicted keys are remembered,
+# for older evictions the newest forgotten version stands in.
+
+MISSING = object()
+
+
+class LocalCache:
+
+    def __init__(self, name: str, max_entries: int = 10000, ttl_seconds: float = 60):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.evicted = OrderedDict()
+        self.forgotten = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def version(self):
+        with self.lock:
+            return self.evictions
+
+    def set(self, key, value, version: int | None = None):
+        with self.lock:
+            if version is not None and self.evicted.get(key, self.forgotten) > version:
+                return
+            self.entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def evict(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.evictions += 1
+            self.evicted[key] = self.evictions
+            self.evicted.move_to_end(key)
+            while len(self.evicted) > self.max_entries:
+                self.forgotten = self.evicted.popitem(last=False)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            # Values being read now were read before the clear
+            self.evictions += 1
+            self.evicted.clear()
+            self.forgotten = self.evictions
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class EngineCache:
+    # A LocalCache per database engine. A value read on the replica is never served to a
+    # request on the primary, which a client that just wrote is pinned to.
+
+    def __init__(self, name: str, **options):
+        self.name = name
+        self.options = options
+        self.caches = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def for_bind(self, bind):
+        with self.lock:
+            cache = self.caches.get(bind)
+            if cache is None:
+                cache = self.caches[bind] = LocalCache(self.name, **self.options)
+            return cache
+
+    def evict(self, key):
+        with self.lock:
+            caches = list(self.caches.values())
+        for cache in caches:
+            cache.evict(key)
+
+    def clear(self):
+        with self.lock:
+            caches = list(self.caches.values())
+        for cache in caches:
+            cache.clear()
+
+
+# Average rating per movie id
+rating_average_cache = EngineCache("rating_average")
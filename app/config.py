@@ -0,0 +1,115 @@
+from typing import Literal
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    # Values come from the environment, then .env and app/.env
+    model_config = SettingsConfigDict(env_file=(".env", "app/.env"), extra="ignore")
+
+    # Database
+    database_url: str | None = None
+    database_replica_url: str | None = None
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    read_your_writes_seconds: float = 5
+
+    # PostgreSQL partitioning of ratings and comments: "none", "time" (monthly ranges
+    # on created_at) or "movie" (hash on movie_id), see app/partitions.py
+    partitioning: Literal["none", "time", "movie"] = "none"
+    partition_months_ahead: int = 2
+    partition_retention_months: int = 0
+    partition_hash_modulus: int = 16
+    partition_maintenance_seconds: float = 3600
+
+    # Authentication
+    secret_key: str | None = None
+    algorithm: str = "HS256"
+    access_token_expires_minutes: int = 30
+
+    # Password hashing, tune the cost with python -m app.passwords
+    password_scheme: Literal["bcrypt", "argon2"] = "bcrypt"
+    bcrypt_rounds: int = 12
+    argon2_time_cost: int = 3
+    argon2_memory_kib: int = 65536
+    argon2_parallelism: int = 4
+
+    # Logging
+    better_stack_token: str | None = None
+
+    # Admission control, concurrency and queue wait budget per route class
+    admission_control_enabled: bool = True
+    admission_auth_concurrency: int = 8
+    admission_auth_max_wait_seconds: float = 2.0
+    admission_write_concurrency: int = 32
+    admission_write_max_wait_seconds: float = 1.0
+    admission_read_concurrency: int = 64
+    admission_read_max_wait_seconds: float = 0.5
+    admission_retry_after_seconds: int = 1
+
+    # Idempotency-Key on POST requests: responses are kept IDEMPOTENCY_TTL_SECONDS and a
+    # duplicate of a running request waits up to IDEMPOTENCY_WAIT_SECONDS for its response
+    idempotency_enabled: bool = True
+    idempotency_ttl_seconds: float = 86400
+    idempotency_wait_seconds: float = 10
+    idempotency_lock_seconds: float = 60
+    idempotency_max_body_bytes: int = 1048576
+    idempotency_purge_seconds: float = 600
+
+    # /batch: sub-requests per batch, and how many of a batch run at once (each holds a session)
+    batch_max_requests: int = 50
+    batch_concurrency: int = 8
+
+    # Request profiling, off unless a sample rate or a token for the X-Profile header is set
+    profiling_sample_rate: float = 0
+    profiling_token: str | None = None
+    profiling_interval_ms: float = 5
+    profiling_dir: str = "profiles"
+    profiling_max_files: int = 200
+
+    # Tracing, off unless an exporter is set: "ndjson" appends to TRACING_FILE,
+    # "otlp" posts OTLP/HTTP JSON to TRACING_OTLP_ENDPOINT
+    tracing_exporter: Literal["ndjson", "otlp"] | None = None
+    tracing_file: str = "traces.ndjson"
+    tracing_otlp_endpoint: str = "http://localhost:4318/v1/traces"
+    tracing_service_name: str = "checkflix"
+    tracing_sample_rate: float = 1.0
+
+    # Memory diagnostics under /diagnostics, only served when DIAGNOSTICS_TOKEN is set and
+    # sent in X-Diagnostics-Token. MEMORY_TRACE_FRAMES > 0 starts tracemalloc at startup.
+    diagnostics_token: str | None = None
+    memory_trace_frames: int = 0
+    memory_sample_rate: float = 0
+
+    # Background jobs
+    run_background_jobs: bool = True
+    ranking_refresh_seconds: float = 60
+    recommendation_refresh_seconds: float = 300
+    recommendation_full_build_seconds: float = 86400
+    invalidation_poll_seconds: float = 1
+    outbox_relay_seconds: float = 1
+    outbox_batch_size: int = 500
+
+    # Rankings
+    ranking_min_votes: int = 5
+    trending_window_hours: int = 72
+
+    # Recommendations
+    recommendation_index_dir: str = "recommendation_index"
+    recommendation_neighbours: int = 50
+    content_index_dimensions: int = 256
+
+
+# Settings of the running application, set by create_app
+current_settings = None
+
+
+def configure(settings: Settings | None = None):
+    global current_settings
+    current_settings = settings or Settings()
+    return current_settings
+
+
+def get_settings():
+    if current_settings is None:
+        return configure()
+    return current_settings
@@ -0,0 +1,208 @@
+import math
+import re
+import threading
+import zlib
+import numpy as np
+from sqlalchemy.orm import Session
+import app.models as models
+from app.config import get_settings
+from app.genres import genre_key, split_genres
+
+# Rows scored at a time, bounds the scratch memory of a query
+SCORE_CHUNK_ROWS = 65536
+
+# Share of the catalog added or removed since the last reweight that triggers the next one
+REWEIGHT_DRIFT = 0.1
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def movie_features(title: str | None, genre: str | None, description: str | None):
+    # Title words, each genre, and description words and bigrams, each in its own namespace
+    features = {}
+
+    def add(feature, weight=1.0):
+        features[feature] = features.get(feature, 0.0) + weight
+
+    for word in TOKEN_PATTERN.findall((title or "").lower()):
+        add(f"t:{word}", 2.0)
+    for name in split_genres(genre):
+        add(f"g:{genre_key(name)}", 3.0)
+    words = TOKEN_PATTERN.findall((description or "").lower())
+    for word in words:
+        add(f"d:{word}")
+    for first, second in zip(words, words[1:]):
+        add(f"d:{first} {second}")
+    return features
+
+
+def hash_features(features: dict, dimensions: int):
+    # Signed feature hashing, crc32 keeps buckets stable across processes
+    buckets = np.zeros(dimensions, dtype=np.float32)
+    for feature, count in features.items():
+        digest = zlib.crc32(feature.encode())
+        sign = 1.0 if digest & 0x80000000 else -1.0
+        buckets[digest % dimensions] += sign * (1.0 + math.log(count))
+    return buckets
+
+
+class ContentIndex:
+    # Hashed term frequencies of every movie in one dense matrix. Similarity is the cosine of
+    # the TF-IDF vectors: the product of the term frequencies with the query weighted by idf²,
+    # divided by the rows' TF-IDF norms. Every row is weighted with the same idf, a snapshot of
+    # the document frequencies taken by reweight, so a movie's weights don't depend on when it
+    # was indexed.
+
+    def __init__(self, dimensions: int | None = None, capacity: int = 1024):
+        # content_index_dimensions is the width of the hashed feature space
+        self.dimensions = dimensions or get_settings().content_index_dimensions
+        self.term_freq = np.zeros((capacity, self.dimensions), dtype=np.float32)
+        self.norms = np.zeros(capacity, dtype=np.float32)
+        self.movie_ids = np.zeros(capacity, dtype=np.int64)
+        self.rows = {}
+        self.size = 0
+        # Document frequency per bucket, and the idf and index size of the last reweight
+        self.doc_freq = np.zeros(self.dimensions, dtype=np.int64)
+        self.idf = np.ones(self.dimensions, dtype=np.float32)
+        self.idf_size = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return self.size
+
+    def add_movie(self, movie: models.Movie):
+        self.add(movie.id, movie.title, movie.genre, movie.description)
+
+    def add(self, movie_id: int, title: str | None, genre: str | None, description: str | None,
+            reweight: bool = True):
+        term_freq = hash_features(movie_features(title, genre, description), self.dimensions)
+        with self.lock:
+            row = self.rows.get(movie_id)
+            if row is not None:
+                self.doc_freq -= self.term_freq[row] != 0
+            else:
+                row = self.size
+                self.grow(row + 1)
+                self.rows[movie_id] = row
+                self.movie_ids[row] = movie_id
+                self.size += 1
+            self.term_freq[row] = term_freq
+            self.norms[row] = np.linalg.norm(term_freq * self.idf)
+            self.doc_freq += term_freq != 0
+            if reweight:
+                self.reweight_if_drifted()
+
+    def remove(self, movie_id: int):
+        # Move the last row into the freed slot so the matrix stays dense
+        with self.lock:
+            row = self.rows.pop(movie_id, None)
+            if row is None:
+                return
+            self.doc_freq -= self.term_freq[row] != 0
+            last = self.size - 1
+            if row != last:
+                self.term_freq[row] = self.term_freq[last]
+                self.norms[row] = self.norms[last]
+                self.movie_ids[row] = self.movie_ids[last]
+                self.rows[int(self.movie_ids[row])] = row
+            self.term_freq[last] = 0
+            self.norms[last] = 0
+            self.size -= 1
+            self.reweight_if_drifted()
+
+    def reweight_if_drifted(self):
+        # The idf is taken again once the catalog has grown or shrunk by a tenth
+        if abs(self.size - self.idf_size) > self.idf_size * REWEIGHT_DRIFT:
+            self.reweight()
+
+    def reweight(self):
+        # Current idf for every row: only the norms depend on it, the term frequencies don't
+        with self.lock:
+            self.idf = (np.log((1.0 + self.size) / (1.0 + self.doc_freq)) + 1.0).astype(np.float32)
+            self.idf_size = self.size
+            for start in range(0, self.size, SCORE_CHUNK_ROWS):
+                stop = min(start + SCORE_CHUNK_ROWS, self.size)
+                self.norms[start:stop] = np.linalg.norm(self.term_freq[start:stop] * self.idf, axis=1)
+
+    def grow(self, needed: int):
+        capacity = len(self.movie_ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        term_freq = np.zeros((capacity, self.dimensions), dtype=np.float32)
+        term_freq[:self.size] = self.term_freq[:self.size]
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[:self.size] = self.norms[:self.size]
+        movie_ids = np.zeros(capacity, dtype=np.int64)
+        movie_ids[:self.size] = self.movie_ids[:self.size]
+        self.term_freq, self.norms, self.movie_ids = term_freq, norms, movie_ids
+
+    def similar(self, movie_id: int, k: int = 10):
+        return self.similar_batch([movie_id], k)[0]
+
+    def similar_batch(self, movie_ids: list[int], k: int = 10):
+        # Neighbours of several movies at once, scored with one matrix product per chunk
+        with self.lock:
+            known = [movie_id for movie_id in movie_ids if movie_id in self.rows]
+            if not known:
+                return [[] for _ in movie_ids]
+            query_rows = np.array([self.rows[movie_id] for movie_id in known])
+            results = self.top_k(query_rows, k)
+        by_movie = dict(zip(known, results))
+        return [by_movie.get(movie_id, []) for movie_id in movie_ids]
+
+    def top_k(self, query_rows, k: int):
+        batch = len(query_rows)
+        best_scores = np.full((batch, 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((batch, 0), dtype=np.int64)
+
+        # Query vectors weighted by idf², one for each side of the dot product, and unit length
+        query_norms = self.norms[query_rows]
+        query_norms[query_norms == 0] = 1.0
+        queries = self.term_freq[query_rows] * (self.idf ** 2) / query_norms[:, None]
+
+        for start in range(0, self.size, SCORE_CHUNK_ROWS):
+            stop = min(start + SCORE_CHUNK_ROWS, self.size)
+            norms = self.norms[start:stop].copy()
+            norms[norms == 0] = 1.0
+            scores = (self.term_freq[start:stop] @ queries.T) / norms[:, None]
+            scores = scores.T
+            # A movie is not its own neighbour
+            inside = (query_rows >= start) & (query_rows < stop)
+            scores[np.flatnonzero(inside), query_rows[inside] - start] = -np.inf
+
+            rows = np.broadcast_to(np.arange(start, stop), scores.shape)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, rows], axis=1)
+            if scores.shape[1] > k:
+                keep = np.argpartition(-scores, k, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, keep, axis=1)
+                rows = np.take_along_axis(rows, keep, axis=1)
+            best_scores, best_rows = scores, rows
+
+        results = []
+        for scores, rows in zip(best_scores, best_rows):
+            order = np.argsort(-scores, kind="stable")
+            results.append([
+                (int(self.movie_ids[row]), round(float(score), 4))
+                for score, row in zip(scores[order], rows[order])
+                if score > 0
+            ])
+        return results
+
+    def build(self, db_session: Session, batch_size: int = 10000):
+        # Index the whole catalog, streaming movies instead of loading them all at once
+        query = (
+            db_session.query(models.Movie.id, models.Movie.title, models.Movie.genre, models.Movie.description)
+            .order_by(models.Movie.id)
+            .yield_per(batch_size)
+        )
+        for movie_id, title, genre, description in query:
+            self.add(movie_id, title, genre, description, reweight=False)
+        self.reweight()
+        return self
+
+
+# The index is kept per process and updated by the movie write paths
+content_index = ContentIndex()
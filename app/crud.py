@@ -1,14 +1,181 @@
+from datetime import datetime, timedelta, timezone
+import json
 from math import floor
 import statistics
-from sqlalchemy import func, select
-from sqlalchemy.orm import Session
+from sqlalchemy import event, func, inspect, or_, select, text, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, load_only, selectinload
 import app.models as models
+from app.config import get_settings
+from app.genres import genre_key, split_genres
+from app.live import movie_feed
+from app.cache import MISSING, rating_average_cache
+from app.invalidation import on_change, record_change
+from app.outbox import emit
+from app.singleflight import SingleFlight
+from app.tracing import traced_service
+import app.database as database
 import app.schemas as schemas
 import app.schemas as dto
 
+# Upserts
+
+
+def upsert(db_session: Session, model):
+    # INSERT with an ON CONFLICT clause, PostgreSQL and SQLite spell it the same way
+    if db_session.get_bind().dialect.name == "postgresql":
+        return postgresql_insert(model)
+    return sqlite_insert(model)
+
+
+# Batch Loading
+
+
+class BatchLoader:
+    # Per-session loader that fetches rows by primary key with one IN query
+    # and remembers them (misses included) for the rest of the request
+
+    def __init__(self, db_session: Session, model):
+        self.db_session = db_session
+        self.model = model
+        self.cache = {}
+
+    def load(self, key):
+        return self.load_many([key])[0]
+
+    def load_many(self, keys):
+        keys = [normalize_key(key) for key in keys]
+        missing = list({key for key in keys if key is not None and key not in self.cache})
+        if missing:
+            rows = self.db_session.query(self.model).filter(self.model.id.in_(missing)).all()
+            found = {row.id: row for row in rows}
+            for key in missing:
+                self.cache[key] = found.get(key)
+        return [self.cache.get(key) for key in keys]
+
+    def prime(self, row):
+        self.cache[row.id] = row
+
+    def clear(self):
+        self.cache.clear()
+
+
+def normalize_key(key):
+    # Path parameters may arrive as strings, ids that are not numbers never match
+    try:
+        return int(key)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_loader(db_session: Session, model):
+    loaders = db_session.info.setdefault("loaders", {})
+    if model not in loaders:
+        loaders[model] = BatchLoader(db_session, model)
+    return loaders[model]
+
+
+def load_related_users(db_session: Session, rows):
+    # Fill the identity map with every user referenced by rows in one query,
+    # so the lazy user / author relationships don't query once per row
+    get_loader(db_session, models.User).load_many({row.user_id for row in rows if row.user_id is not None})
+    return rows
+
+
+def get_included_users(db_session: Session, rows):
+    # Each distinct user referenced by rows, fetched with one IN query (or none if already loaded)
+    user_ids = sorted({row.user_id for row in rows if row.user_id is not None})
+    users = get_loader(db_session, models.User).load_many(user_ids)
+    return {user.id: user for user in users if user is not None}
+
+
+@event.listens_for(Session, "after_transaction_end")
+def clear_loaders(db_session: Session, transaction):
+    # Commits, rollbacks and close end the transaction, cached rows may be stale after that
+    for loader in db_session.info.get("loaders", {}).values():
+        loader.clear()
+
+# Projection
+
+
+def project(query, model, fields=None):
+    # Only fetch the columns and relationships a sparse fieldset asks for
+    if fields is None:
+        return query
+    return query.options(*projection_options(model, fields))
+
+
+def projection_options(model, fields, loader=None):
+    mapper = inspect(model)
+    columns, options = [], []
+    for name, children in fields:
+        if name in mapper.column_attrs:
+            columns.append(mapper.column_attrs[name].class_attribute)
+        elif name in mapper.relationships:
+            relationship = mapper.relationships[name]
+            # The foreign key is needed to load the related rows
+            columns.extend(mapper.get_property_by_column(column).class_attribute
+                           for column in relationship.local_columns)
+            attribute = relationship.class_attribute
+            related = loader.selectinload(attribute) if loader is not None else selectinload(attribute)
+            if children is None:
+                options.append(related)
+            else:
+                options.extend(projection_options(relationship.mapper.class_, children, related))
+    if columns:
+        options.append(loader.load_only(*columns) if loader is not None else load_only(*columns))
+    return options
+
+
+def load_users(db_session: Session, rows, fields=None):
+    # Without a fieldset the related users are batch loaded, with one the query already did it
+    if fields is None:
+        return load_related_users(db_session, rows)
+    return rows
+
+# Live Feed
+
+
+def publish_comment(comment: models.Comment):
+    # Tell live subscribers of the movie about a new comment or reply
+    event_type = "reply" if comment.parent_id is not None else "comment"
+    movie_feed.publish(comment.movie_id, {
+        "type": event_type,
+        "data": {
+            "id": comment.id,
+            "user_id": comment.user_id,
+            "movie_id": comment.movie_id,
+            "comment": comment.comment,
+            "parent_id": comment.parent_id,
+            "created_at": comment.created_at,
+        },
+    })
+
+
+def publish_rating_average(db_session: Session, movie_id: int):
+    # The aggregate is only computed when somebody is listening
+    if not movie_feed.has_subscribers(movie_id):
+        return
+    avg_rating, rating_count = (
+        db_session.query(func.avg(models.Rating.rating_value), func.count(models.Rating.id))
+        .filter(models.Rating.movie_id == movie_id)
+        .one()
+    )
+    movie_feed.publish(movie_id, {
+        "type": "rating_average",
+        "data": {
+            "movie_id": movie_id,
+            "avg_rating": round(float(avg_rating), 2) if avg_rating is not None else 0.0,
+            "rating_count": rating_count,
+        },
+    })
+
+
 # User CRUD Operations
 
 
+@traced_service
 class UserCRUDService:
 
     @staticmethod
@@ -21,17 +188,24 @@ class UserCRUDService:
         )
 
         db_session.add(db_user)
+        db_session.flush()
         db_session.commit()
         db_session.refresh(db_user)
         return db_user
 
     @staticmethod
-    def get_users(db_session: Session, offset: int = 0, limit: int = 10):
-        return db_session.query(models.User).offset(offset).limit(limit).all()
+    def get_users(db_session: Session, offset: int = 0, limit: int = 10, fields=None):
+        return project(db_session.query(models.User), models.User, fields).offset(offset).limit(limit).all()
 
     @staticmethod
     def get_user_by_id(db_session: Session, user_id: int):
-        return db_session.query(models.User).filter(models.User.id == user_id).first()
+        return get_loader(db_session, models.User).load(user_id)
+
+    @staticmethod
+    def get_users_by_ids(db_session: Session, user_ids: list[int]):
+        # One IN query, returned in the order of user_ids
+        users = get_loader(db_session, models.User).load_many(user_ids)
+        return [user for user in users if user is not None]
 
     @staticmethod
     def get_user_by_username(db_session: Session, username: str):
@@ -62,16 +236,31 @@ class UserCRUDService:
             setattr(user, key, value)
 
         db_session.add(user)
+        # No worker caches user fields, the movie cards get them through the outbox
+        emit(db_session, "user_saved", user_id=user.id)
         db_session.commit()
         db_session.refresh(user)
 
         return user
 
+    @staticmethod
+    def update_password_hash(db_session: Session, user: models.User, hashed_password: str):
+        user.hashed_password = hashed_password
+        db_session.commit()
+        return user
+
     @staticmethod
     def delete_user(db_session: Session, user_id: int):
         user = user_service.get_user_by_id(db_session, user_id)
 
+        # The user's ratings are kept without a user, they leave the similarity index
+        rated = db_session.query(models.Rating.movie_id).filter(models.Rating.user_id == user_id)
+        record_similarity_changes(db_session, [movie_id for movie_id, in rated])
+        # The user's movies lose their owner, reads of them that carry the owner's id go stale
+        for movie_id, in db_session.query(models.Movie.id).filter(models.Movie.user_id == user_id):
+            record_change(db_session, "user", user_id, movie_id=movie_id)
         db_session.delete(user)
+        emit(db_session, "user_deleted", user_id=user_id)
         db_session.commit()
 
         return None
@@ -79,38 +268,118 @@ class UserCRUDService:
 
 # Movies CRUD Operations
 
+# Keys the /movies listing can be sorted by
+MOVIE_SORT_KEYS = {
+    "id": models.Movie.id,
+    "title": models.Movie.title,
+    "release_year": models.Movie.release_year,
+    "created_at": models.Movie.created_at,
+    "avg_rating": models.MovieRanking.avg_rating,
+    "weighted_rating": models.MovieRanking.weighted_rating,
+}
+RANKING_SORT_KEYS = {"avg_rating", "weighted_rating"}
+
+@traced_service
 class MovieCRUDService:
 
     @staticmethod
     def create_movie(db_session: Session, movie: schemas.MovieCreate, user_id: int):
+        # numpy comes in with the content index, keep it out of the import of app.crud
+        from app.content_index import content_index
         db_movie = models.Movie(
             **movie.model_dump(),
             user_id=user_id
         )
         db_session.add(db_movie)
+        db_session.flush()
+        genre_crud_service.set_movie_genres(db_session, db_movie)
+        record_change(db_session, "movie", db_movie.id)
+        emit(db_session, "movie_saved", db_movie.id)
         db_session.commit()
         db_session.refresh(db_movie)
+        content_index.add_movie(db_movie)
         return db_movie
 
     @staticmethod
-    def get_movies(db_session: Session, offset: int = 0, limit: int = 10):
-        return db_session.query(models.Movie).offset(offset).limit(limit).all()
+    def get_movies(db_session: Session, offset: int = 0, limit: int = 10, fields=None):
+        return project(db_session.query(models.Movie), models.Movie, fields).offset(offset).limit(limit).all()
+
+    @staticmethod
+    def filter_movies(db_session: Session, filters: schemas.MovieFilter, sort=()):
+        # Compile the filters and sort keys into a single query, see MOVIE_SORT_KEYS
+        query = db_session.query(models.Movie)
+        if filters.genres:
+            query = query.filter(genre_crud_service.has_genres(filters.genres))
+        if filters.year_from is not None:
+            query = query.filter(models.Movie.release_year >= filters.year_from)
+        if filters.year_to is not None:
+            query = query.filter(models.Movie.release_year <= filters.year_to)
+        if filters.owner_id is not None:
+            query = query.filter(models.Movie.user_id == filters.owner_id)
+        if filters.title is not None:
+            query = query.filter(models.Movie.title == filters.title)
+
+        # Averages come from the rankings table, movies without ratings have no row there yet
+        sorts_by_ranking = any(key in RANKING_SORT_KEYS for key, _ in sort)
+        inner_join = filters.min_rating is not None
+        if inner_join:
+            query = query.join(models.MovieRanking, models.MovieRanking.movie_id == models.Movie.id)
+            query = query.filter(models.MovieRanking.avg_rating >= filters.min_rating)
+        elif sorts_by_ranking:
+            query = query.outerjoin(models.MovieRanking, models.MovieRanking.movie_id == models.Movie.id)
+
+        order = []
+        for key, descending in sort:
+            column = MOVIE_SORT_KEYS[key]
+            if key in RANKING_SORT_KEYS and not inner_join:
+                column = func.coalesce(column, 0.0)
+            order.append(column.desc() if descending else column.asc())
+
+        # The id breaks ties so pages don't overlap. It follows the direction of the last key,
+        # and for ranking keys it is the rankings' own movie_id, so (key, movie_id) indexes give the order
+        if not any(key == "id" for key, _ in sort):
+            last_key, descending = sort[-1] if sort else ("id", False)
+            tiebreak = models.Movie.id
+            if inner_join and last_key in RANKING_SORT_KEYS:
+                tiebreak = models.MovieRanking.movie_id
+            order.append(tiebreak.desc() if descending else tiebreak.asc())
+        return query.order_by(*order)
+
+    @staticmethod
+    def search_movies(db_session: Session, filters: schemas.MovieFilter, sort=(), offset: int = 0, limit: int = 10, fields=None):
+        query = movie_crud_service.filter_movies(db_session, filters, sort)
+        return project(query, models.Movie, fields).offset(offset).limit(limit).all()
 
 
     @staticmethod
     def get_movie_by_id(db_session: Session, movie_id: int):
-        return db_session.query(models.Movie).filter(models.Movie.id == movie_id).first()
+        return get_loader(db_session, models.Movie).load(movie_id)
+
+    @staticmethod
+    def get_movie_data(db_session: Session, movie_id: int):
+        # A detached copy of the movie, safe to share between requests
+        movie = movie_crud_service.get_movie_by_id(db_session, movie_id)
+        return None if movie is None else schemas.Movie.model_validate(movie)
 
     @staticmethod
-    def get_movie_by_title(db_session: Session, title: str, offset: int = 0, limit: int = 10):
-        return db_session.query(models.Movie).filter(models.Movie.title == title).offset(offset).limit(limit).all()
+    def get_movies_by_ids(db_session: Session, movie_ids: list[int]):
+        # One IN query, returned in the order of movie_ids
+        movies = get_loader(db_session, models.Movie).load_many(movie_ids)
+        return [movie for movie in movies if movie is not None]
 
     @staticmethod
-    def get_movie_by_genre(db_session: Session, genre: str, offset: int = 0, limit: int = 10):
-        return db_session.query(models.Movie).filter(models.Movie.genre == genre).offset(offset).limit(limit).all()
+    def get_movie_by_title(db_session: Session, title: str, offset: int = 0, limit: int = 10, fields=None):
+        return project(db_session.query(models.Movie), models.Movie, fields).filter(models.Movie.title == title).offset(offset).limit(limit).all()
+
+    @staticmethod
+    def get_movie_by_genre(db_session: Session, genre: str, offset: int = 0, limit: int = 10, fields=None):
+        query = project(db_session.query(models.Movie), models.Movie, fields)
+        query = query.filter(genre_crud_service.has_genres([genre]))
+        return query.order_by(models.Movie.id).offset(offset).limit(limit).all()
 
     @staticmethod
     def update_movie(db_session: Session, movie_payload: schemas.MovieUpdate, movie_id: int):
+        from app.content_index import content_index
         movie = movie_crud_service.get_movie_by_id(db_session, movie_id)
         if not movie:
             return None
@@ -121,21 +390,67 @@ class MovieCRUDService:
             setattr(movie, k, v)
 
         db_session.add(movie)
+        if "genre" in movie_payload_dict:
+            genre_crud_service.set_movie_genres(db_session, movie)
+        record_change(db_session, "movie", movie.id)
+        emit(db_session, "movie_saved", movie.id)
         db_session.commit()
         db_session.refresh(movie)
+        content_index.add_movie(movie)
         return movie
 
     @staticmethod
     def delete_movie(db_session: Session, movie_id: int = None):
+        from app.content_index import content_index
         movie = movie_crud_service.get_movie_by_id(db_session, movie_id)
 
+        genre_crud_service.change_counts(movie.genres, -1)
+        if get_settings().partitioning == "movie":
+            # movie_id is part of the partitioned tables' key and can't be set to NULL
+            movie_crud_service.delete_movie_activity(db_session, movie)
         db_session.delete(movie)
+        # Its ratings are kept without a movie, or deleted, either way they leave the similarity index
+        record_similarity_changes(db_session, [movie_id])
+        record_change(db_session, "movie", movie_id)
+        emit(db_session, "movie_deleted", movie_id)
         db_session.commit()
+        content_index.remove(movie_id)
 
         return None
 
+    @staticmethod
+    def delete_movie_activity(db_session: Session, movie: models.Movie):
+        # Delete the movie's ratings and comments, one bulk delete each on the movie's partition.
+        # Their users' counters lose them, the movie's own counters go with the movie.
+        for model, counted in ((models.Rating, "ratings"), (models.Comment, "comments")):
+            per_user = (
+                db_session.query(model.user_id, func.count())
+                .filter(model.movie_id == movie.id).group_by(model.user_id).all()
+            )
+            db_session.query(model).filter(model.movie_id == movie.id).delete(synchronize_session="fetch")
+            for user_id, count in per_user:
+                count_crud_service.change_count(db_session, "user", user_id, counted, -count)
+        # Reloaded empty, so the delete of the movie has no children left to set to NULL
+        db_session.expire(movie, ["ratings", "comments"])
+
 # Ratings CRUD Operations
 
+
+def in_movie(query, model, movie_id: int | None):
+    # Lookups by id name the movie when the caller knows it, under PARTITIONING=movie
+    # that prunes the scan to the movie's partition
+    return query if movie_id is None else query.filter(model.movie_id == movie_id)
+
+
+def record_similarity_changes(db_session: Session, movie_ids):
+    # Movies whose ratings changed, the similarity index refresh reads their rows again.
+    # Must be called before the commit, like record_change.
+    for movie_id in set(movie_ids):
+        if movie_id is not None:
+            db_session.add(models.SimilarityChange(movie_id=movie_id))
+
+
+@traced_service
 class RatingCRUDService:
 
     @staticmethod
@@ -147,37 +462,71 @@ class RatingCRUDService:
         )
 
         db_session.add(db_rating)
+        ranking_crud_service.mark_dirty(db_session, movie_id)
+        record_similarity_changes(db_session, [movie_id])
+        db_session.flush()
+        count_crud_service.count_rating(db_session, db_rating, 1)
+        record_change(db_session, "rating", db_rating.id, movie_id=movie_id)
+        emit(db_session, "rating_added", movie_id, value=db_rating.rating_value)
         db_session.commit()
         db_session.refresh(db_rating)
+        publish_rating_average(db_session, movie_id)
         return db_rating
 
     @staticmethod
-    def get_ratings(db_session: Session, offset: int = 0, limit: int = 10):
-        return db_session.query(models.Rating).offset(offset).limit(limit).all()
+    def get_ratings(db_session: Session, offset: int = 0, limit: int = 10, fields=None):
+        ratings = project(db_session.query(models.Rating), models.Rating, fields).offset(offset).limit(limit).all()
+        return load_users(db_session, ratings, fields)
 
     @staticmethod
     def get_rating(db_session: Session, user_id: int, movie_id: int):
         return db_session.query(models.Rating).filter(models.Rating.user_id == user_id, models.Rating.movie_id == movie_id).first()
 
     @staticmethod
-    def get_rating_by_id(db_session: Session, rating_id: int):
-        return db_session.query(models.Rating).filter(models.Rating.id == rating_id).first()
+    def get_rating_by_id(db_session: Session, rating_id: int, movie_id: int | None = None):
+        return in_movie(db_session.query(models.Rating), models.Rating, movie_id).filter(models.Rating.id == rating_id).first()
 
     @staticmethod
-    def get_ratings_by_movie_id(db_session: Session, movie_id: int, offset: int = 0, limit: int = 10):
-        return db_session.query(models.Rating).filter(models.Rating.movie_id == movie_id).offset(offset).limit(limit).all()
+    def get_ratings_by_movie_id(db_session: Session, movie_id: int, offset: int = 0, limit: int = 10, fields=None):
+        ratings = project(db_session.query(models.Rating), models.Rating, fields).filter(models.Rating.movie_id == movie_id).offset(offset).limit(limit).all()
+        return load_users(db_session, ratings, fields)
     
+    @staticmethod
+    def get_all_ratings_by_user(db_session: Session, user_id: int):
+        return db_session.query(models.Rating).filter(models.Rating.user_id == user_id).all()
+
     @staticmethod
     def get_all_ratings_for_a_movie(db_session: Session, movie_id: int):
         return db_session.query(models.Rating).filter(models.Rating.movie_id == movie_id).all()
     
+    @staticmethod
+    def aggregate_ratings(db_session: Session, movie_ids: list[int]):
+        # Average rating of several movies with one GROUP BY query
+        averages = (
+            db_session.query(models.Rating.movie_id, func.avg(models.Rating.rating_value))
+            .filter(models.Rating.movie_id.in_(movie_ids))
+            .group_by(models.Rating.movie_id)
+            .all()
+        )
+        averages = {movie_id: round(float(avg), 2) for movie_id, avg in averages}
+        return {movie_id: averages.get(movie_id, 0.0) for movie_id in movie_ids}
+
     @staticmethod
     def aggregate_rating(db_session: Session, movie_id: int):
+        cache = rating_average_cache.for_bind(db_session.get_bind())
+        cached = cache.get(movie_id)
+        if cached is not MISSING:
+            return cached
+        # Taken before the read, a rating committed meanwhile evicts the movie and the
+        # average read here isn't stored
+        version = cache.version()
+
          # Fetch all ratings for the specified movie
         ratings = rating_crud_service.get_all_ratings_for_a_movie(db_session, movie_id)
         
         # Check if there are any ratings
         if not ratings:
+            cache.set(movie_id, 0.0, version=version)
             return 0.0
         
         # Extract the ratings from the objects
@@ -187,38 +536,65 @@ class RatingCRUDService:
         mean_rating = statistics.mean(rating_values)
         
         avg_rating = round(mean_rating, 2)
+        cache.set(movie_id, avg_rating, version=version)
         
         return avg_rating
 
+    @staticmethod
+    def get_average_rating_data(db_session: Session, movie_id: int):
+        movie = movie_crud_service.get_movie_by_id(db_session, movie_id)
+        if movie is None:
+            return None
+        return {
+            "movie_id": movie.id,
+            "movie_title": movie.title,
+            "owner_id": movie.user_id,
+            "avg_rating": rating_crud_service.aggregate_rating(db_session, movie_id),
+        }
+
 
 
     @staticmethod
-    def update_rating(db_session: Session, rating_payload: schemas.RatingUpdate, rating_id: int):
-        rating = rating_crud_service.get_rating_by_id(db_session, rating_id)
+    def update_rating(db_session: Session, rating_payload: schemas.RatingUpdate, rating_id: int, movie_id: int | None = None):
+        rating = rating_crud_service.get_rating_by_id(db_session, rating_id, movie_id)
         if not rating:
             return None
 
         rating_payload_dict = rating_payload.model_dump(exclude_unset=True)
+        previous_value = rating.rating_value
 
         for k, v in rating_payload_dict.items():
             setattr(rating, k, v)
 
         db_session.add(rating)
+        ranking_crud_service.mark_dirty(db_session, rating.movie_id)
+        record_similarity_changes(db_session, [rating.movie_id])
+        record_change(db_session, "rating", rating.id, movie_id=rating.movie_id)
+        emit(db_session, "rating_changed", rating.movie_id, previous=previous_value, value=rating.rating_value)
         db_session.commit()
         db_session.refresh(rating)
+        publish_rating_average(db_session, rating.movie_id)
         return rating
 
     @staticmethod
-    def delete_rating(db_session: Session, rating_id: int = None):
-        rating = rating_crud_service.get_rating_by_id(db_session, rating_id)
+    def delete_rating(db_session: Session, rating_id: int = None, movie_id: int | None = None):
+        rating = rating_crud_service.get_rating_by_id(db_session, rating_id, movie_id)
 
+        movie_id = rating.movie_id
         db_session.delete(rating)
+        count_crud_service.count_rating(db_session, rating, -1)
+        ranking_crud_service.mark_dirty(db_session, movie_id)
+        record_similarity_changes(db_session, [movie_id])
+        record_change(db_session, "rating", rating_id, movie_id=movie_id)
+        emit(db_session, "rating_removed", movie_id, value=rating.rating_value)
         db_session.commit()
+        publish_rating_average(db_session, movie_id)
 
         return None
 
 # Comments CRUD Operations
 
+@traced_service
 class CommentCRUDService:
 
     @staticmethod
@@ -230,13 +606,17 @@ class CommentCRUDService:
         )
 
         db_session.add(db_comment)
+        db_session.flush()
+        count_crud_service.count_comment(db_session, db_comment, 1)
+        emit(db_session, "comment_added", movie_id)
         db_session.commit()
         db_session.refresh(db_comment)
+        publish_comment(db_comment)
         return db_comment
 
     @staticmethod
-    def get_comments(db_session: Session, offset: int = 0, limit: int = 10):
-        # Join comments with the reply counts
+    def get_comments(db_session: Session, offset: int = 0, limit: int = 10, with_authors: bool = True):
+        # Join comments with the reply counts, and with their authors unless they are side-loaded
 
         # Subquery to count replies
         subquery = (
@@ -248,6 +628,18 @@ class CommentCRUDService:
             .subquery()
         )
 
+        if not with_authors:
+            return (
+                db_session.query(
+                    models.Comment,
+                    func.coalesce(subquery.c.reply_count, 0).label("replies")
+                )
+                .outerjoin(subquery, models.Comment.id == subquery.c.parent_id)
+                .offset(offset)
+                .limit(limit)
+                .all()
+            )
+
         # Main query to get comments with reply count and author details
         comments_with_no_of_replies = (
             db_session.query(
@@ -267,24 +659,32 @@ class CommentCRUDService:
         return comments_with_no_of_replies
 
     @staticmethod
-    def get_replies_to_comment(db_session: Session, parent_id: int, offset: int = 0, limit: int = 10):
-        return db_session.query(models.Comment).filter(models.Comment.parent_id == parent_id).offset(offset).limit(limit).all()
+    def get_replies_to_comment(db_session: Session, parent_id: int, offset: int = 0, limit: int = 10, fields=None,
+                               movie_id: int | None = None):
+        # Replies share their parent's movie, filtering on it prunes movie partitions
+        query = project(db_session.query(models.Comment), models.Comment, fields).filter(models.Comment.parent_id == parent_id)
+        if movie_id is not None:
+            query = query.filter(models.Comment.movie_id == movie_id)
+        comments = query.offset(offset).limit(limit).all()
+        return load_users(db_session, comments, fields)
 
     @staticmethod
-    def get_comments_by_movie(db_session: Session, movie_id: int, offset: int = 0, limit: int = 10):
-        return db_session.query(models.Comment).filter(models.Comment.movie_id == movie_id).offset(offset).limit(limit).all()
+    def get_comments_by_movie(db_session: Session, movie_id: int, offset: int = 0, limit: int = 10, fields=None):
+        comments = project(db_session.query(models.Comment), models.Comment, fields).filter(models.Comment.movie_id == movie_id).offset(offset).limit(limit).all()
+        return load_users(db_session, comments, fields)
 
     @staticmethod
-    def get_comment_by_id(db_session: Session, comment_id: int):
-        # Subquery to count replies
+    def get_comment_by_id(db_session: Session, comment_id: int, movie_id: int | None = None):
+        # Subquery to count the replies of this comment only
         reply_count_subquery = (
             select(
                 models.Comment.parent_id,
                 func.count(models.Comment.id).label("reply_count")
             )
+            .where(models.Comment.parent_id == comment_id)
             .group_by(models.Comment.parent_id)
-            .subquery()
         )
+        reply_count_subquery = in_movie(reply_count_subquery, models.Comment, movie_id).subquery()
 
         # Query to get a specific comment with reply count
         query = (
@@ -296,22 +696,24 @@ class CommentCRUDService:
             .outerjoin(reply_count_subquery, models.Comment.id == reply_count_subquery.c.parent_id)
             .where(models.Comment.id == comment_id)
         )
+        query = in_movie(query, models.Comment, movie_id)
         comment_with_no_of_replies = db_session.execute(query).fetchone()
 
         # The above query ensures that comment is returned with the no. of replies
         return comment_with_no_of_replies
 
     @staticmethod
-    def get_comments_by_user(db_session: Session, user_id: int, offset: int = 0, limit: int = 10):
-        return db_session.query(models.Comment).filter(models.Comment.user_id == user_id).offset(offset).limit(limit).all()
+    def get_comments_by_user(db_session: Session, user_id: int, offset: int = 0, limit: int = 10, fields=None):
+        comments = project(db_session.query(models.Comment), models.Comment, fields).filter(models.Comment.user_id == user_id).offset(offset).limit(limit).all()
+        return load_users(db_session, comments, fields)
 
     @staticmethod
-    def get_a_comment(db_session: Session, comment_id: int):
-        return db_session.query(models.Comment).filter(models.Comment.id == comment_id).first()
+    def get_a_comment(db_session: Session, comment_id: int, movie_id: int | None = None):
+        return in_movie(db_session.query(models.Comment), models.Comment, movie_id).filter(models.Comment.id == comment_id).first()
 
     @staticmethod
-    def reply_comment(comment_id: int, db_session: Session, comment: schemas.CommentBase, user_id: int):
-        parent_comment = comment_crud_service.get_a_comment(db_session, comment_id)
+    def reply_comment(comment_id: int, db_session: Session, comment: schemas.CommentBase, user_id: int, movie_id: int | None = None):
+        parent_comment = comment_crud_service.get_a_comment(db_session, comment_id, movie_id)
         if not parent_comment:
             return None
         movie_id = parent_comment.movie_id
@@ -322,13 +724,17 @@ class CommentCRUDService:
             **comment.model_dump(), movie_id=movie_id, parent_id=parent_id, user_id=user_id)
 
         db_session.add(new_comment)
+        db_session.flush()
+        count_crud_service.count_comment(db_session, new_comment, 1)
+        emit(db_session, "comment_added", movie_id)
         db_session.commit()
         db_session.refresh(new_comment)
+        publish_comment(new_comment)
         return new_comment
 
     @staticmethod
-    def update_comment(db_session: Session, comment_payload: schemas.CommentUpdate, comment_id: int):
-        comment = comment_crud_service.get_a_comment(db_session, comment_id)
+    def update_comment(db_session: Session, comment_payload: schemas.CommentUpdate, comment_id: int, movie_id: int | None = None):
+        comment = comment_crud_service.get_a_comment(db_session, comment_id, movie_id)
         if not comment:
             return None
         comment_payload_dict = comment_payload.model_dump(exclude_unset=True)
@@ -337,21 +743,455 @@ class CommentCRUDService:
             setattr(comment, k, v)
 
         db_session.add(comment)
+        # No worker caches comments and the movie cards only count them, nothing to notify
         db_session.commit()
         db_session.refresh(comment)
         return comment
 
     @staticmethod
-    def delete_comment(db_session: Session, comment_id: int):
-        comment = comment_crud_service.get_a_comment(db_session, comment_id)
+    def delete_comment(db_session: Session, comment_id: int, movie_id: int | None = None):
+        comment = comment_crud_service.get_a_comment(db_session, comment_id, movie_id)
 
         db_session.delete(comment)
+        count_crud_service.count_comment(db_session, comment, -1)
+        emit(db_session, "comment_removed", comment.movie_id)
         db_session.commit()
 
         return None
 
 
+# Movie Rankings Operations
+
+
+@traced_service
+class RankingCRUDService:
+
+    @staticmethod
+    def mark_dirty(db_session: Session, movie_id: int):
+        # Flag the movie so the next refresh recomputes its ranking. An upsert, the first two
+        # ratings of a movie may arrive at once.
+        db_session.execute(
+            upsert(db_session, models.MovieRanking)
+            .values(movie_id=movie_id, dirty=True)
+            .on_conflict_do_update(index_elements=[models.MovieRanking.movie_id], set_={"dirty": True})
+        )
+
+    @staticmethod
+    def get_top_movies(db_session: Session, offset: int = 0, limit: int = 10):
+        return (
+            db_session.query(models.Movie, models.MovieRanking)
+            .join(models.MovieRanking, models.MovieRanking.movie_id == models.Movie.id)
+            .filter(models.MovieRanking.rating_count > 0)
+            .order_by(models.MovieRanking.weighted_rating.desc(), models.MovieRanking.movie_id.desc())
+            .offset(offset)
+            .limit(limit)
+            .all()
+        )
+
+    @staticmethod
+    def get_trending_movies(db_session: Session, offset: int = 0, limit: int = 10):
+        return (
+            db_session.query(models.Movie, models.MovieRanking)
+            .join(models.MovieRanking, models.MovieRanking.movie_id == models.Movie.id)
+            .filter(models.MovieRanking.trending_score > 0)
+            .order_by(models.MovieRanking.trending_score.desc(), models.MovieRanking.movie_id.desc())
+            .offset(offset)
+            .limit(limit)
+            .all()
+        )
+
+    @staticmethod
+    def refresh_rankings(db_session: Session, full: bool = False):
+        # Recompute the aggregates of the movies whose ratings changed since the last run
+        dirty_query = db_session.query(models.MovieRanking)
+        if not full:
+            dirty_query = dirty_query.filter(models.MovieRanking.dirty.is_(True))
+        rankings = {ranking.movie_id: ranking for ranking in dirty_query.all()}
+
+        if rankings:
+            aggregates = (
+                db_session.query(
+                    models.Rating.movie_id,
+                    func.count(models.Rating.id),
+                    func.coalesce(func.sum(models.Rating.rating_value), 0)
+                )
+                .filter(models.Rating.movie_id.in_(rankings.keys()))
+                .group_by(models.Rating.movie_id)
+                .all()
+            )
+            totals = {movie_id: (count, total) for movie_id, count, total in aggregates}
+
+            for movie_id, ranking in rankings.items():
+                count, total = totals.get(movie_id, (0, 0))
+                ranking.rating_count = count
+                ranking.rating_sum = total
+                ranking.avg_rating = round(total / count, 2) if count else 0.0
+            db_session.flush()
+
+        # The global mean is read from the ranking table itself, not the ratings
+        global_count, global_sum = db_session.query(
+            func.coalesce(func.sum(models.MovieRanking.rating_count), 0),
+            func.coalesce(func.sum(models.MovieRanking.rating_sum), 0)
+        ).one()
+        global_mean = global_sum / global_count if global_count else 0.0
+
+        for ranking in rankings.values():
+            ranking.weighted_rating = ranking_crud_service.bayesian_average(
+                ranking.rating_count, ranking.avg_rating, global_mean)
+            ranking.dirty = False
+            ranking.updated_at = datetime.now(timezone.utc)
+
+        global trending_cutoff
+        cutoff = ranking_crud_service.refresh_trending(
+            db_session, None if full else list(rankings), trending_cutoff)
+        db_session.commit()
+        trending_cutoff = cutoff
+        return len(rankings)
+
+    @staticmethod
+    def bayesian_average(count: int, avg_rating: float, global_mean: float):
+        # ranking_min_votes is the number of ratings a movie needs before its own average outweighs the global mean
+        if count == 0:
+            return 0.0
+        weight = count / (count + get_settings().ranking_min_votes)
+        return round(weight * avg_rating + (1 - weight) * global_mean, 4)
+
+    @staticmethod
+    def refresh_trending(db_session: Session, movie_ids: list[int] | None = None, since: datetime | None = None):
+        # Trending is the sum of rating values inside the recent window. The scores that can have
+        # changed since the window started at `since` are those of movie_ids, whose ratings changed,
+        # and of the movies whose ratings have left the window since. Without either, every score is
+        # recomputed. Returns the window's start, the `since` of the next run.
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=get_settings().trending_window_hours)
+        in_window = models.Rating.created_at >= cutoff
+        if movie_ids is None or since is None:
+            affected = or_(
+                models.MovieRanking.trending_score > 0,
+                models.MovieRanking.movie_id.in_(select(models.Rating.movie_id).where(in_window)),
+            )
+            rating_filter = in_window
+        else:
+            left_window = select(models.Rating.movie_id).where(models.Rating.created_at >= since, models.Rating.created_at < cutoff)
+            affected = or_(models.MovieRanking.movie_id.in_(movie_ids), models.MovieRanking.movie_id.in_(left_window))
+            rating_filter = in_window & or_(models.Rating.movie_id.in_(movie_ids), models.Rating.movie_id.in_(left_window))
+
+        recent = (
+            db_session.query(models.Rating.movie_id, func.sum(models.Rating.rating_value))
+            .filter(rating_filter)
+            .group_by(models.Rating.movie_id)
+            .all()
+        )
+        scores = {movie_id: float(score or 0) for movie_id, score in recent}
+
+        # Only rows whose score changed are written
+        rankings = db_session.query(models.MovieRanking).filter(affected).all()
+        for ranking in rankings:
+            score = scores.pop(ranking.movie_id, 0.0)
+            if ranking.trending_score != score:
+                ranking.trending_score = score
+
+        # Ratings of movies without a ranking row, left from before rankings existed
+        for movie_id, score in scores.items():
+            db_session.execute(
+                upsert(db_session, models.MovieRanking)
+                .values(movie_id=movie_id, dirty=True, trending_score=score)
+                .on_conflict_do_update(index_elements=[models.MovieRanking.movie_id], set_={"trending_score": score})
+            )
+        return cutoff
+
+
+# Start of the trending window at the last refresh of this process, rankings are refreshed
+# incrementally from there. Any worker may clear the dirty flags, but each one moves its own
+# window: a window refreshed twice costs a query, one never refreshed would leave stale scores.
+trending_cutoff = None
+
+
+# Genre Catalog
+
+@traced_service
+class GenreCRUDService:
+
+    @staticmethod
+    def get_genres(db_session: Session, offset: int = 0, limit: int = 50):
+        # Browse list, the most listed genres first
+        return (
+            db_session.query(models.Genre)
+            .filter(models.Genre.movie_count > 0)
+            .order_by(models.Genre.movie_count.desc(), models.Genre.key)
+            .offset(offset)
+            .limit(limit)
+            .all()
+        )
+
+    @staticmethod
+    def get_genre(db_session: Session, name: str):
+        return db_session.query(models.Genre).filter(models.Genre.key == genre_key(name)).first()
+
+    @staticmethod
+    def get_or_create_genres(db_session: Session, names: list[str]):
+        keys = {genre_key(name): name for name in names}
+        genres = {
+            genre.key: genre
+            for genre in db_session.query(models.Genre).filter(models.Genre.key.in_(keys)).all()
+        }
+        missing = [{"name": name, "key": key, "movie_count": 0} for key, name in keys.items() if key not in genres]
+        if missing:
+            # A request creating the same genre at the same time wins the unique key, its row is read back
+            db_session.execute(
+                upsert(db_session, models.Genre).values(missing).on_conflict_do_nothing(index_elements=[models.Genre.key]))
+            genres.update(
+                (genre.key, genre)
+                for genre in db_session.query(models.Genre).filter(
+                    models.Genre.key.in_([genre["key"] for genre in missing])).all())
+        return [genres[key] for key in keys]
+
+    @staticmethod
+    def change_counts(genres, delta: int):
+        for genre in genres:
+            genre.movie_count = models.Genre.movie_count + delta
+
+    @staticmethod
+    def set_movie_genres(db_session: Session, movie: models.Movie):
+        # Link the movie to the genres named in movie.genre, which is rewritten with their catalog names
+        genres = genre_crud_service.get_or_create_genres(db_session, split_genres(movie.genre))
+        current = list(movie.genres)
+        genre_crud_service.change_counts([genre for genre in current if genre not in genres], -1)
+        genre_crud_service.change_counts([genre for genre in genres if genre not in current], 1)
+        movie.genres = genres
+        movie.genre = ", ".join(genre.name for genre in genres)
+
+    @staticmethod
+    def has_genres(names: list[str]):
+        # Movies with any of the genres. The genre ids come off the unique key index and each
+        # movie is probed on the movie_genres primary key, so pages in id order stop early
+        genre_ids = select(models.Genre.id).where(models.Genre.key.in_([genre_key(name) for name in names]))
+        return (
+            select(models.MovieGenre.movie_id)
+            .where(models.MovieGenre.movie_id == models.Movie.id, models.MovieGenre.genre_id.in_(genre_ids))
+            .exists()
+        )
+
+    @staticmethod
+    def migrate_movies(db_session: Session, batch_size: int = 1000):
+        # Link the movies listed before the catalog existed, then recount every genre
+        linked = select(models.MovieGenre.movie_id)
+        migrated, last_id = 0, 0
+        while True:
+            movies = (
+                db_session.query(models.Movie)
+                .filter(models.Movie.id > last_id, models.Movie.id.not_in(linked))
+                .order_by(models.Movie.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not movies:
+                break
+            for movie in movies:
+                genre_crud_service.set_movie_genres(db_session, movie)
+            last_id = movies[-1].id
+            migrated += len(movies)
+            db_session.commit()
+
+        counts = dict(
+            db_session.query(models.MovieGenre.genre_id, func.count())
+            .group_by(models.MovieGenre.genre_id)
+            .all()
+        )
+        for genre in db_session.query(models.Genre).all():
+            genre.movie_count = counts.get(genre.id, 0)
+        db_session.commit()
+        return migrated
+
+
+# Total Counts
+
+# Counters kept up to date by the write paths: (scope, counted) -> column the rows are counted by
+COUNTED_BY = {
+    ("movie", "ratings"): models.Rating.movie_id,
+    ("movie", "comments"): models.Comment.movie_id,
+    ("user", "ratings"): models.Rating.user_id,
+    ("user", "comments"): models.Comment.user_id,
+    ("comment", "replies"): models.Comment.parent_id,
+}
+
+
+@traced_service
+class CountCRUDService:
+
+    @staticmethod
+    def count_query(scope: str, scope_id: int, counted: str):
+        # Counting by an indexed foreign key only touches the rows of one movie, user or comment
+        column = COUNTED_BY[(scope, counted)]
+        return select(func.count()).select_from(column.class_).where(column == scope_id)
+
+    @staticmethod
+    def change_count(db_session: Session, scope: str, scope_id: int | None, counted: str, delta: int):
+        # Call before the commit, after the row was added or deleted
+        if scope_id is None:
+            return
+        db_session.flush()
+        counter = models.ActivityCount
+        key = (counter.scope == scope, counter.scope_id == scope_id, counter.counted == counted)
+        incremented = counter.count + delta
+        updated = db_session.execute(
+            update(counter).where(*key).values(count=incremented).execution_options(synchronize_session=False))
+        if not updated.rowcount:
+            # The first counter of a scope starts from the rows already there. A request that
+            # creates it at the same time conflicts on the key and adds its delta instead
+            db_session.execute(
+                upsert(db_session, counter)
+                .values(scope=scope, scope_id=scope_id, counted=counted,
+                        count=count_crud_service.count_query(scope, scope_id, counted).scalar_subquery())
+                .on_conflict_do_update(index_elements=[counter.scope, counter.scope_id, counter.counted],
+                                       set_={"count": incremented}))
+        # The statements bypass the session, drop a counter it has loaded
+        loaded = db_session.identity_map.get(db_session.identity_key(counter, (scope, scope_id, counted)))
+        if loaded is not None:
+            db_session.expire(loaded)
+
+    @staticmethod
+    def count_rating(db_session: Session, rating: models.Rating, delta: int):
+        count_crud_service.change_count(db_session, "movie", rating.movie_id, "ratings", delta)
+        count_crud_service.change_count(db_session, "user", rating.user_id, "ratings", delta)
+
+    @staticmethod
+    def count_comment(db_session: Session, comment: models.Comment, delta: int):
+        count_crud_service.change_count(db_session, "movie", comment.movie_id, "comments", delta)
+        count_crud_service.change_count(db_session, "user", comment.user_id, "comments", delta)
+        count_crud_service.change_count(db_session, "comment", comment.parent_id, "replies", delta)
+
+    @staticmethod
+    def get_count(db_session: Session, scope: str, scope_id: int, counted: str):
+        # Exact count from the maintained counter
+        counter = db_session.get(models.ActivityCount, (scope, scope_id, counted))
+        if counter is not None:
+            return counter.count
+        return db_session.execute(count_crud_service.count_query(scope, scope_id, counted)).scalar()
+
+    @staticmethod
+    def estimate_table_count(db_session: Session, model):
+        # Approximate row count of a whole table without scanning it
+        table = model.__table__
+        if db_session.get_bind().dialect.name == "postgresql":
+            estimate = db_session.execute(
+                text("SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+                {"table": table.name}
+            ).scalar()
+            # -1 until the table was first analyzed
+            if estimate is not None and estimate >= 0:
+                return int(estimate)
+        # Ids come from a sequence, the largest one is read off the primary key index
+        return db_session.query(func.coalesce(func.max(table.c.id), 0)).scalar()
+
+    @staticmethod
+    def estimate_query_count(db_session: Session, query):
+        # The planner's row estimate for a filtered query, only PostgreSQL exposes one cheaply
+        dialect = db_session.get_bind().dialect
+        if dialect.name != "postgresql":
+            return None
+        compiled = query.limit(None).offset(None).order_by(None).statement.compile(
+            dialect=dialect, compile_kwargs={"render_postcompile": True})
+        plan = db_session.connection().exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+
+# Movie Cards Operations
+
+@traced_service
+class MovieCardCRUDService:
+
+    @staticmethod
+    def get_movie_card(db_session: Session, movie_id: int):
+        # One primary key read of the projection maintained by app/movie_cards.py
+        return db_session.get(models.MovieCard, movie_id)
+
+    @staticmethod
+    def get_movie_cards(db_session: Session, movie_ids: list[int]):
+        # One IN query, returned in the order of movie_ids
+        cards = db_session.query(models.MovieCard).filter(models.MovieCard.movie_id.in_(movie_ids)).all()
+        found = {card.movie_id: card for card in cards}
+        return [found[movie_id] for movie_id in movie_ids if movie_id in found]
+
+
 user_service = UserCRUDService()
 movie_crud_service = MovieCRUDService()
 rating_crud_service = RatingCRUDService()
-comment_crud_service = CommentCRUDService()
\ No newline at end of file
+comment_crud_service = CommentCRUDService()
+ranking_crud_service = RankingCRUDService()
+count_crud_service = CountCRUDService()
+genre_crud_service = GenreCRUDService()
+movie_card_crud_service = MovieCardCRUDService()
+
+
+# Coalesced Reads
+
+# The hottest reads when a movie trends: concurrent identical calls share one query.
+# Keys include the engine, a read on the replica isn't shared with one on the primary.
+movie_flights = SingleFlight("movie")
+average_rating_flights = SingleFlight("average_rating")
+
+
+def read_in_own_session(bind, read, *args):
+    # A flight outlives the request that started it, so it never reads through that request's
+    # session, which is closed when its client goes away. It opens one on the same engine.
+    if bind is database.engine:
+        db = database.SessionLocal()
+    elif bind is database.replica_engine:
+        db = database.ReplicaSessionLocal()
+    else:
+        db = Session(bind=bind, autoflush=False)
+    try:
+        return read(db, *args)
+    finally:
+        db.close()
+
+
+async def get_movie_shared(db_session: Session, movie_id):
+    movie_id = normalize_key(movie_id)
+    bind = db_session.get_bind()
+    return await movie_flights.do(
+        (movie_id, bind), read_in_own_session, bind, movie_crud_service.get_movie_data, movie_id)
+
+
+async def get_average_rating_shared(db_session: Session, movie_id: int):
+    bind = db_session.get_bind()
+    return await average_rating_flights.do(
+        (movie_id, bind), read_in_own_session, bind, rating_crud_service.get_average_rating_data, movie_id)
+
+
+# Cross-worker Invalidation Handlers
+
+def evict_rating_average(change: dict):
+    rating_average_cache.evict(change["movie_id"])
+
+
+def reindex_movie(change: dict):
+    # Another worker changed the movie, re-read it into this worker's content index
+    from app.content_index import content_index
+    db = database.SessionLocal()
+    try:
+        movie = movie_crud_service.get_movie_by_id(db, change["id"])
+        if movie is None:
+            content_index.remove(change["id"])
+        else:
+            content_index.add_movie(movie)
+    finally:
+        db.close()
+
+
+def forget_movie_flights(change: dict):
+    movie_flights.forget(change["id"])
+    average_rating_flights.forget(change["id"])
+
+
+def forget_average_rating_flights(change: dict):
+    average_rating_flights.forget(change["movie_id"])
+
+
+on_change("rating", evict_rating_average)
+on_change("rating", forget_average_rating_flights)
+on_change("movie", forget_movie_flights)
+on_change("user", forget_average_rating_flights)
+on_change("movie", reindex_movie, local=False)
@@ -1,36 +1,151 @@
-import os
-from dotenv import load_dotenv
-from sqlalchemy import create_engine
+import time
+from starlette.requests import HTTPConnection
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from app.config import Settings, get_settings
+from app.tracing import MAX_STATEMENT_LENGTH, end_span, start_span
 
+# Base class for declarative models
 Base = declarative_base()
 
+# Methods that never mutate data and can be served by the replica
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
 
-# Load environment variables from .env file
-load_dotenv()
+# POST endpoints that only read, /batch runs GET sub-requests
+READ_ONLY_PATHS = {"/batch"}
 
-# Load the DATABASE_URL from environment variables
-SQLALCHEMY_DATABASE_URL = os.getenv('DATABASE_URL')
+# Engines are created by init_database when the application starts, not at import
+engine = None
+replica_engine = None
 
-if not SQLALCHEMY_DATABASE_URL:
-    raise ValueError("DATABASE_URL is not set in environment variables")
+# Session makers are bound to the engines by init_database
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False)
 
-# Create SQLAlchemy engine
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
-)
+# Write marker: the time of a client's last write, set on write responses as a cookie and a
+# header. The client carries it to whichever worker serves its next request, a client that
+# doesn't keep cookies can send the header back instead.
+LAST_WRITE_COOKIE = "last_write"
+LAST_WRITE_HEADER = "x-last-write"
 
-# Create a session maker bound to the engine
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# Base class for declarative models
-Base = declarative_base()
+def make_engine(url: str, settings: Settings, **kwargs):
+    if url.startswith("sqlite"):
+        return create_engine(url, **kwargs)
+    return create_engine(
+        url,
+        pool_size=settings.database_pool_size,
+        max_overflow=settings.database_max_overflow,
+        **kwargs
+    )
+
+
+def init_database(settings: Settings):
+    global engine, replica_engine
+    if not settings.database_url:
+        raise ValueError("DATABASE_URL is not set in environment variables")
+
+    # Create SQLAlchemy engine
+    engine = make_engine(settings.database_url, settings)
+
+    # Create the read-only engine, reads fall back to the primary when it is not set
+    if settings.database_replica_url:
+        if settings.database_replica_url.startswith("postgresql"):
+            replica_engine = make_engine(
+                settings.database_replica_url, settings,
+                execution_options={"postgresql_readonly": True}
+            )
+        else:
+            replica_engine = make_engine(settings.database_replica_url, settings)
+    else:
+        replica_engine = engine
+
+    SessionLocal.configure(bind=engine)
+    ReplicaSessionLocal.configure(bind=replica_engine)
+    return engine
+
+
+# A span per SQL statement run inside a traced request, on every engine
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement_span(connection, cursor, statement, parameters, context, executemany):
+    span = start_span("sql", "client", {
+        "db.system": connection.dialect.name,
+        "db.statement": statement[:MAX_STATEMENT_LENGTH],
+    })
+    if span is not None and context is not None:
+        context.trace_span = span
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement_span(connection, cursor, statement, parameters, context, executemany):
+    span = getattr(context, "trace_span", None)
+    if span is not None:
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            span.attributes["db.rows"] = cursor.rowcount
+        end_span(span)
+        context.trace_span = None
+
+
+@event.listens_for(Engine, "handle_error")
+def end_failed_statement_span(exception_context):
+    span = getattr(exception_context.execution_context, "trace_span", None)
+    if span is not None:
+        end_span(span, exception_context.original_exception)
+        exception_context.execution_context.trace_span = None
+
+
+def dispose_database():
+    global engine, replica_engine
+    if replica_engine is not None and replica_engine is not engine:
+        replica_engine.dispose()
+    if engine is not None:
+        engine.dispose()
+    engine = replica_engine = None
+
+
+def last_write_time(request: HTTPConnection):
+    value = request.headers.get(LAST_WRITE_HEADER) or request.cookies.get(LAST_WRITE_COOKIE)
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def wrote_recently(request: HTTPConnection, now: float | None = None):
+    wrote_at = last_write_time(request)
+    if wrote_at is None:
+        return False
+    now = time.time() if now is None else now
+    # Either way round, clocks of the workers' hosts may differ slightly. A marker from far in
+    # the future is ignored rather than pinning the client for good.
+    return abs(now - wrote_at) < get_settings().read_your_writes_seconds
+
+
+def write_marker(now: float | None = None):
+    # Value of the cookie and the header set on a write response
+    return f"{time.time() if now is None else now:.3f}"
+
+
+def request_method(request: HTTPConnection):
+    if request.scope.get("path") in READ_ONLY_PATHS:
+        return "GET"
+    # WebSocket connections have no method and only ever read
+    return request.scope.get("method", "GET")
+
+
+def choose_session_factory(request: HTTPConnection):
+    # Mutations always go to the primary, and so do reads of a client that wrote recently
+    if request_method(request) not in SAFE_METHODS or wrote_recently(request):
+        return SessionLocal
+    return ReplicaSessionLocal
 
 
-def get_database_session():
+def get_database_session(request: HTTPConnection):
     # Provide a database session to be used in dependency injection
-    db = SessionLocal()
+    db = choose_session_factory(request)()
     try:
         yield db
     finally:
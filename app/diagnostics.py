@@ -0,0 +1,192 @@
+import gc
+import itertools
+import random
+import resource
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import OrderedDict, deque
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.config import Settings
+from app.metrics import gauge
+
+# Memory diagnostics for the admin endpoints in app/routers/diagnostics.py:
+# tracemalloc snapshots kept in memory and diffed on demand, the peak allocation
+# of sampled requests, and the sessions that are open with their identity maps.
+
+# Snapshots kept at most, the oldest is dropped first
+MAX_SNAPSHOTS = 10
+
+# Sampled requests remembered
+MAX_REQUEST_SAMPLES = 200
+
+# Frames tracemalloc leaves out of the statistics, its own and the import machinery's
+IGNORED_FILES = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>")
+
+request_peak_bytes = gauge("checkflix_request_peak_allocated_bytes", "Largest peak allocation of a sampled request per route")
+
+snapshots = OrderedDict()
+snapshot_ids = itertools.count(1)
+snapshots_lock = threading.Lock()
+
+request_samples = deque(maxlen=MAX_REQUEST_SAMPLES)
+
+# Sessions in a transaction, added and removed from the threads running them
+live_sessions = weakref.WeakSet()
+live_sessions_lock = threading.Lock()
+
+
+@event.listens_for(Session, "after_begin")
+def track_session(db_session: Session, transaction, connection):
+    with live_sessions_lock:
+        live_sessions.add(db_session)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def untrack_session(db_session: Session, transaction):
+    # Commit, rollback and close all end the outermost transaction, savepoints end inside it
+    if transaction.parent is None:
+        with live_sessions_lock:
+            live_sessions.discard(db_session)
+
+
+def start_tracing(frames: int):
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    tracemalloc.start(frames)
+
+
+def stop_tracing():
+    tracemalloc.stop()
+    with snapshots_lock:
+        snapshots.clear()
+
+
+def kib(size: int):
+    return round(size / 1024, 1)
+
+
+def process_memory():
+    current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+    with live_sessions_lock:
+        sessions = list(live_sessions)
+    with snapshots_lock:
+        snapshot_ids_taken = list(snapshots)
+    return {
+        "tracing": tracemalloc.is_tracing(),
+        "traceback_frames": tracemalloc.get_traceback_limit() if tracemalloc.is_tracing() else 0,
+        "traced_kib": kib(current),
+        "traced_peak_kib": kib(peak),
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "gc_objects": len(gc.get_objects()),
+        "open_sessions": len(sessions),
+        "identity_map_objects": sum(len(db_session.identity_map) for db_session in sessions),
+        "snapshots": [snapshot_info(snapshot_id) for snapshot_id in snapshot_ids_taken],
+    }
+
+
+def take_snapshot():
+    if not tracemalloc.is_tracing():
+        raise RuntimeError("tracemalloc is not tracing, start it first")
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, filename) for filename in IGNORED_FILES])
+    with snapshots_lock:
+        snapshot_id = next(snapshot_ids)
+        snapshots[snapshot_id] = (time.time(), snapshot)
+        while len(snapshots) > MAX_SNAPSHOTS:
+            snapshots.popitem(last=False)
+    return snapshot_id
+
+
+def get_snapshot(snapshot_id: int):
+    with snapshots_lock:
+        entry = snapshots.get(snapshot_id)
+    if entry is None:
+        raise KeyError(snapshot_id)
+    return entry
+
+
+def snapshot_info(snapshot_id: int):
+    taken_at, snapshot = get_snapshot(snapshot_id)
+    return {
+        "id": snapshot_id,
+        "taken_at": taken_at,
+        "traced_kib": kib(sum(trace.size for trace in snapshot.traces)),
+    }
+
+
+def frame_list(traceback):
+    return [f"{frame.filename}:{frame.lineno}" for frame in traceback]
+
+
+def top_allocations(snapshot_id: int, group_by: str = "lineno", limit: int = 20):
+    _, snapshot = get_snapshot(snapshot_id)
+    return [
+        {"site": frame_list(stat.traceback), "size_kib": kib(stat.size), "count": stat.count}
+        for stat in snapshot.statistics(group_by)[:limit]
+    ]
+
+
+def diff_snapshots(first_id: int, second_id: int, group_by: str = "lineno", limit: int = 20):
+    # Allocation sites that grew the most from the first snapshot to the second
+    _, first = get_snapshot(first_id)
+    _, second = get_snapshot(second_id)
+    return [
+        {
+            "site": frame_list(stat.traceback),
+            "size_kib": kib(stat.size),
+            "size_diff_kib": kib(stat.size_diff),
+            "count": stat.count,
+            "count_diff": stat.count_diff,
+        }
+        for stat in second.compare_to(first, group_by)[:limit]
+    ]
+
+
+class MemorySamplingMiddleware:
+    # Records how far traced memory rose above its starting point during sampled requests.
+    # tracemalloc's peak is process wide, so one request is sampled at a time and the
+    # figure also counts what concurrent requests allocated meanwhile.
+
+    def __init__(self, app, settings: Settings):
+        self.app = app
+        self.sample_rate = settings.memory_sample_rate
+        self.lock = threading.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or not tracemalloc.is_tracing()
+                or random.random() >= self.sample_rate or not self.lock.acquire(blocking=False)):
+            await self.app(scope, receive, send)
+            return
+
+        status_code = None
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        start_size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+            self.lock.release()
+            route = scope.get("route")
+            template = getattr(route, "path", scope["path"])
+            peak_bytes = max(peak - start_size, 0)
+            request_samples.append({
+                "method": scope["method"],
+                "route": template,
+                "status_code": status_code,
+                "peak_kib": kib(peak_bytes),
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                "at": time.time(),
+            })
+            if peak_bytes > request_peak_bytes.get(route=template):
+                request_peak_bytes.set(peak_bytes, route=template)
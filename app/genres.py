@@ -0,0 +1,48 @@
+import argparse
+import re
+import time
+
+# Genre names. Movie.genre holds one or more genres ("Drama, Crime"), each one is
+# linked to a row of the genres catalog through movie_genres. Genres are the same
+# when their keys are: whitespace collapsed and case folded ("Drama ", "drama").
+
+GENRE_SEPARATORS = re.compile(r"[,|]")
+
+
+def clean_genre(name: str):
+    return " ".join(name.split())
+
+
+def genre_key(name: str):
+    return clean_genre(name).casefold()
+
+
+def split_genres(value: str | None):
+    # Distinct genre names in the order they were given
+    names = {}
+    for name in GENRE_SEPARATORS.split(value or ""):
+        name = clean_genre(name)
+        if name:
+            names.setdefault(genre_key(name), name)
+    return list(names.values())
+
+
+if __name__ == "__main__":
+    from app.config import get_settings
+    from app.crud import genre_crud_service
+    from app.database import Base, SessionLocal, init_database
+
+    parser = argparse.ArgumentParser(description="Link existing movies to the genre catalog and recount the genres")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    engine = init_database(get_settings())
+    # Creates the genres and movie_genres tables if they don't exist yet
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        migrated = genre_crud_service.migrate_movies(db, batch_size=args.batch_size)
+        print(f"Linked {migrated} movies to their genres in {time.perf_counter() - started:.2f}s")
+    finally:
+        db.close()
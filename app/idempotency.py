@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import zlib
+from datetime import datetime, timedelta, timezone
+from fastapi.responses import JSONResponse, Response
+from jose import JWTError, jwt
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+import app.database as database
+from app.config import Settings, get_settings
+from app.crud import user_service
+from app.metrics import counter
+from app.models import IdempotencyKey
+
+# Idempotency-Key support for POST requests. The first request with a key claims it
+# in the idempotency_keys table, which every worker shares. Its response is stored
+# compressed, and a retry with the same key gets that response back without running
+# the endpoint again. A duplicate that arrives while the first request is still
+# running waits for its response. Keys expire after IDEMPOTENCY_TTL_SECONDS.
+
+HEADER = "idempotency-key"
+MAX_KEY_LENGTH = 255
+
+# Logging in twice must hand out a fresh token, never a stored one
+EXCLUDED_PATHS = ("/login",)
+
+# Responses a retry could change, the key is released instead of stored
+RETRYABLE_STATUSES = {401, 403, 408, 409, 425, 429}
+
+# How often a duplicate checks whether a request on another worker finished
+POLL_SECONDS = 0.1
+
+CLAIMED, DONE, PENDING, MISMATCH = "claimed", "done", "pending", "mismatch"
+
+idempotency_requests = counter("checkflix_idempotency_requests_total", "Requests with an Idempotency-Key per outcome")
+
+
+def key_digest(client: str, method: str, path: str, key: str):
+    return hashlib.sha256("\0".join((client, method, path, key)).encode()).digest()
+
+
+def client_identity(authorization: str | None, client):
+    # Keys belong to the user a token resolves to, so every token of a user shares them,
+    # and to the client address for anonymous requests
+    if not authorization:
+        return f"address:{client[0] if client else ''}"
+    _, _, token = authorization.partition(" ")
+    settings = get_settings()
+    try:
+        subject = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm]).get("sub")
+    except JWTError:
+        subject = None
+    if subject is not None:
+        db = database.SessionLocal()
+        try:
+            user = user_service.get_user_by_email_or_username(db, subject)
+        finally:
+            db.close()
+        if user is not None:
+            return f"user:{user.id}"
+    # The endpoint rejects a token that resolves to no one, it never shares a key
+    return f"token:{authorization}"
+
+
+def claim(key: bytes, fingerprint: bytes, settings: Settings):
+    # Returns (CLAIMED, None), (DONE, (status, content type, body)), (PENDING, None) or (MISMATCH, None)
+    now = datetime.now(timezone.utc)
+    db = database.SessionLocal()
+    try:
+        db.query(IdempotencyKey).filter(
+            IdempotencyKey.key == key, IdempotencyKey.expires_at <= now).delete(synchronize_session=False)
+        db.add(IdempotencyKey(
+            key=key, fingerprint=fingerprint,
+            locked_until=now + timedelta(seconds=settings.idempotency_lock_seconds),
+            expires_at=now + timedelta(seconds=settings.idempotency_ttl_seconds),
+        ))
+        try:
+            db.commit()
+            return CLAIMED, None
+        except IntegrityError:
+            db.rollback()
+
+        stored = db.get(IdempotencyKey, key)
+        if stored is None:
+            # Released or expired in the meantime, the caller tries again
+            return PENDING, None
+        if stored.fingerprint != fingerprint:
+            return MISMATCH, None
+        if stored.status_code is not None:
+            return DONE, (stored.status_code, stored.content_type, zlib.decompress(stored.body))
+
+        # Take over a key whose request died without releasing it
+        taken = db.query(IdempotencyKey).filter(
+            IdempotencyKey.key == key,
+            IdempotencyKey.status_code.is_(None),
+            IdempotencyKey.locked_until < now,
+        ).update({"locked_until": now + timedelta(seconds=settings.idempotency_lock_seconds)}, synchronize_session=False)
+        db.commit()
+        return (CLAIMED if taken else PENDING), None
+    finally:
+        db.close()
+
+
+def complete(key: bytes, status_code: int, content_type: str | None, body: bytes, settings: Settings):
+    db = database.SessionLocal()
+    try:
+        db.query(IdempotencyKey).filter(IdempotencyKey.key == key).update({
+            "status_code": status_code,
+            "content_type": content_type,
+            "body": zlib.compress(body),
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=settings.idempotency_ttl_seconds),
+        }, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def release(key: bytes):
+    db = database.SessionLocal()
+    try:
+        db.query(IdempotencyKey).filter(
+            IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def purge_expired():
+    db = database.SessionLocal()
+    try:
+        purged = db.query(IdempotencyKey).filter(
+            IdempotencyKey.expires_at <= datetime.now(timezone.utc)).delete(synchronize_session=False)
+        db.commit()
+        return purged
+    finally:
+        db.close()
+
+
+class IdempotencyMiddleware:
+
+    def __init__(self, app, settings: Settings):
+        self.app = app
+        self.settings = settings
+        # Keys of the requests running in this worker, set when their response is stored
+        self.running = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"].startswith(EXCLUDED_PATHS):
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        idempotency_key = headers.get(HEADER)
+        if idempotency_key is None:
+            await self.app(scope, receive, send)
+            return
+        if not 0 < len(idempotency_key) <= MAX_KEY_LENGTH:
+            response = JSONResponse(status_code=400, content={
+                "detail": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"})
+            await response(scope, receive, send)
+            return
+
+        body = await read_body(receive)
+        if body is None:
+            return
+        client = await run_in_threadpool(client_identity, headers.get("authorization"), scope.get("client"))
+        key = key_digest(client, scope["method"], scope["path"], idempotency_key)
+        fingerprint = hashlib.sha256(body).digest()
+
+        waited = False
+        deadline = asyncio.get_running_loop().time() + self.settings.idempotency_wait_seconds
+        while True:
+            outcome, stored = await run_in_threadpool(claim, key, fingerprint, self.settings)
+            if outcome == CLAIMED:
+                break
+            if outcome == DONE:
+                idempotency_requests.inc(outcome="waited" if waited else "replayed")
+                status_code, content_type, content = stored
+                response = Response(content, status_code=status_code, media_type=content_type,
+                                    headers={"Idempotent-Replayed": "true"})
+                await response(scope, receive, send)
+                return
+            if outcome == MISMATCH:
+                idempotency_requests.inc(outcome="mismatch")
+                response = JSONResponse(status_code=422, content={
+                    "detail": "Idempotency-Key was already used for a different request"})
+                await response(scope, receive, send)
+                return
+
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                idempotency_requests.inc(outcome="in_progress")
+                response = JSONResponse(status_code=409, headers={"Retry-After": "1"}, content={
+                    "detail": "A request with this Idempotency-Key is still in progress"})
+                await response(scope, receive, send)
+                return
+            waited = True
+            finished = self.running.get(key)
+            if finished is None:
+                await asyncio.sleep(min(remaining, POLL_SECONDS))
+            else:
+                try:
+                    await asyncio.wait_for(finished.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+        idempotency_requests.inc(outcome="executed")
+        # A duplicate that takes over the key once its lock expires replaces the entry,
+        # only the event this request set is removed
+        finished = asyncio.Event()
+        self.running[key] = finished
+        try:
+            await self.execute(key, body, scope, receive, send)
+        finally:
+            if self.running.get(key) is finished:
+                del self.running[key]
+            finished.set()
+
+    async def execute(self, key: bytes, body: bytes, scope, receive, send):
+        response = {"status": None, "content_type": None, "chunks": [], "size": 0}
+        body_sent = False
+
+        async def replay_body():
+            nonlocal body_sent
+            if body_sent:
+                return await receive()
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["content_type"] = Headers(raw=message.get("headers", [])).get("content-type")
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                response["size"] += len(chunk)
+                if response["size"] <= self.settings.idempotency_max_body_bytes:
+                    response["chunks"].append(chunk)
+            await send(message)
+
+        try:
+            await self.app(scope, replay_body, capture)
+        except BaseException:
+            await run_in_threadpool(release, key)
+            raise
+
+        status_code = response["status"]
+        if (status_code is None or status_code >= 500 or status_code in RETRYABLE_STATUSES
+                or response["size"] > self.settings.idempotency_max_body_bytes):
+            await run_in_threadpool(release, key)
+        else:
+            await run_in_threadpool(
+                complete, key, status_code, response["content_type"], b"".join(response["chunks"]), self.settings)
+
+
+async def read_body(receive):
+    # The whole request body, or None when the client went away
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
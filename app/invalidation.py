@@ -0,0 +1,174 @@
+import asyncio
+import json
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+import app.database as database
+import app.models as models
+from app.logger import custom_logger
+from app.metrics import counter
+
+# Cross-worker change notifications. The CRUD write paths record a change inside
+# their transaction: a NOTIFY on Postgres, a row in cache_invalidations elsewhere.
+# Every worker listens (or polls, on SQLite) and runs the handlers registered for
+# the entity so in-process caches and indexes drop what went stale.
+
+CHANNEL = "checkflix_invalidation"
+
+# Identifies this worker, so it skips the notifications it sent itself
+ORIGIN = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# Polled rows are kept this long before they are pruned
+INVALIDATION_RETENTION = timedelta(hours=1)
+
+invalidations_sent = counter("checkflix_invalidations_sent_total", "Change notifications sent per entity")
+invalidations_received = counter("checkflix_invalidations_received_total", "Change notifications received from other workers per entity")
+
+# entity -> [(handler, local)]
+handlers = {}
+
+
+def on_change(entity: str, handler, local: bool = True):
+    # Local handlers also run in the worker that made the change, right after its commit.
+    # Non-local handlers are for state the write path already updated itself.
+    handlers.setdefault(entity, []).append((handler, local))
+    return handler
+
+
+def record_change(db_session: Session, entity: str, entity_id: int, movie_id: int | None = None):
+    # Must be called before the commit, the notification is only delivered if it commits.
+    # Nothing is sent for entities no cache or index depends on.
+    if entity not in handlers:
+        return
+    change = {"entity": entity, "id": entity_id, "movie_id": movie_id, "origin": ORIGIN}
+    if db_session.get_bind().dialect.name == "postgresql":
+        db_session.execute(select(func.pg_notify(CHANNEL, json.dumps(change))))
+    else:
+        db_session.add(models.CacheInvalidation(
+            entity=entity, entity_id=entity_id, movie_id=movie_id, origin=ORIGIN))
+    db_session.info.setdefault("changes", []).append(change)
+    invalidations_sent.inc(entity=entity)
+
+
+@event.listens_for(Session, "after_commit")
+def apply_committed_changes(db_session: Session):
+    for change in db_session.info.pop("changes", []):
+        apply_change(change, local=True)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_changes(db_session: Session):
+    db_session.info.pop("changes", None)
+
+
+def apply_change(change: dict, local: bool = False):
+    for handler, runs_locally in handlers.get(change["entity"], []):
+        if local and not runs_locally:
+            continue
+        try:
+            handler(change)
+        except Exception:
+            custom_logger.exception(f"Invalidation handler for {change['entity']} failed")
+
+
+def apply_remote_changes(changes):
+    for change in changes:
+        if change.get("origin") == ORIGIN:
+            continue
+        invalidations_received.inc(entity=change["entity"])
+        apply_change(change)
+
+
+async def listen_for_changes(poll_seconds: float):
+    # Runs for the life of the worker
+    if database.engine.dialect.name == "postgresql":
+        await listen_postgres()
+    else:
+        await poll_changes(poll_seconds)
+
+
+async def listen_postgres():
+    loop = asyncio.get_running_loop()
+    while True:
+        connection = None
+        try:
+            # A dedicated connection outside the pool, LISTEN needs it for the worker's lifetime
+            connection = database.engine.raw_connection()
+            connection.detach()
+            driver_connection = connection.driver_connection
+            driver_connection.autocommit = True
+            with driver_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+
+            received = asyncio.Queue()
+
+            def on_readable():
+                driver_connection.poll()
+                changes = []
+                while driver_connection.notifies:
+                    changes.append(json.loads(driver_connection.notifies.pop(0).payload))
+                if changes:
+                    received.put_nowait(changes)
+
+            loop.add_reader(driver_connection.fileno(), on_readable)
+            try:
+                while True:
+                    changes = await received.get()
+                    await run_in_threadpool(apply_remote_changes, changes)
+            finally:
+                loop.remove_reader(driver_connection.fileno())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            custom_logger.exception("Invalidation listener failed, reconnecting")
+            await asyncio.sleep(5)
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+async def poll_changes(poll_seconds: float):
+    # SQLite has no LISTEN/NOTIFY, read the rows other workers wrote instead
+    last_id = await run_in_threadpool(latest_change_id)
+    while True:
+        await asyncio.sleep(poll_seconds)
+        try:
+            last_id = await run_in_threadpool(poll_once, last_id)
+        except Exception:
+            custom_logger.exception("Polling for invalidations failed")
+
+
+def latest_change_id():
+    db = database.SessionLocal()
+    try:
+        return db.query(func.coalesce(func.max(models.CacheInvalidation.id), 0)).scalar()
+    finally:
+        db.close()
+
+
+def poll_once(last_id: int):
+    db = database.SessionLocal()
+    try:
+        rows = (
+            db.query(models.CacheInvalidation)
+            .filter(models.CacheInvalidation.id > last_id)
+            .order_by(models.CacheInvalidation.id)
+            .all()
+        )
+        changes = [
+            {"entity": row.entity, "id": row.entity_id, "movie_id": row.movie_id, "origin": row.origin}
+            for row in rows
+        ]
+        if rows:
+            last_id = rows[-1].id
+
+        cutoff = datetime.now(timezone.utc) - INVALIDATION_RETENTION
+        db.query(models.CacheInvalidation).filter(models.CacheInvalidation.created_at < cutoff).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    apply_remote_changes(changes)
+    return last_id
@@ -0,0 +1,89 @@
+import asyncio
+import json
+import threading
+from app.metrics import counter, gauge
+
+# In-process fan-out of movie activity to live subscribers (SSE and WebSocket).
+# A subscriber is a small bounded queue, so idle connections cost almost nothing
+# and a slow one only ever loses its own oldest events.
+
+live_subscribers = gauge("checkflix_live_subscribers", "Open live feed subscriptions")
+live_published = counter("checkflix_live_events_published_total", "Live feed events published per type")
+live_dropped = counter("checkflix_live_events_dropped_total", "Live feed events dropped for slow subscribers")
+
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class Subscription:
+
+    def __init__(self, broker, topic):
+        self.broker = broker
+        self.topic = topic
+        # Subscriptions live on the event loop that serves them
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def push(self, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+            live_dropped.inc()
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+
+    def __init__(self):
+        self.topics = {}
+        # Writes publish from threadpool threads while the event loop subscribes and unsubscribes
+        self.lock = threading.Lock()
+
+    def subscribe(self, topic):
+        subscription = Subscription(self, topic)
+        with self.lock:
+            self.topics.setdefault(topic, set()).add(subscription)
+        live_subscribers.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.topics.get(subscription.topic)
+            if subscribers is None or subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.topics[subscription.topic]
+        live_subscribers.dec()
+
+    def has_subscribers(self, topic):
+        return bool(self.topics.get(topic))
+
+    def publish(self, topic, event: dict):
+        if not self.has_subscribers(topic):
+            return
+        live_published.inc(type=event["type"])
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        with self.lock:
+            subscriptions = list(self.topics.get(topic, ()))
+        for subscription in subscriptions:
+            if subscription.loop is running_loop:
+                subscription.push(event)
+            elif not subscription.loop.is_closed():
+                # Writes may commit from another thread, hand the event over to the subscriber's loop
+                subscription.loop.call_soon_threadsafe(subscription.push, event)
+
+
+def encode_event(event: dict):
+    return json.dumps(event, default=str)
+
+
+# Movie activity, one topic per movie id
+movie_feed = Broker()
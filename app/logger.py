@@ -1,14 +1,7 @@
-import os
-
 import logging
 import sys
-from dotenv import load_dotenv
-from logtail import LogtailHandler
-
-
-load_dotenv(dotenv_path='app/.env')
+from app.config import Settings
 
-token = os.getenv("BETTER_STACK_TOKEN")
 
 # Get logger
 
@@ -22,13 +15,37 @@ formatter = logging.Formatter(
 
 # Create handlers
 stream_handler = logging.StreamHandler(sys.stdout)
-better_stack_handler = LogtailHandler(source_token=token)
 
 # Set formatters
 stream_handler.setFormatter(formatter)
 
 # Add handlers to the logger
-custom_logger.handlers = [stream_handler, better_stack_handler]
+custom_logger.handlers = [stream_handler]
 
 # Set log level
-custom_logger.setLevel(logging.INFO)
\ No newline at end of file
+custom_logger.setLevel(logging.INFO)
+
+# The Better Stack handler ships logs over the network, so it is only created at startup
+better_stack_handler = None
+
+
+def init_log_shipping(settings: Settings):
+    global better_stack_handler
+    if not settings.better_stack_token or better_stack_handler is not None:
+        return None
+    from logtail import LogtailHandler
+
+    better_stack_handler = LogtailHandler(source_token=settings.better_stack_token)
+    custom_logger.addHandler(better_stack_handler)
+    return better_stack_handler
+
+
+def shutdown_log_shipping():
+    # Flush what is still buffered before the worker exits
+    global better_stack_handler
+    if better_stack_handler is None:
+        return
+    custom_logger.removeHandler(better_stack_handler)
+    better_stack_handler.flush()
+    better_stack_handler.close()
+    better_stack_handler = None
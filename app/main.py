@@ -1,56 +1,62 @@
-from fastapi import Depends, FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, Depends, FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
-from app.logger import custom_logger
-from app.middleware import request_logger_middleware
+import app.database as database
+from app.config import Settings, configure
+from app.logger import custom_logger, init_log_shipping, shutdown_log_shipping
+from app.middleware import AdmissionControlMiddleware, ReadYourWritesMiddleware, request_logger_middleware
+from app.idempotency import IdempotencyMiddleware
+from app.profiling import ProfilingMiddleware
+from app.diagnostics import MemorySamplingMiddleware, start_tracing
+from app.tracing import TracingMiddleware, init_tracing, shutdown_tracing
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.base import BaseHTTPMiddleware
-from app.auth import verify_user_credentials, generate_access_token, password_hasher
+from app.auth import verify_user_credentials, generate_access_token, get_password_hash
 from app.crud import user_service
 import app.schemas as dto
-from app.database import engine, Base, get_database_session
+from app.database import Base, get_database_session
+from app.partitions import create_partitioned_tables
+from app.serialization import SerializedRoute
+from app.background import start_background_jobs, stop_background_jobs
 from app.routers.users import user_router
 from app.routers.comments import comment_routes
 from app.routers.movies import movie_routes
 from app.routers.ratings import rating_routes
+from app.routers.metrics import metrics_routes
+from app.routers.live import live_routes
+from app.routers.diagnostics import diagnostics_routes
+from app.routers.batch import batch_routes
 
-# Initialize database tables
-Base.metadata.create_all(bind=engine)
+auth_routes = APIRouter(route_class=SerializedRoute)
 
-# Initialize FastAPI application
-app = FastAPI()
-
-# Add middleware for request logging
-app.add_middleware(BaseHTTPMiddleware, dispatch=request_logger_middleware)
-custom_logger.info('Starting CheckFlix API...')
 
 # Default route
-@app.get('/')
+@auth_routes.get('/')
 async def home():
     return {'message': 'Welcome to CheckFlix'}
 
-# Register resource routers
-app.include_router(user_router, prefix="/users", tags=["Users"])
-app.include_router(comment_routes, prefix="/movies/comments", tags=["Comments"])
-app.include_router(movie_routes, prefix="/movies", tags=["Movies"])
-app.include_router(rating_routes, prefix="/movies/ratings", tags=["Ratings"])
 
 # User registration endpoint
-@app.post("/register/", status_code=201, response_model=dto.User)
+@auth_routes.post("/register/", status_code=201, response_model=dto.User)
 async def register(new_user: dto.UserCreate, db_session: Session = Depends(get_database_session)):
     existing_user = user_service.get_user_by_email_or_username(db_session, credentials=new_user.username)
-    encrypted_password = password_hasher.hash(new_user.password)
-    
+    # Hashing is deliberately slow, keep it off the event loop
+    encrypted_password = await run_in_threadpool(get_password_hash, new_user.password)
+
     if existing_user:
         custom_logger.warning("User registration attempt for an existing user.")
         raise HTTPException(status_code=400, detail="User is already registered")
-    
+
     return user_service.create_user(db_session=db_session, user=new_user, hashed_password=encrypted_password)
 
 # User login endpoint
-@app.post("/login", status_code=200)
+@auth_routes.post("/login", status_code=200)
 async def login(auth_data: OAuth2PasswordRequestForm = Depends(), db_session: Session = Depends(get_database_session)):
-    authenticated_user = verify_user_credentials(db_session, auth_data.username, auth_data.password)
-    
+    authenticated_user = await run_in_threadpool(
+        verify_user_credentials, db_session, auth_data.username, auth_data.password)
+
     if not authenticated_user:
         custom_logger.warning("Failed login attempt with incorrect credentials.")
         raise HTTPException(
@@ -58,6 +64,80 @@ async def login(auth_data: OAuth2PasswordRequestForm = Depends(), db_session: Se
             detail="Invalid username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    
+
     access_token = generate_access_token(data={"sub": authenticated_user.username})
     return {"access_token": access_token, "token_type": "bearer"}
+
+
+def create_app(settings: Settings | None = None):
+    # Building the application has no side effects, the database engine, its pool,
+    # the log shipper and the background jobs are created when the lifespan starts
+    settings = configure(settings)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        init_log_shipping(settings)
+        init_tracing(settings)
+        if settings.memory_trace_frames > 0:
+            start_tracing(settings.memory_trace_frames)
+        database.init_database(settings)
+
+        # Initialize database tables, ratings and comments first when they are partitioned
+        create_partitioned_tables(database.engine, settings)
+        Base.metadata.create_all(bind=database.engine)
+        custom_logger.info('Starting CheckFlix API...')
+
+        tasks = start_background_jobs(settings) if settings.run_background_jobs else []
+        yield
+        await stop_background_jobs(tasks)
+        database.dispose_database()
+        shutdown_log_shipping()
+        shutdown_tracing()
+
+    # Initialize FastAPI application, JSON is encoded with orjson by default
+    app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+    app.state.settings = settings
+
+    # Profile sampled requests, innermost so the profiler runs in the request's own task
+    if settings.profiling_sample_rate > 0 or settings.profiling_token:
+        app.add_middleware(ProfilingMiddleware, settings=settings)
+
+    # Peak allocation of sampled requests, while tracemalloc is tracing
+    if settings.memory_sample_rate > 0:
+        app.add_middleware(MemorySamplingMiddleware, settings=settings)
+
+    # Write responses carry the marker that keeps the client's next reads on the primary
+    if settings.database_replica_url:
+        app.add_middleware(ReadYourWritesMiddleware, settings=settings)
+
+    # Add middleware for request logging
+    app.add_middleware(BaseHTTPMiddleware, dispatch=request_logger_middleware)
+
+    # Shed load per route class before any other work is done for the request
+    if settings.admission_control_enabled:
+        app.add_middleware(AdmissionControlMiddleware, settings=settings)
+
+    # Replays and duplicates waiting for their original don't take an admission slot
+    if settings.idempotency_enabled:
+        app.add_middleware(IdempotencyMiddleware, settings=settings)
+
+    # Outermost, so a request's span includes its wait for admission
+    if settings.tracing_exporter:
+        app.add_middleware(TracingMiddleware)
+
+    # Register resource routers
+    app.include_router(auth_routes)
+    app.include_router(user_router, prefix="/users", tags=["Users"])
+    app.include_router(comment_routes, prefix="/movies/comments", tags=["Comments"])
+    app.include_router(movie_routes, prefix="/movies", tags=["Movies"])
+    app.include_router(live_routes, prefix="/movies", tags=["Live"])
+    app.include_router(rating_routes, prefix="/movies/ratings", tags=["Ratings"])
+    app.include_router(metrics_routes, prefix="/metrics", tags=["Metrics"])
+    app.include_router(batch_routes, tags=["Batch"])
+    if settings.diagnostics_token:
+        app.include_router(diagnostics_routes, prefix="/diagnostics", tags=["Diagnostics"])
+
+    return app
+
+
+app = create_app()
@@ -0,0 +1,63 @@
+import threading
+
+# In-process metrics, rendered in the Prometheus text exposition format by /metrics
+
+
+class Metric:
+
+    def __init__(self, name: str, help: str, type: str):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            if labels:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"{self.name}{{{label_text}}} {value}")
+            else:
+                lines.append(f"{self.name} {value}")
+        return "\n".join(lines)
+
+
+registry = {}
+
+
+def register(name: str, help: str, type: str):
+    # Registering the same name twice returns the existing metric
+    if name not in registry:
+        registry[name] = Metric(name, help, type)
+    return registry[name]
+
+
+def counter(name: str, help: str):
+    return register(name, help, "counter")
+
+
+def gauge(name: str, help: str):
+    return register(name, help, "gauge")
+
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in registry.values()) + "\n"
@@ -1,5 +1,13 @@
+import asyncio
+import math
 from fastapi import Request
+from fastapi.responses import JSONResponse
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+from app.config import Settings
+from app.database import LAST_WRITE_COOKIE, LAST_WRITE_HEADER, READ_ONLY_PATHS, SAFE_METHODS, request_method, write_marker
 from app.logger import custom_logger
+from app.metrics import counter, gauge
 import time
 
 
@@ -17,4 +25,133 @@ async def request_logger_middleware(request: Request, call_next):
         'status_code': response.status_code
     }
     custom_logger.info(log_dict, extra=log_dict)
-    return response
\ No newline at end of file
+    return response
+
+
+# Read-your-writes: a write response carries the write marker, the client sends it back and
+# its reads go to the primary for READ_YOUR_WRITES_SECONDS, on any worker
+class ReadYourWritesMiddleware:
+
+    def __init__(self, app, settings: Settings):
+        self.app = app
+        self.max_age = math.ceil(settings.read_your_writes_seconds)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or request_method(HTTPConnection(scope)) in SAFE_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_marker(message):
+            if message["type"] == "http.response.start":
+                marker = write_marker()
+                headers = MutableHeaders(scope=message)
+                headers.append(LAST_WRITE_HEADER, marker)
+                headers.append("set-cookie", f"{LAST_WRITE_COOKIE}={marker}; Max-Age={self.max_age}; Path=/; HttpOnly; SameSite=Lax")
+            await send(message)
+
+        await self.app(scope, receive, send_with_marker)
+
+
+# Admission control: each route class gets its own concurrency budget and queue,
+# requests that wait longer than the class allows are shed with a fast 503
+admission_in_flight = gauge("checkflix_admission_in_flight", "Requests currently being processed per route class")
+admission_queue_depth = gauge("checkflix_admission_queue_depth", "Requests waiting for a slot per route class")
+admission_admitted = counter("checkflix_admission_admitted_total", "Requests admitted per route class")
+admission_shed = counter("checkflix_admission_shed_total", "Requests shed with a 503 per route class")
+
+AUTH_PATHS = ("/login", "/register")
+
+# Paths that must keep answering under load
+EXEMPT_PATHS = ("/metrics", "/diagnostics")
+
+# Long-lived streams would hold a slot for their whole life
+STREAMING_SUFFIXES = ("/live",)
+
+OVERLOADED = "Service is overloaded, retry later"
+
+# Set on the scope of admitted requests, /batch charges its sub-requests to the same queue
+ADMISSION_SCOPE_KEY = "checkflix.admission"
+
+
+class AdmissionQueue:
+
+    def __init__(self, route_class: str, concurrency: int, max_wait: float):
+        self.route_class = route_class
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_wait = max_wait
+        self.waiting = 0
+
+    async def acquire(self):
+        if not self.semaphore.locked():
+            await self.semaphore.acquire()
+            return True
+        if self.max_wait <= 0:
+            return False
+
+        self.waiting += 1
+        admission_queue_depth.set(self.waiting, route_class=self.route_class)
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.max_wait)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+            admission_queue_depth.set(self.waiting, route_class=self.route_class)
+
+    def release(self):
+        self.semaphore.release()
+
+    async def admit(self):
+        if not await self.acquire():
+            admission_shed.inc(route_class=self.route_class)
+            return False
+        admission_admitted.inc(route_class=self.route_class)
+        admission_in_flight.inc(route_class=self.route_class)
+        return True
+
+    def leave(self):
+        admission_in_flight.dec(route_class=self.route_class)
+        self.release()
+
+
+def classify_route(method: str, path: str):
+    if path.startswith(AUTH_PATHS):
+        return "auth"
+    if method not in SAFE_METHODS and path not in READ_ONLY_PATHS:
+        return "write"
+    return "read"
+
+
+class AdmissionControlMiddleware:
+
+    def __init__(self, app, settings: Settings):
+        self.app = app
+        self.retry_after = settings.admission_retry_after_seconds
+        self.queues = {
+            "auth": AdmissionQueue("auth", settings.admission_auth_concurrency, settings.admission_auth_max_wait_seconds),
+            "write": AdmissionQueue("write", settings.admission_write_concurrency, settings.admission_write_max_wait_seconds),
+            "read": AdmissionQueue("read", settings.admission_read_concurrency, settings.admission_read_max_wait_seconds),
+        }
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path.startswith(EXEMPT_PATHS) or path.endswith(STREAMING_SUFFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        queue = self.queues[classify_route(scope["method"], scope["path"])]
+        if not await queue.admit():
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": OVERLOADED},
+                headers={"Retry-After": str(self.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        scope[ADMISSION_SCOPE_KEY] = queue
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            queue.leave()
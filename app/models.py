@@ -1,4 +1,4 @@
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, text
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, LargeBinary, String, text
 from sqlalchemy.orm import relationship
 
 from app.database import Base
@@ -30,13 +30,46 @@ class Movie(Base):
     genre = Column(String, nullable=False)
     description = Column(String)
     release_year = Column(Integer)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     created_at = Column(DateTime(timezone=True), nullable=False,
                         server_default=text('CURRENT_TIMESTAMP'))
 # Relationships
     owner = relationship("User", back_populates="movies")
     ratings = relationship("Rating", back_populates="movie")
     comments = relationship("Comment", back_populates="movie")
+    genres = relationship("Genre", secondary="movie_genres", back_populates="movies")
+
+    # Discovery filters by release year, genres are filtered through movie_genres
+    __table_args__ = (
+        Index("ix_movies_release_year", "release_year"),
+    )
+
+
+class Genre(Base):
+    __tablename__ = "genres"
+
+    id = Column(Integer, primary_key=True, index=True,
+                autoincrement=True, nullable=False)
+    # Display name as first listed, the key is its case-insensitive form
+    name = Column(String, nullable=False)
+    key = Column(String, nullable=False, unique=True, index=True)
+    movie_count = Column(Integer, nullable=False, default=0)
+# Relationships
+    movies = relationship("Movie", secondary="movie_genres", back_populates="genres")
+
+
+class MovieGenre(Base):
+    __tablename__ = "movie_genres"
+
+    movie_id = Column(Integer, ForeignKey("movies.id", ondelete="CASCADE"),
+                      primary_key=True, nullable=False)
+    genre_id = Column(Integer, ForeignKey("genres.id", ondelete="CASCADE"),
+                      primary_key=True, nullable=False)
+
+    # Genre pages join from the genre to its movies
+    __table_args__ = (
+        Index("ix_movie_genres_genre_movie", "genre_id", "movie_id"),
+    )
 
 
 class Rating(Base):
@@ -44,11 +77,11 @@ class Rating(Base):
 
     id = Column(Integer, primary_key=True, index=True,
                 autoincrement=True, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    movie_id = Column(Integer, ForeignKey("movies.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    movie_id = Column(Integer, ForeignKey("movies.id"), index=True)
     rating_value = Column(Integer)
     created_at = Column(DateTime(timezone=True), nullable=False,
-                        server_default=text('CURRENT_TIMESTAMP'))
+                        server_default=text('CURRENT_TIMESTAMP'), index=True)
 # Relationships
     user = relationship('User', back_populates='ratings')
     movie = relationship('Movie', back_populates='ratings')
@@ -59,13 +92,123 @@ class Comment(Base):
 
     id = Column(Integer, primary_key=True, nullable=False,
                 autoincrement=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    movie_id = Column(Integer, ForeignKey("movies.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    movie_id = Column(Integer, ForeignKey("movies.id"), index=True)
     comment = Column(String)
-    parent_id = Column(Integer, ForeignKey("comments.id"), nullable=True)
+    parent_id = Column(Integer, ForeignKey("comments.id"), nullable=True, index=True)
     created_at = Column(DateTime(timezone=True), nullable=False,
                         server_default=text('CURRENT_TIMESTAMP'))
 # Relationships
     author = relationship('User', back_populates='comments')
     movie = relationship('Movie', back_populates='comments')
-    replies = relationship('Comment', backref='parent', remote_side=[id])
\ No newline at end of file
+    replies = relationship('Comment', backref='parent', remote_side=[id])
+
+
+class MovieRanking(Base):
+    __tablename__ = "movie_rankings"
+
+    movie_id = Column(Integer, ForeignKey("movies.id", ondelete="CASCADE"),
+                      primary_key=True, nullable=False)
+    rating_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    avg_rating = Column(Float, nullable=False, default=0.0)
+    weighted_rating = Column(Float, nullable=False, default=0.0)
+    trending_score = Column(Float, nullable=False, default=0.0)
+    dirty = Column(Boolean, nullable=False, default=True, index=True)
+    updated_at = Column(DateTime(timezone=True), nullable=False,
+                        server_default=text('CURRENT_TIMESTAMP'))
+# Relationships
+    movie = relationship("Movie")
+
+    # Leaderboard pages are read straight off these indexes
+    __table_args__ = (
+        Index("ix_movie_rankings_weighted", "weighted_rating", "movie_id"),
+        Index("ix_movie_rankings_trending", "trending_score", "movie_id"),
+        Index("ix_movie_rankings_avg", "avg_rating", "movie_id"),
+    )
+
+
+class CacheInvalidation(Base):
+    __tablename__ = "cache_invalidations"
+
+    id = Column(Integer, primary_key=True, index=True,
+                autoincrement=True, nullable=False)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    movie_id = Column(Integer, nullable=True)
+    origin = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False,
+                        server_default=text('CURRENT_TIMESTAMP'), index=True)
+
+
+class SimilarityChange(Base):
+    __tablename__ = "similarity_changes"
+
+    # A movie whose ratings changed since an index was built, read from the index's last_change_id
+    id = Column(Integer, primary_key=True, index=True,
+                autoincrement=True, nullable=False)
+    movie_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False,
+                        server_default=text('CURRENT_TIMESTAMP'))
+
+    # Ids must keep growing once the rows below an index's last_change_id are purged
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+class ActivityCount(Base):
+    __tablename__ = "activity_counts"
+
+    # e.g. ("movie", 1, "ratings"): the number of ratings of movie 1
+    scope = Column(String, primary_key=True, nullable=False)
+    scope_id = Column(Integer, primary_key=True, nullable=False)
+    counted = Column(String, primary_key=True, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class OutboxEvent(Base):
+    __tablename__ = "outbox_events"
+
+    # Written in the transaction of the change, deleted once a projection applied it
+    id = Column(Integer, primary_key=True, index=True,
+                autoincrement=True, nullable=False)
+    event_type = Column(String, nullable=False)
+    movie_id = Column(Integer, nullable=True, index=True)
+    payload = Column(String, nullable=False, default="{}")
+    created_at = Column(DateTime(timezone=True), nullable=False,
+                        server_default=text('CURRENT_TIMESTAMP'))
+
+
+class MovieCard(Base):
+    __tablename__ = "movie_cards"
+
+    # Read model of a movie with its owner and activity, maintained from outbox_events
+    movie_id = Column(Integer, primary_key=True, nullable=False)
+    title = Column(String, nullable=False)
+    genre = Column(String, nullable=False)
+    description = Column(String)
+    release_year = Column(Integer)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    owner_id = Column(Integer, nullable=True, index=True)
+    owner_username = Column(String, nullable=True)
+    owner_full_name = Column(String, nullable=True)
+    rating_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    avg_rating = Column(Float, nullable=False, default=0.0)
+    comment_count = Column(Integer, nullable=False, default=0)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    # sha256 of the client, method, path and Idempotency-Key header
+    key = Column(LargeBinary(32), primary_key=True, nullable=False)
+    # sha256 of the request body, a key can't be reused for another request
+    fingerprint = Column(LargeBinary(32), nullable=False)
+    # Null while the first request is running
+    status_code = Column(Integer, nullable=True)
+    content_type = Column(String, nullable=True)
+    # zlib compressed response body
+    body = Column(LargeBinary, nullable=True)
+    # A running request that holds its key past this is taken to have died
+    locked_until = Column(DateTime(timezone=True), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
@@ -0,0 +1,247 @@
+import argparse
+import json
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+import app.models as models
+from app.outbox import on_event, relay
+
+# The movie_cards projection: a movie with its owner, rating count, average rating and
+# comment count in one row, read with a primary key lookup. The write paths emit outbox
+# events (app/outbox.py) and the handlers below apply them, so a card lags its movie by
+# at most one relay interval. rebuild_cards recomputes cards from the source tables and
+# check_cards compares the two.
+
+CARD_FIELDS = (
+    "title", "genre", "description", "release_year", "created_at", "owner_id", "owner_username",
+    "owner_full_name", "rating_count", "rating_sum", "avg_rating", "comment_count",
+)
+
+
+def average(rating_sum: int, rating_count: int):
+    # Rounded like the average_rating endpoint
+    return round(rating_sum / rating_count, 2) if rating_count else 0.0
+
+
+def set_owner(card: models.MovieCard, owner: models.User | None):
+    card.owner_username = owner.username if owner is not None else None
+    card.owner_full_name = owner.full_name if owner is not None else None
+
+
+# Event Handlers
+
+
+def save_movie(db_session: Session, event, payload):
+    movie = db_session.get(models.Movie, event.movie_id)
+    if movie is None:
+        return
+    card = db_session.get(models.MovieCard, movie.id)
+    if card is None:
+        card = models.MovieCard(movie_id=movie.id, rating_count=0, rating_sum=0, avg_rating=0.0, comment_count=0)
+        db_session.add(card)
+    for field in ("title", "genre", "description", "release_year", "created_at"):
+        setattr(card, field, getattr(movie, field))
+    card.owner_id = movie.user_id
+    set_owner(card, db_session.get(models.User, movie.user_id) if movie.user_id is not None else None)
+    # Later events of the batch find the new card
+    db_session.flush()
+
+
+def delete_movie(db_session: Session, event, payload):
+    # Through the session, earlier events of the batch may have changed the card
+    card = db_session.get(models.MovieCard, event.movie_id)
+    if card is not None:
+        db_session.delete(card)
+        db_session.flush()
+
+
+def change_activity(db_session: Session, movie_id: int, ratings: int = 0, rating_sum: int = 0, comments: int = 0):
+    # A card that doesn't exist yet is made by rebuild_cards, which counts from the source
+    card = db_session.get(models.MovieCard, movie_id)
+    if card is None:
+        return
+    card.rating_count += ratings
+    card.rating_sum += rating_sum
+    card.avg_rating = average(card.rating_sum, card.rating_count)
+    card.comment_count += comments
+
+
+def save_owner(db_session: Session, event, payload):
+    owner = db_session.get(models.User, payload["user_id"])
+    for card in db_session.query(models.MovieCard).filter(models.MovieCard.owner_id == payload["user_id"]).all():
+        set_owner(card, owner)
+        if owner is None:
+            # Deleting the user set the user_id of its movies to NULL
+            card.owner_id = None
+
+
+on_event("movie_saved", save_movie)
+on_event("movie_deleted", delete_movie)
+on_event("rating_added", lambda db, event, payload: change_activity(db, event.movie_id, 1, payload["value"]))
+on_event("rating_changed", lambda db, event, payload: change_activity(db, event.movie_id, 0, payload["value"] - payload["previous"]))
+on_event("rating_removed", lambda db, event, payload: change_activity(db, event.movie_id, -1, -payload["value"]))
+on_event("comment_added", lambda db, event, payload: change_activity(db, event.movie_id, comments=1))
+on_event("comment_removed", lambda db, event, payload: change_activity(db, event.movie_id, comments=-1))
+on_event("user_saved", save_owner)
+on_event("user_deleted", save_owner)
+
+
+# Rebuild and Consistency Check
+
+
+def movie_id_chunks(db_session: Session, chunk_size: int):
+    last_id = 0
+    while True:
+        ids = db_session.query(models.Movie.id).filter(models.Movie.id > last_id).order_by(models.Movie.id).limit(chunk_size).all()
+        if not ids:
+            return
+        ids = [movie_id for movie_id, in ids]
+        yield ids
+        last_id = ids[-1]
+
+
+def compute_cards(db_session: Session, movie_ids: list[int]):
+    # The cards of these movies as the source tables say they should be
+    ratings = dict(
+        (movie_id, (count, total)) for movie_id, count, total in
+        db_session.query(models.Rating.movie_id, func.count(models.Rating.id), func.sum(models.Rating.rating_value))
+        .filter(models.Rating.movie_id.in_(movie_ids)).group_by(models.Rating.movie_id)
+    )
+    comments = dict(
+        db_session.query(models.Comment.movie_id, func.count(models.Comment.id))
+        .filter(models.Comment.movie_id.in_(movie_ids)).group_by(models.Comment.movie_id)
+    )
+    rows = (
+        db_session.query(models.Movie, models.User.username, models.User.full_name)
+        .outerjoin(models.User, models.User.id == models.Movie.user_id)
+        .filter(models.Movie.id.in_(movie_ids))
+    )
+    cards = {}
+    for movie, username, full_name in rows:
+        rating_count, rating_sum = ratings.get(movie.id, (0, 0))
+        cards[movie.id] = {
+            "movie_id": movie.id,
+            "title": movie.title,
+            "genre": movie.genre,
+            "description": movie.description,
+            "release_year": movie.release_year,
+            "created_at": movie.created_at,
+            "owner_id": movie.user_id,
+            "owner_username": username,
+            "owner_full_name": full_name,
+            "rating_count": rating_count,
+            "rating_sum": rating_sum,
+            "avg_rating": average(rating_sum, rating_count),
+            "comment_count": comments.get(movie.id, 0),
+        }
+    return cards
+
+
+def rebuild_cards(db_session: Session, movie_ids: list[int] | None = None, chunk_size: int = 1000):
+    # Recomputes all cards, or those of movie_ids, and drops their pending events, which the
+    # recomputed cards already reflect. Runs in a transaction of its own. The deletes come first:
+    # on SQLite they take the write lock before anything is read, on PostgreSQL the reads share
+    # their repeatable read snapshot.
+    if db_session.get_bind().dialect.name == "postgresql":
+        db_session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    events = db_session.query(models.OutboxEvent)
+    cards = db_session.query(models.MovieCard)
+    if movie_ids is not None:
+        events = events.filter(models.OutboxEvent.movie_id.in_(movie_ids))
+        cards = cards.filter(models.MovieCard.movie_id.in_(movie_ids))
+    events.delete(synchronize_session=False)
+    cards.delete(synchronize_session=False)
+
+    rebuilt = 0
+    chunks = movie_id_chunks(db_session, chunk_size) if movie_ids is None else [movie_ids]
+    for chunk in chunks:
+        computed = list(compute_cards(db_session, chunk).values())
+        if computed:
+            db_session.execute(insert(models.MovieCard), computed)
+        rebuilt += len(computed)
+    db_session.commit()
+    return rebuilt
+
+
+def check_cards(db_session: Session, chunk_size: int = 1000):
+    # Compares every card with its source. Movies with events still waiting for the relay
+    # are skipped, their cards are behind rather than wrong.
+    pending_movies = {movie_id for movie_id, in db_session.query(models.OutboxEvent.movie_id).distinct()}
+    pending_owners = {
+        json.loads(payload)["user_id"] for payload, in
+        db_session.query(models.OutboxEvent.payload).filter(models.OutboxEvent.event_type.in_(["user_saved", "user_deleted"]))
+    }
+    report = {"checked": 0, "skipped": 0, "missing": [], "orphaned": [], "mismatched": []}
+    for chunk in movie_id_chunks(db_session, chunk_size):
+        expected = compute_cards(db_session, chunk)
+        cards = {card.movie_id: card for card in db_session.query(models.MovieCard).filter(models.MovieCard.movie_id.in_(chunk))}
+        for movie_id, source in expected.items():
+            if movie_id in pending_movies or source["owner_id"] in pending_owners:
+                report["skipped"] += 1
+                continue
+            report["checked"] += 1
+            card = cards.get(movie_id)
+            if card is None:
+                report["missing"].append(movie_id)
+                continue
+            fields = {
+                field: [getattr(card, field), source[field]]
+                for field in CARD_FIELDS if getattr(card, field) != source[field]
+            }
+            if fields:
+                report["mismatched"].append({"movie_id": movie_id, "fields": fields})
+
+    orphaned = (
+        db_session.query(models.MovieCard.movie_id)
+        .outerjoin(models.Movie, models.Movie.id == models.MovieCard.movie_id)
+        .filter(models.Movie.id.is_(None))
+    )
+    report["orphaned"] = sorted(movie_id for movie_id, in orphaned if movie_id not in pending_movies)
+    return report
+
+
+def repair_cards(db_session: Session, report: dict):
+    # Ends the check's transaction, the rebuild needs one of its own
+    db_session.commit()
+    movie_ids = report["missing"] + [mismatch["movie_id"] for mismatch in report["mismatched"]]
+    rebuilt = rebuild_cards(db_session, movie_ids) if movie_ids else 0
+    if report["orphaned"]:
+        db_session.query(models.MovieCard).filter(
+            models.MovieCard.movie_id.in_(report["orphaned"])).delete(synchronize_session=False)
+        db_session.commit()
+    return rebuilt
+
+
+if __name__ == "__main__":
+    from app.config import get_settings
+    from app.database import Base, SessionLocal, dispose_database, init_database
+
+    parser = argparse.ArgumentParser(description="Maintain the movie_cards projection")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild", help="recompute every card from the source tables")
+    check = commands.add_parser("check", help="compare every card with the source tables")
+    check.add_argument("--repair", action="store_true", help="rebuild the cards that differ")
+    commands.add_parser("relay", help="apply the pending outbox events now")
+    args = parser.parse_args()
+
+    engine = init_database(get_settings())
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        if args.command == "rebuild":
+            print(f"Rebuilt {rebuild_cards(db)} cards")
+        elif args.command == "relay":
+            total = 0
+            while applied := relay(db):
+                total += applied
+            print(f"Applied {total} events")
+        else:
+            report = check_cards(db)
+            print(json.dumps(report, default=str, indent=2))
+            if args.repair and (report["missing"] or report["orphaned"] or report["mismatched"]):
+                repair_cards(db, report)
+                print("Repaired")
+            elif report["missing"] or report["orphaned"] or report["mismatched"]:
+                parser.exit(1)
+    finally:
+        db.close()
+        dispose_database()
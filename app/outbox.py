@@ -0,0 +1,69 @@
+import json
+from datetime import datetime, timezone
+from sqlalchemy.orm import Session
+import app.database as database
+import app.models as models
+from app.metrics import counter, gauge
+
+# Transactional outbox. The CRUD write paths emit an event inside their transaction,
+# so the event exists exactly when the change committed. The relay hands the pending
+# events to the handlers registered for their type and deletes them in one transaction,
+# a projection therefore applies each committed change once.
+
+events_relayed = counter("checkflix_outbox_events_relayed_total", "Outbox events applied per event type")
+relay_lag = gauge("checkflix_outbox_lag_seconds", "Age of the newest outbox event applied by the last relay")
+
+# event type -> [handler(db_session, event, payload)]
+handlers = {}
+
+
+def on_event(event_type: str, handler):
+    handlers.setdefault(event_type, []).append(handler)
+    return handler
+
+
+def emit(db_session: Session, event_type: str, movie_id: int | None = None, **payload):
+    # Must be called before the commit, like record_change
+    db_session.add(models.OutboxEvent(event_type=event_type, movie_id=movie_id, payload=json.dumps(payload)))
+
+
+def relay_once(batch_size: int = 500):
+    db = database.SessionLocal()
+    try:
+        return relay(db, batch_size)
+    finally:
+        db.close()
+
+
+def relay(db_session: Session, batch_size: int = 500):
+    # Applies up to batch_size pending events in id order, returns how many
+    events = db_session.query(models.OutboxEvent).order_by(models.OutboxEvent.id).limit(batch_size).all()
+    if not events:
+        return 0
+
+    # Claiming is deleting: a relay in another worker that read the same events deletes
+    # nothing once this transaction commits, and leaves them alone
+    claimed = (
+        db_session.query(models.OutboxEvent)
+        .filter(models.OutboxEvent.id.in_([event.id for event in events]))
+        .delete(synchronize_session=False)
+    )
+    if claimed != len(events):
+        db_session.rollback()
+        return 0
+
+    for event in events:
+        payload = json.loads(event.payload)
+        for handler in handlers.get(event.event_type, []):
+            handler(db_session, event, payload)
+    # The events are gone once committed, read what the metrics need first
+    event_types = [event.event_type for event in events]
+    created_at = events[-1].created_at
+    db_session.commit()
+
+    for event_type in event_types:
+        events_relayed.inc(event_type=event_type)
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    relay_lag.set(round((datetime.now(timezone.utc) - created_at).total_seconds(), 3))
+    return len(events)
@@ -0,0 +1,194 @@
+import argparse
+import re
+from datetime import date, datetime, timezone
+from sqlalchemy import MetaData, PrimaryKeyConstraint, inspect, text
+import app.models as models
+from app.config import Settings, get_settings
+from app.logger import custom_logger
+
+# Optional PostgreSQL partitioning of the append-heavy ratings and comments tables.
+#
+#   PARTITIONING=time   monthly RANGE partitions on created_at, created ahead of time
+#                       by a background job; old months are archived with a detach
+#   PARTITIONING=movie  HASH partitions on movie_id, so the per-movie reads prune
+#                       to a single partition
+#
+# The tables are created partitioned when they don't exist yet, an existing table is
+# left as it is. Postgres requires the partition key in the primary key, so it becomes
+# (id, created_at) or (id, movie_id), and comments.parent_id loses its foreign key
+# (nothing can reference a partitioned table by id alone). SQLite and the default
+# PARTITIONING=none use the plain tables.
+
+PARTITIONED_MODELS = (models.Rating, models.Comment)
+
+PARTITION_KEYS = {"time": "created_at", "movie": "movie_id"}
+
+# Monthly partitions are named <table>_pYYYY_MM
+MONTH_PARTITION = re.compile(r"_p(\d{4})_(\d{2})$")
+
+
+def month_start(day: date):
+    return date(day.year, day.month, 1)
+
+
+def add_months(day: date, months: int):
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def month_partition_name(table_name: str, month: date):
+    return f"{table_name}_p{month:%Y_%m}"
+
+
+def partition_month(partition_name: str):
+    match = MONTH_PARTITION.search(partition_name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def partitioned_table(table, mode: str):
+    # A copy of the model's table with the partition key in its primary key, for the DDL only
+    metadata = MetaData()
+    for referenced in {key.column.table for key in table.foreign_keys if key.column.table is not table}:
+        referenced.to_metadata(metadata)
+    copy = table.to_metadata(metadata)
+    for constraint in list(copy.foreign_key_constraints):
+        if constraint.referred_table is copy:
+            copy.constraints.discard(constraint)
+            for element in constraint.elements:
+                element.parent.foreign_keys.discard(element)
+
+    key = copy.c[PARTITION_KEYS[mode]]
+    key.primary_key = True
+    key.nullable = False
+    copy.append_constraint(PrimaryKeyConstraint(copy.c.id, key))
+    strategy = "RANGE" if mode == "time" else "HASH"
+    copy.dialect_options["postgresql"]["partition_by"] = f"{strategy} ({key.name})"
+    return copy
+
+
+def is_partitioned(connection, table_name: str):
+    return connection.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"),
+        {"table": table_name},
+    ).scalar()
+
+
+def list_partitions(connection, table_name: str):
+    return connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass(:table) ORDER BY child.relname"
+    ), {"table": table_name}).scalars().all()
+
+
+def uses_partitions(engine, settings: Settings):
+    return engine.dialect.name == "postgresql" and settings.partitioning != "none"
+
+
+def create_partitioned_tables(engine, settings: Settings):
+    # Call before Base.metadata.create_all, which then skips the tables created here
+    if not uses_partitions(engine, settings):
+        return []
+    created = []
+    with engine.begin() as connection:
+        for model in PARTITIONED_MODELS:
+            table_name = model.__tablename__
+            if inspect(connection).has_table(table_name):
+                if not is_partitioned(connection, table_name):
+                    custom_logger.warning(f"{table_name} exists without partitions, it is left as it is")
+                continue
+            partitioned_table(model.__table__, settings.partitioning).create(connection)
+            if settings.partitioning == "movie":
+                for remainder in range(settings.partition_hash_modulus):
+                    connection.execute(text(
+                        f"CREATE TABLE {table_name}_h{remainder} PARTITION OF {table_name} "
+                        f"FOR VALUES WITH (MODULUS {settings.partition_hash_modulus}, REMAINDER {remainder})"
+                    ))
+            created.append(table_name)
+        ensure_partitions(connection, settings)
+    return created
+
+
+def ensure_partitions(connection, settings: Settings, start: date | None = None, today: date | None = None):
+    # Monthly partitions from start (default the current month) to partition_months_ahead months ahead
+    if settings.partitioning != "time" or connection.dialect.name != "postgresql":
+        return []
+    today = today or datetime.now(timezone.utc).date()
+    first = month_start(start or today)
+    last = add_months(month_start(today), settings.partition_months_ahead)
+    created = []
+    for model in PARTITIONED_MODELS:
+        table_name = model.__tablename__
+        if not is_partitioned(connection, table_name):
+            continue
+        existing = set(list_partitions(connection, table_name))
+        month = first
+        while month <= last:
+            name = month_partition_name(table_name, month)
+            if name not in existing:
+                connection.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table_name} "
+                    f"FOR VALUES FROM ('{month.isoformat()} 00:00:00+00') TO ('{add_months(month, 1).isoformat()} 00:00:00+00')"
+                ))
+                created.append(name)
+            month = add_months(month, 1)
+    return created
+
+
+def archive_partitions(connection, before: date):
+    # Detach the monthly partitions that end on or before the given day. A detach only
+    # changes the catalog, the rows stay in the detached tables to dump or drop at will.
+    detached = []
+    for model in PARTITIONED_MODELS:
+        table_name = model.__tablename__
+        if connection.dialect.name != "postgresql" or not is_partitioned(connection, table_name):
+            continue
+        for name in list_partitions(connection, table_name):
+            month = partition_month(name)
+            if month is not None and add_months(month, 1) <= before:
+                connection.execute(text(f"ALTER TABLE {table_name} DETACH PARTITION {name}"))
+                detached.append(name)
+    if detached:
+        custom_logger.info(f"Archived partitions {', '.join(detached)}")
+    return detached
+
+
+def maintain_partitions(engine, settings: Settings, today: date | None = None):
+    # Background job: create the coming months, archive the months past retention
+    if not uses_partitions(engine, settings) or settings.partitioning != "time":
+        return [], []
+    today = today or datetime.now(timezone.utc).date()
+    with engine.begin() as connection:
+        created = ensure_partitions(connection, settings, today=today)
+        archived = []
+        if settings.partition_retention_months > 0:
+            archived = archive_partitions(connection, add_months(month_start(today), -settings.partition_retention_months))
+    return created, archived
+
+
+if __name__ == "__main__":
+    from app.database import init_database
+
+    parser = argparse.ArgumentParser(description="Manage the partitions of ratings and comments (PostgreSQL)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="list the partitions")
+    ensure = commands.add_parser("ensure", help="create the monthly partitions up to PARTITION_MONTHS_AHEAD")
+    ensure.add_argument("--from", dest="start", type=date.fromisoformat, help="first month, e.g. for backfills")
+    archive = commands.add_parser("archive", help="detach the monthly partitions that end on or before a day")
+    archive.add_argument("--before", type=date.fromisoformat, required=True)
+    args = parser.parse_args()
+
+    settings = get_settings()
+    engine = init_database(settings)
+    if not uses_partitions(engine, settings):
+        parser.exit(1, "Partitioning needs PostgreSQL and PARTITIONING=time or movie\n")
+    create_partitioned_tables(engine, settings)
+    with engine.begin() as connection:
+        if args.command == "list":
+            for model in PARTITIONED_MODELS:
+                print(model.__tablename__, " ".join(list_partitions(connection, model.__tablename__)))
+        elif args.command == "ensure":
+            print("\n".join(ensure_partitions(connection, settings, start=args.start)) or "Nothing to create")
+        else:
+            print("\n".join(archive_partitions(connection, args.before)) or "Nothing to archive")
+    engine.dispose()
@@ -0,0 +1,111 @@
+import argparse
+import math
+import secrets
+import statistics
+import time
+from passlib.context import CryptContext
+from passlib.hash import argon2
+from app.config import Settings, get_settings
+
+# Password hashing. The scheme and its cost come from the settings. Hashes made with
+# the other scheme or a lower cost still verify and are replaced on the user's next
+# successful login, see app.auth.verify_user_credentials.
+
+SCHEMES = ("bcrypt", "argon2")
+
+# (settings, context) of the settings the context was built from
+password_context = None
+
+
+def build_password_context(settings: Settings):
+    scheme = settings.password_scheme
+    if scheme == "argon2" and not argon2.has_backend():
+        raise RuntimeError("password_scheme=argon2 needs the argon2-cffi package")
+    # The default scheme hashes, the others only verify: deprecated="auto" flags their hashes for an update
+    schemes = [scheme] + [name for name in SCHEMES if name != scheme and (name != "argon2" or argon2.has_backend())]
+    return CryptContext(
+        schemes=schemes,
+        default=scheme,
+        deprecated="auto",
+        bcrypt__rounds=settings.bcrypt_rounds,
+        # Hashes below the configured cost need an update, hashes above it are kept
+        bcrypt__min_rounds=settings.bcrypt_rounds,
+        argon2__type="ID",
+        argon2__rounds=settings.argon2_time_cost,
+        argon2__memory_cost=settings.argon2_memory_kib,
+        argon2__parallelism=settings.argon2_parallelism,
+    )
+
+
+def get_password_context():
+    global password_context
+    settings = get_settings()
+    if password_context is None or password_context[0] is not settings:
+        password_context = (settings, build_password_context(settings))
+    return password_context[1]
+
+
+def time_verify(context: CryptContext, samples: int = 3):
+    # Median seconds a verify takes with the context's default scheme
+    password = secrets.token_urlsafe(16)
+    hashed_password = context.hash(password)
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        context.verify(password, hashed_password)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def calibrate(settings: Settings, target_seconds: float, samples: int = 3):
+    # The highest cost whose verify stays within target_seconds on this machine.
+    # bcrypt doubles its work per round, argon2 grows linearly with time_cost at
+    # the configured memory and parallelism. Returns (settings changes, seconds).
+    def measure(**changes):
+        return time_verify(build_password_context(settings.model_copy(update=changes)), samples)
+
+    if settings.password_scheme == "bcrypt":
+        name, minimum, maximum = "bcrypt_rounds", 4, 31
+        seconds = measure(bcrypt_rounds=minimum)
+        cost = minimum + math.floor(math.log2(max(target_seconds / seconds, 1)))
+    else:
+        name, minimum, maximum = "argon2_time_cost", 1, 100
+        seconds = measure(argon2_time_cost=minimum)
+        cost = math.floor(target_seconds / seconds)
+    cost = min(max(cost, minimum), maximum)
+
+    # The estimate is only a starting point, step down until the measurement agrees
+    seconds = measure(**{name: cost})
+    while seconds > target_seconds and cost > minimum:
+        cost -= 1
+        seconds = measure(**{name: cost})
+    return {name: cost}, seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pick the password hashing cost for a target verify latency")
+    parser.add_argument("--scheme", choices=SCHEMES, help="defaults to PASSWORD_SCHEME")
+    parser.add_argument("--target-ms", type=float, default=250)
+    parser.add_argument("--memory-kib", type=int, help="argon2 memory cost, defaults to ARGON2_MEMORY_KIB")
+    parser.add_argument("--parallelism", type=int, help="argon2 lanes, defaults to ARGON2_PARALLELISM")
+    parser.add_argument("--samples", type=int, default=3)
+    args = parser.parse_args()
+
+    changes = {
+        "password_scheme": args.scheme,
+        "argon2_memory_kib": args.memory_kib,
+        "argon2_parallelism": args.parallelism,
+    }
+    settings = get_settings().model_copy(update={key: value for key, value in changes.items() if value is not None})
+    costs, seconds = calibrate(settings, args.target_ms / 1000, args.samples)
+    settings = settings.model_copy(update=costs)
+
+    # Lines for .env
+    print(f"PASSWORD_SCHEME={settings.password_scheme}")
+    if settings.password_scheme == "bcrypt":
+        print(f"BCRYPT_ROUNDS={settings.bcrypt_rounds}")
+    else:
+        print(f"ARGON2_TIME_COST={settings.argon2_time_cost}")
+        print(f"ARGON2_MEMORY_KIB={settings.argon2_memory_kib}")
+        print(f"ARGON2_PARALLELISM={settings.argon2_parallelism}")
+    print(f"# verify takes {seconds * 1000:.0f} ms on this machine (target {args.target_ms:.0f} ms)")
@@ -0,0 +1,190 @@
+import asyncio
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from starlette.concurrency import run_in_threadpool
+from app.config import Settings
+from app.logger import custom_logger
+from app.metrics import counter
+
+# Sampled request profiling. A request is profiled when it carries the profiling
+# token in X-Profile, or at random at PROFILING_SAMPLE_RATE. While it runs, a sampler
+# thread records the stacks of the threads working for it: the event loop thread
+# when the request's task is the one running, and the threadpool threads running
+# its endpoint. Each profile is written in the folded stack format read by
+# flamegraph.pl and speedscope, one line per distinct stack with its sample count.
+
+PROFILE_HEADER = b"x-profile"
+
+profiles_written = counter("checkflix_profiles_written_total", "Request profiles written per route")
+
+# The profile of the request being handled, threadpool calls inherit it
+active_profile = ContextVar("active_profile", default=None)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}.{code.co_qualname}"
+
+
+def folded_stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class RequestProfile:
+
+    def __init__(self, loop, task):
+        self.loop = loop
+        self.task = task
+        self.loop_thread = threading.get_ident()
+        self.threads = Counter()
+        self.samples = Counter()
+        self.lock = threading.Lock()
+
+    def enter_thread(self):
+        with self.lock:
+            self.threads[threading.get_ident()] += 1
+
+    def exit_thread(self):
+        with self.lock:
+            ident = threading.get_ident()
+            self.threads[ident] -= 1
+            if not self.threads[ident]:
+                del self.threads[ident]
+
+    def sample(self, frames):
+        with self.lock:
+            idents = list(self.threads)
+        # The loop thread works for this request only while its task is the one running
+        if asyncio.current_task(self.loop) is self.task:
+            idents.append(self.loop_thread)
+        stacks = [folded_stack(frames[ident]) for ident in idents if ident in frames]
+        with self.lock:
+            self.samples.update(stacks)
+
+    def folded(self):
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class Sampler:
+    # One daemon thread per worker, it sleeps on an event while nothing is profiled
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.profiles = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self, profile: RequestProfile):
+        with self.lock:
+            self.profiles.add(profile)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="request-profiler", daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def stop(self, profile: RequestProfile):
+        with self.lock:
+            self.profiles.discard(profile)
+            if not self.profiles:
+                self.wake.clear()
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.interval)
+            with self.lock:
+                profiles = list(self.profiles)
+            if not profiles:
+                continue
+            frames = sys._current_frames()
+            for profile in profiles:
+                profile.sample(frames)
+
+
+def call_in_thread(func, *args, **kwargs):
+    # Runs in the threadpool, so the sampler knows this thread works for the profiled request
+    profile = active_profile.get()
+    if profile is None:
+        return func(*args, **kwargs)
+    profile.enter_thread()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.exit_thread()
+
+
+def write_profile(directory: str, name: str, content: str, max_files: int):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name), "w") as profile_file:
+        profile_file.write(content)
+    # Keep the newest max_files profiles
+    entries = sorted(
+        (entry for entry in os.scandir(directory) if entry.name.endswith(".folded")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in entries[:max(len(entries) - max_files, 0)]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+class ProfilingMiddleware:
+    # Added innermost, so the request runs in this middleware's task from here to the endpoint
+
+    def __init__(self, app, settings: Settings):
+        self.app = app
+        self.token = settings.profiling_token
+        self.sample_rate = settings.profiling_sample_rate
+        self.directory = settings.profiling_dir
+        self.max_files = settings.profiling_max_files
+        self.sampler = Sampler(settings.profiling_interval_ms / 1000)
+
+    def should_profile(self, scope):
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    return secrets.compare_digest(value, self.token.encode())
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(asyncio.get_running_loop(), asyncio.current_task())
+        reset = active_profile.set(profile)
+        started = time.perf_counter()
+        self.sampler.start(profile)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.sampler.stop(profile)
+            active_profile.reset(reset)
+            elapsed = time.perf_counter() - started
+            await self.save(scope, profile, elapsed)
+
+    async def save(self, scope, profile: RequestProfile, elapsed: float):
+        if not profile.samples:
+            return
+        route = scope.get("route")
+        template = getattr(route, "path", scope["path"])
+        slug = template.strip("/").replace("/", "_").replace("{", "").replace("}", "") or "root"
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{scope['method']}-{slug}-{elapsed * 1000:.0f}ms-{secrets.token_hex(3)}.folded"
+        try:
+            await run_in_threadpool(write_profile, self.directory, name, profile.folded(), self.max_files)
+            profiles_written.inc(route=template)
+        except OSError:
+            custom_logger.exception("Writing a request profile failed")
@@ -0,0 +1,379 @@
+import argparse
+import fcntl
+import os
+import shutil
+import time
+from contextlib import contextmanager
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+import app.models as models
+from app.config import get_settings
+from app.crud import movie_crud_service
+
+# Rows of the similarity product computed at a time, bounds peak memory
+SIMILARITY_CHUNK_ROWS = 1024
+
+# Movies per query when fetching the ratings of changed movies
+FETCH_CHUNK_MOVIES = 1000
+
+INDEX_ARRAYS = (
+    "movie_ids", "neighbours", "scores", "indptr", "user_ids", "values", "last_rating_id", "last_change_id", "built_at",
+)
+
+
+class SimilarityIndex:
+    # Item-item co-rating similarity index with the top-k neighbours of every movie.
+    # The movie x user rating matrix is kept in CSR form so changed rows can be replaced.
+    # last_rating_id and last_change_id mark the ratings and similarity_changes it includes,
+    # built_at is the time of the full build it was refreshed from.
+
+    def __init__(self, movie_ids, neighbours, scores, indptr, user_ids, values, last_rating_id,
+                 last_change_id=0, built_at=0.0, version=None):
+        self.movie_ids = movie_ids
+        self.neighbours = neighbours
+        self.scores = scores
+        self.indptr = indptr
+        self.user_ids = user_ids
+        self.values = values
+        self.last_rating_id = int(last_rating_id)
+        self.last_change_id = int(last_change_id)
+        self.built_at = float(built_at)
+        # Name of the saved version directory, None until saved or loaded
+        self.version = version
+
+    @classmethod
+    def build(cls, db_session: Session, k: int | None = None):
+        # Changes are read first, one made while the ratings are read is applied again next time
+        last_change_id = fetch_last_change_id(db_session)
+        rows = fetch_ratings(db_session)
+        if not rows:
+            return None
+        rating_ids, user_ids, movie_ids, values = (np.asarray(column) for column in zip(*rows))
+        return cls.from_triplets(movie_ids, user_ids, values, int(rating_ids.max()), k,
+                                 last_change_id=last_change_id, built_at=time.time())
+
+    @classmethod
+    def from_triplets(cls, movie_ids, user_ids, values, last_rating_id: int, k: int | None = None,
+                      previous=None, affected=None, last_change_id: int = 0, built_at: float = 0.0):
+        # SciPy is only needed to build the index, not to serve it
+        from scipy import sparse
+
+        k = k or get_settings().recommendation_neighbours
+        movie_ids = np.asarray(movie_ids, dtype=np.int32)
+        user_ids = np.asarray(user_ids, dtype=np.int32)
+        values = np.asarray(values, dtype=np.float32)
+
+        # Sort by movie so the rows of the CSR matrix line up with unique_movies
+        order = np.lexsort((user_ids, movie_ids))
+        movie_ids, user_ids, values = movie_ids[order], user_ids[order], values[order]
+
+        # A user rates a movie once, the latest rating wins
+        latest = np.ones(len(movie_ids), dtype=bool)
+        latest[:-1] = (movie_ids[1:] != movie_ids[:-1]) | (user_ids[1:] != user_ids[:-1])
+        movie_ids, user_ids, values = movie_ids[latest], user_ids[latest], values[latest]
+
+        unique_movies, movie_rows = np.unique(movie_ids, return_inverse=True)
+        unique_users, user_columns = np.unique(user_ids, return_inverse=True)
+
+        matrix = sparse.csr_matrix(
+            (values, (movie_rows, user_columns)),
+            shape=(len(unique_movies), len(unique_users))
+        )
+        matrix.sum_duplicates()
+
+        neighbours = np.full((len(unique_movies), k), -1, dtype=np.int32)
+        scores = np.zeros((len(unique_movies), k), dtype=np.float32)
+
+        # Reuse the rows of movies whose ratings did not change
+        if previous is not None and affected is not None:
+            positions = np.searchsorted(previous.movie_ids, unique_movies)
+            positions = np.minimum(positions, len(previous.movie_ids) - 1)
+            kept = (previous.movie_ids[positions] == unique_movies) & ~np.isin(unique_movies, affected)
+            width = min(k, previous.neighbours.shape[1])
+            neighbours[kept, :width] = previous.neighbours[positions[kept], :width]
+            scores[kept, :width] = previous.scores[positions[kept], :width]
+            rows_to_compute = np.flatnonzero(~kept)
+        else:
+            rows_to_compute = np.arange(len(unique_movies))
+
+        compute_neighbours(matrix, unique_movies, rows_to_compute, neighbours, scores, k)
+
+        # Store user ids (not column positions) so later merges stay valid
+        return cls(
+            movie_ids=unique_movies,
+            neighbours=neighbours,
+            scores=scores,
+            indptr=matrix.indptr.astype(np.int64),
+            user_ids=unique_users[matrix.indices].astype(np.int32),
+            values=matrix.data.astype(np.float32),
+            last_rating_id=last_rating_id,
+            last_change_id=last_change_id,
+            built_at=built_at,
+        )
+
+    def refresh(self, db_session: Session, k: int | None = None):
+        # The movies whose ratings were added, changed or removed since the index was built get
+        # their rows read again. Neighbours are recomputed for them and for every movie sharing a
+        # rater with one of them, before or after the change: only those similarities can move.
+        changes = (
+            db_session.query(models.SimilarityChange.id, models.SimilarityChange.movie_id)
+            .filter(models.SimilarityChange.id > self.last_change_id)
+            .all()
+        )
+        # Ratings written without a change, by bulk loads
+        new_ratings = (
+            db_session.query(models.Rating.id, models.Rating.movie_id)
+            .filter(models.Rating.id > self.last_rating_id, models.Rating.movie_id.isnot(None))
+            .all()
+        )
+        if not changes and not new_ratings:
+            return self
+        changed = np.unique(np.asarray([movie_id for _, movie_id in changes + new_ratings], dtype=np.int32))
+
+        rows = fetch_ratings(db_session, movie_ids=changed.tolist())
+        if rows:
+            _, user_ids, movie_ids, values = (np.asarray(column) for column in zip(*rows))
+        else:
+            user_ids = movie_ids = values = np.empty(0, dtype=np.int32)
+
+        old_movie_ids = np.repeat(self.movie_ids, np.diff(self.indptr))
+        replaced = np.isin(old_movie_ids, changed)
+        all_movie_ids = np.concatenate([old_movie_ids[~replaced], movie_ids]).astype(np.int32)
+        all_user_ids = np.concatenate([self.user_ids[~replaced], user_ids]).astype(np.int32)
+        if not len(all_movie_ids):
+            return None
+
+        affected = np.union1d(
+            changed,
+            np.union1d(
+                old_movie_ids[np.isin(self.user_ids, self.user_ids[replaced])],
+                all_movie_ids[np.isin(all_user_ids, user_ids)],
+            ),
+        )
+        return SimilarityIndex.from_triplets(
+            all_movie_ids,
+            all_user_ids,
+            np.concatenate([self.values[~replaced], values]),
+            last_rating_id=max([self.last_rating_id] + [rating_id for rating_id, _ in new_ratings]),
+            k=k,
+            previous=self,
+            affected=affected,
+            last_change_id=max([self.last_change_id] + [change_id for change_id, _ in changes]),
+            built_at=self.built_at,
+        )
+
+    def similar(self, movie_id: int, k: int = 10):
+        position = np.searchsorted(self.movie_ids, movie_id)
+        if position >= len(self.movie_ids) or self.movie_ids[position] != movie_id:
+            return []
+        neighbours = self.neighbours[position]
+        scores = self.scores[position]
+        found = neighbours >= 0
+        return list(zip(neighbours[found][:k].tolist(), scores[found][:k].tolist()))
+
+    def recommend(self, rated: dict, k: int = 10):
+        # Score unseen movies by the similarity-weighted ratings of their rated neighbours
+        totals = {}
+        weights = {}
+        for movie_id, rating_value in rated.items():
+            for neighbour, score in self.similar(movie_id, k=self.neighbours.shape[1]):
+                if neighbour in rated:
+                    continue
+                totals[neighbour] = totals.get(neighbour, 0.0) + score * rating_value
+                weights[neighbour] = weights.get(neighbour, 0.0) + score
+        predictions = [(movie_id, totals[movie_id] / weights[movie_id]) for movie_id in totals if weights[movie_id]]
+        predictions.sort(key=lambda item: (-item[1], item[0]))
+        return predictions[:k]
+
+    def save(self, directory: str | None = None):
+        # Write a new version next to the current one, then switch the pointer atomically
+        directory = directory or get_settings().recommendation_index_dir
+        previous = read_version(directory)
+        version = str(time.time_ns())
+        os.makedirs(os.path.join(directory, version))
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(directory, version, f"{name}.npy"), np.asarray(getattr(self, name)))
+
+        pointer = os.path.join(directory, "CURRENT")
+        with open(pointer + ".tmp", "w") as f:
+            f.write(version)
+        os.replace(pointer + ".tmp", pointer)
+        self.version = version
+
+        # Only versions older than the one just replaced go: a worker may still be loading
+        # the previous one, and anything newer is being written
+        if previous is None:
+            return
+        for entry in os.listdir(directory):
+            if entry.isdigit() and int(entry) < int(previous):
+                shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory: str | None = None):
+        # Arrays are memory-mapped, so loading is cheap and pages are shared between workers
+        directory = directory or get_settings().recommendation_index_dir
+        for attempt in range(3):
+            version = read_version(directory)
+            if version is None:
+                return None
+            try:
+                arrays = {
+                    name: np.load(os.path.join(directory, version, f"{name}.npy"), mmap_mode="r")
+                    for name in INDEX_ARRAYS
+                }
+            except FileNotFoundError:
+                # Replaced and removed since the pointer was read, or saved by an older release
+                continue
+            return cls(**arrays, version=version)
+        return None
+
+
+def read_version(directory: str):
+    pointer = os.path.join(directory, "CURRENT")
+    try:
+        with open(pointer) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def build_lock(directory: str):
+    # One worker builds at a time, the others keep serving what it published
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "LOCK"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def fetch_last_change_id(db_session: Session):
+    return db_session.query(func.coalesce(func.max(models.SimilarityChange.id), 0)).scalar()
+
+
+def fetch_ratings(db_session: Session, movie_ids: list[int] | None = None):
+    # In id order, so the latest rating of a user for a movie comes last
+    query = (
+        db_session.query(models.Rating.id, models.Rating.user_id, models.Rating.movie_id, models.Rating.rating_value)
+        .filter(models.Rating.user_id.isnot(None), models.Rating.movie_id.isnot(None))
+    )
+    if movie_ids is None:
+        return query.order_by(models.Rating.id).all()
+    rows = []
+    for start in range(0, len(movie_ids), FETCH_CHUNK_MOVIES):
+        rows += query.filter(models.Rating.movie_id.in_(movie_ids[start:start + FETCH_CHUNK_MOVIES])).all()
+    return sorted(rows, key=lambda row: row[0])
+
+
+def compute_neighbours(matrix, movie_ids, rows, neighbours, scores, k: int):
+    # Cosine similarity between movie rows, computed chunk by chunk
+    from scipy import sparse
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    normalized = sparse.diags(1.0 / norms) @ matrix
+    normalized_t = normalized.T.tocsr()
+
+    for start in range(0, len(rows), SIMILARITY_CHUNK_ROWS):
+        chunk = rows[start:start + SIMILARITY_CHUNK_ROWS]
+        similarities = (normalized[chunk] @ normalized_t).tocsr()
+        for offset, row in enumerate(chunk):
+            begin, end = similarities.indptr[offset], similarities.indptr[offset + 1]
+            columns = similarities.indices[begin:end]
+            values = similarities.data[begin:end]
+
+            # A movie is not its own neighbour
+            mask = columns != row
+            columns, values = columns[mask], values[mask]
+
+            if len(values) > k:
+                top = np.argpartition(-values, k)[:k]
+                columns, values = columns[top], values[top]
+            order = np.lexsort((movie_ids[columns], -values))
+            neighbours[row] = -1
+            scores[row] = 0.0
+            neighbours[row, :len(order)] = movie_ids[columns[order]]
+            scores[row, :len(order)] = values[order]
+
+
+# The index currently served, swapped wholesale on refresh
+similarity_index = None
+
+
+def get_similarity_index():
+    global similarity_index
+    if similarity_index is None:
+        similarity_index = SimilarityIndex.load()
+    return similarity_index
+
+
+def refresh_similarity_index(db_session: Session):
+    # Run by every worker. The one holding the build lock refreshes the published index, or
+    # builds it again every RECOMMENDATION_FULL_BUILD_SECONDS, the others load what it published.
+    global similarity_index
+    settings = get_settings()
+    directory = settings.recommendation_index_dir
+    with build_lock(directory) as building:
+        # Another worker may have published since this one last looked
+        current = published_index(directory)
+        if not building:
+            similarity_index = current
+            return similarity_index
+
+        if current is None or time.time() - current.built_at >= settings.recommendation_full_build_seconds:
+            refreshed = SimilarityIndex.build(db_session)
+        else:
+            refreshed = current.refresh(db_session)
+        if refreshed is not None and refreshed is not current:
+            refreshed.save(directory)
+            # The index includes these changes now
+            db_session.query(models.SimilarityChange).filter(
+                models.SimilarityChange.id <= refreshed.last_change_id).delete(synchronize_session=False)
+            db_session.commit()
+            current = refreshed
+        similarity_index = current
+        return similarity_index
+
+
+def published_index(directory: str):
+    # The index CURRENT points at, the one already loaded if the pointer hasn't moved
+    if similarity_index is not None and similarity_index.version == read_version(directory):
+        return similarity_index
+    return SimilarityIndex.load(directory)
+
+
+def to_scored_movies(db_session: Session, scored):
+    # Hydrate (movie_id, score) pairs with one query, keeping their order
+    scores = dict(scored)
+    movies = movie_crud_service.get_movies_by_ids(db_session, [movie_id for movie_id, _ in scored])
+    return [{"movie": movie, "score": round(scores[movie.id], 4)} for movie in movies]
+
+
+if __name__ == "__main__":
+    from app.database import SessionLocal, init_database
+
+    settings = get_settings()
+    parser = argparse.ArgumentParser(description="Build the item-item similarity index from ratings")
+    parser.add_argument("--neighbours", type=int, default=settings.recommendation_neighbours)
+    parser.add_argument("--output", default=settings.recommendation_index_dir)
+    args = parser.parse_args()
+
+    init_database(settings)
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        index = SimilarityIndex.build(db, k=args.neighbours)
+        if index is None:
+            print("No ratings to index")
+        else:
+            index.save(args.output)
+            print(f"Indexed {len(index.movie_ids)} movies in {time.perf_counter() - started:.2f}s")
+    finally:
+        db.close()
@@ -0,0 +1,129 @@
+import asyncio
+from urllib.parse import unquote
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from starlette.exceptions import HTTPException as StarletteHTTPException
+import app.schemas as schemas
+from app.auth import CURRENT_USER_SCOPE_KEY, get_optional_user
+from app.config import get_settings
+from app.database import LAST_WRITE_HEADER, last_write_time
+from app.logger import custom_logger
+from app.metrics import counter
+from app.middleware import ADMISSION_SCOPE_KEY, OVERLOADED, STREAMING_SUFFIXES
+
+batch_routes = APIRouter()
+
+batch_items = counter("checkflix_batch_items_total", "Sub-requests served by /batch per status code")
+
+# The read routes a sub-request may target. Sub-requests go straight to the router:
+# no middleware, no HTTP round trip.
+BATCH_PREFIXES = ("/movies", "/users")
+
+# Sent back with each item, the rest describe the item's own encoding
+SKIPPED_HEADERS = {b"content-length", b"content-type"}
+
+# The scope keys a sub-request shares with its batch
+SHARED_SCOPE_KEYS = ("asgi", "http_version", "scheme", "server", "client", "root_path", "app")
+
+
+def encode_item(status_code: int, headers, body: bytes, content_type: str):
+    # The item's JSON body is embedded as it is, without decoding it
+    if not body:
+        body = b"null"
+    elif not content_type.startswith("application/json"):
+        body = orjson.dumps(body.decode("utf-8", "replace"))
+    headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in headers if name.lower() not in SKIPPED_HEADERS}
+    batch_items.inc(status_code=status_code)
+    return b'{"status":%d,"headers":%s,"body":%s}' % (status_code, orjson.dumps(headers), body)
+
+
+def error_item(status_code: int, detail, headers=None):
+    headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in (headers or {}).items()]
+    return encode_item(status_code, headers, orjson.dumps({"detail": detail}), "application/json")
+
+
+async def dispatch(router, scope, path: str):
+    response = {"status": 500, "headers": [], "chunks": []}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = message.get("headers", [])
+        elif message["type"] == "http.response.body":
+            response["chunks"].append(message.get("body", b""))
+
+    try:
+        await router(scope, receive, send)
+    except StarletteHTTPException as error:
+        return error_item(error.status_code, error.detail, error.headers)
+    except RequestValidationError as error:
+        return error_item(status.HTTP_422_UNPROCESSABLE_ENTITY, jsonable_encoder(error.errors()))
+    except Exception:
+        custom_logger.exception(f"Batch sub-request {path} failed")
+        return error_item(status.HTTP_500_INTERNAL_SERVER_ERROR, "Internal Server Error")
+
+    content_type = next((value.decode("latin-1") for name, value in response["headers"] if name.lower() == b"content-type"), "")
+    return encode_item(response["status"], response["headers"], b"".join(response["chunks"]), content_type)
+
+
+async def run_sub_request(request: Request, item: schemas.BatchItem, current_user, semaphore: asyncio.Semaphore):
+    path, _, query = item.path.partition("?")
+    batchable = any(path == prefix or path.startswith(prefix + "/") for prefix in BATCH_PREFIXES)
+    if not batchable or path.endswith(STREAMING_SUFFIXES):
+        return error_item(status.HTTP_400_BAD_REQUEST, f"Only GET requests under {' or '.join(BATCH_PREFIXES)} can be batched")
+
+    headers = [(b"accept", b"application/json")]
+    authorization = request.headers.get("authorization")
+    if authorization:
+        headers.append((b"authorization", authorization.encode("latin-1")))
+    # The client's write marker, so a batch right after a write reads from the primary
+    wrote_at = last_write_time(request)
+    if wrote_at is not None:
+        headers.append((LAST_WRITE_HEADER.encode(), repr(wrote_at).encode()))
+    scope = {key: request.scope[key] for key in SHARED_SCOPE_KEYS if key in request.scope}
+    scope.update({
+        "type": "http",
+        "method": item.method,
+        "path": unquote(path),
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "headers": headers,
+        "state": dict(request.scope.get("state", {})),
+    })
+    if current_user is not None:
+        scope[CURRENT_USER_SCOPE_KEY] = current_user
+
+    async with semaphore:
+        # Each sub-request takes a read slot of its own, as if it had been sent on its own
+        admission = request.scope.get(ADMISSION_SCOPE_KEY)
+        if admission is not None and not await admission.admit():
+            retry_after = str(get_settings().admission_retry_after_seconds)
+            return error_item(status.HTTP_503_SERVICE_UNAVAILABLE, OVERLOADED, {"Retry-After": retry_after})
+        try:
+            return await dispatch(request.app.router, scope, item.path)
+        finally:
+            if admission is not None:
+                admission.leave()
+
+
+# Endpoint to run many GET requests under /movies or /users in one round trip. The bearer token, if any,
+# is checked once for the whole batch. Up to batch_concurrency sub-requests are in progress at once,
+# each with its own session and admission slot, as tasks on the batch's event loop: they overlap
+# while they wait on the threadpool, like coalesced reads do, the blocking queries of the others
+# run one after another. The responses come back in the order they were asked for.
+@batch_routes.post("/batch", status_code=200)
+async def run_batch(request: Request, payload: schemas.BatchRequest, current_user=Depends(get_optional_user)):
+    settings = get_settings()
+    if len(payload.requests) > settings.batch_max_requests:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"A batch can have at most {settings.batch_max_requests} requests")
+    semaphore = asyncio.Semaphore(settings.batch_concurrency)
+    # Sub-requests get a detached copy, the user instance belongs to the batch's session
+    user = None if current_user is None else schemas.User.model_validate(current_user)
+    items = await asyncio.gather(*(run_sub_request(request, item, user, semaphore) for item in payload.requests))
+    return Response(b'{"responses":[' + b",".join(items) + b"]}", media_type="application/json")
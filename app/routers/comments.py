@@ -1,17 +1,46 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import List, Literal
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from app.logger import custom_logger
 from app.auth import get_current_user
+import app.models as models
 import app.schemas as schemas
-from app.crud import comment_crud_service, movie_crud_service, user_service
+from app.crud import comment_crud_service, count_crud_service, get_included_users, movie_crud_service, user_service
 from sqlalchemy.orm import Session
 from app.database import get_database_session
+from app.serialization import SerializedRoute, serialize
+from app.routers.params import check_include, set_total_count, sparse_fields
 
-comment_routes = APIRouter()
+comment_routes = APIRouter(route_class=SerializedRoute)
 
 
+# With include=users the comments come as a compound document (schemas.CommentSummaryDocument),
+# count=true adds an estimated X-Total-Count
 @comment_routes.get("/", status_code=200, response_model=List[schemas.CommentResponse])
-async def get_comments(db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
+async def get_comments(request: Request, response: Response, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10,
+                       fields=Depends(sparse_fields(schemas.CommentResponse)), include: Literal["users"] | None = None,
+                       count: bool = False):
+    check_include(include, fields)
+    if count:
+        set_total_count(response, count_crud_service.estimate_table_count(db, models.Comment), estimated=True)
+    if include == "users":
+        rows = comment_crud_service.get_comments(db, offset=offset, limit=limit, with_authors=False)
+        comments = [comment for comment, _ in rows]
+        data = [
+            {
+                "id": comment.id,
+                "user_id": comment.user_id,
+                "movie_id": comment.movie_id,
+                "comment": comment.comment,
+                "parent_id": comment.parent_id,
+                "created_at": comment.created_at,
+                "replies": replies
+            }
+            for comment, replies in rows
+        ]
+        document = {"data": data, "included": {"users": get_included_users(db, comments)}}
+        return serialize(request, schemas.CommentSummaryDocument, document)
+
+    # The reply counts and authors come from one joined query, fields only trims the response
     comments = comment_crud_service.get_comments(
         db,
         offset=offset,
@@ -19,7 +48,7 @@ async def get_comments(db: Session = Depends(get_database_session), offset: int
     )
 
     # Return a response that contains the comment, author and no. of replies
-    response = [
+    results = [
         {
             "id": comment.id,
             "user_id": comment.user_id,
@@ -37,57 +66,77 @@ async def get_comments(db: Session = Depends(get_database_session), offset: int
         for comment, author, replies in comments  # Unpack the query results
     ]
 
-    return response
+    return results
 
 
+# The comment endpoints by id take the comment's movie_id as an optional query parameter,
+# with PARTITIONING=movie it limits the lookup to the movie's partition
 @comment_routes.get("/{comment_id}", status_code=200, response_model=schemas.CommentOut)
-async def get_comment_by_id(comment_id: int, db: Session = Depends(get_database_session)):
-    comment = comment_crud_service.get_comment_by_id(db, comment_id)
+async def get_comment_by_id(comment_id: int, db: Session = Depends(get_database_session), movie_id: int | None = None):
+    comment = comment_crud_service.get_comment_by_id(db, comment_id, movie_id)
     if not comment:
         raise HTTPException(status_code=404, detail="Comment not found")
     return comment
 
 
+# With include=users the comments come as a compound document (schemas.CommentDocument),
+# count=true adds an exact X-Total-Count
 @comment_routes.get("/movie/{movie_id}", status_code=200, response_model=List[schemas.Comment])
-async def get_comments_by_movie(movie_id: int, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
+async def get_comments_by_movie(request: Request, response: Response, movie_id: int, db: Session = Depends(get_database_session),
+                                offset: int = 0, limit: int = 10, fields=Depends(sparse_fields(schemas.Comment)),
+                                include: Literal["users"] | None = None, count: bool = False):
+    check_include(include, fields)
     movie = movie_crud_service.get_movie_by_id(db, movie_id)
     if not movie:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="No Movie Found")
+    if count:
+        set_total_count(response, count_crud_service.get_count(db, "movie", movie_id, "comments"))
     comments = comment_crud_service.get_comments_by_movie(
-        db, movie_id, offset=offset, limit=limit)
+        db, movie_id, offset=offset, limit=limit, fields=fields)
     if not comments:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="No comments for movie")
+    if include == "users":
+        document = {"data": comments, "included": {"users": get_included_users(db, comments)}}
+        return serialize(request, schemas.CommentDocument, document)
     return comments
 
 
+# count=true adds an exact X-Total-Count
 @comment_routes.get("/user/{user_id}", status_code=200, response_model=List[schemas.Comment])
-async def get_comments_by_user(user_id: int, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
+async def get_comments_by_user(response: Response, user_id: int, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10,
+                               fields=Depends(sparse_fields(schemas.Comment)), count: bool = False):
     user = user_service.get_user_by_id(db, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    if count:
+        set_total_count(response, count_crud_service.get_count(db, "user", user_id, "comments"))
     comment = comment_crud_service.get_comments_by_user(
-        db, user_id, offset=offset, limit=limit)
+        db, user_id, offset=offset, limit=limit, fields=fields)
     if not comment:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="No comments for user")
     return comment
 
 
+# count=true adds an exact X-Total-Count
 @comment_routes.get("/replies/{parent_id}", status_code=200, response_model=List[schemas.Comment])
-async def get_replies_to_comment(parent_id: int, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
+async def get_replies_to_comment(response: Response, parent_id: int, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10,
+                                 fields=Depends(sparse_fields(schemas.Comment)), count: bool = False, movie_id: int | None = None):
     # Check if parent comment exists
-    parent_comment = comment_crud_service.get_a_comment(db, parent_id)
+    parent_comment = comment_crud_service.get_a_comment(db, parent_id, movie_id)
     if not parent_comment:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Parent comment not found"
         )
+    if count:
+        set_total_count(response, count_crud_service.get_count(db, "comment", parent_id, "replies"))
 
     # Fetch replies
     replies = comment_crud_service.get_replies_to_comment(
-        db, parent_id, offset=offset, limit=limit
+        db, parent_id, offset=offset, limit=limit, fields=fields, movie_id=parent_comment.movie_id
     )
 
     if not replies:
@@ -113,20 +162,22 @@ async def create_comment(movie_id: int, comment: schemas.CommentCreate, current_
 
 
 @comment_routes.post("/reply_comment/{comment_id}")
-async def reply_comment(comment_id: int, comment_payload: schemas.CommentBase, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_database_session)):
+async def reply_comment(comment_id: int, comment_payload: schemas.CommentBase, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_database_session),
+                        movie_id: int | None = None):
     parent_comment = comment_crud_service.get_a_comment(
-        db, comment_id=comment_id)
+        db, comment_id=comment_id, movie_id=movie_id)
     if not parent_comment:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
     reply = comment_crud_service.reply_comment(
-        comment_id, db, comment=comment_payload, user_id=current_user.id)
+        comment_id, db, comment=comment_payload, user_id=current_user.id, movie_id=movie_id)
     return reply
 
 
 @comment_routes.put("/{comment_id}", status_code=200, response_model=schemas.Comment)
-async def update_comment(comment_payload: schemas.CommentUpdate, comment_id: int, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_database_session)):
-    comment = comment_crud_service.get_a_comment(db, comment_id=comment_id)
+async def update_comment(comment_payload: schemas.CommentUpdate, comment_id: int, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_database_session),
+                         movie_id: int | None = None):
+    comment = comment_crud_service.get_a_comment(db, comment_id=comment_id, movie_id=movie_id)
     if not comment:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
@@ -134,13 +185,14 @@ async def update_comment(comment_payload: schemas.CommentUpdate, comment_id: int
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized")
     update_comment = comment_crud_service.update_comment(
-        db, comment_payload=comment_payload, comment_id=comment_id)
+        db, comment_payload=comment_payload, comment_id=comment_id, movie_id=movie_id)
     return update_comment
 
 
 @comment_routes.delete("/{comment_id}", status_code=200)
-async def delete_comment(comment_id: int, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_database_session)):
-    comment = comment_crud_service.get_a_comment(db, comment_id)
+async def delete_comment(comment_id: int, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_database_session),
+                         movie_id: int | None = None):
+    comment = comment_crud_service.get_a_comment(db, comment_id, movie_id)
     if not comment:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
@@ -148,6 +200,6 @@ async def delete_comment(comment_id: int, current_user: schemas.User = Depends(g
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized")
 
-    comment_crud_service.delete_comment(db, comment_id)
+    comment_crud_service.delete_comment(db, comment_id, movie_id)
 
     return {"message": "Success"}
\ No newline at end of file
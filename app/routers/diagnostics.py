@@ -0,0 +1,78 @@
+import secrets
+from typing import Literal
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+from starlette.concurrency import run_in_threadpool
+import app.diagnostics as diagnostics
+from app.config import get_settings
+
+
+def require_diagnostics_token(x_diagnostics_token: str | None = Header(default=None)):
+    token = get_settings().diagnostics_token
+    if not token or not x_diagnostics_token or not secrets.compare_digest(x_diagnostics_token, token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed")
+
+
+diagnostics_routes = APIRouter(dependencies=[Depends(require_diagnostics_token)])
+
+GroupBy = Literal["lineno", "filename", "traceback"]
+
+
+def snapshot_or_404(snapshot_id: int):
+    try:
+        return diagnostics.get_snapshot(snapshot_id)
+    except KeyError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Snapshot {snapshot_id} not found")
+
+
+# Endpoint to get the worker's memory use, open sessions and snapshots
+@diagnostics_routes.get("/memory", status_code=200)
+async def get_memory():
+    return await run_in_threadpool(diagnostics.process_memory)
+
+
+# Endpoint to start tracing allocations, keeping up to frames frames per traceback
+@diagnostics_routes.post("/memory/tracing", status_code=200)
+async def start_memory_tracing(frames: int = 10):
+    if not 1 <= frames <= 100:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="frames must be between 1 and 100")
+    diagnostics.start_tracing(frames)
+    return await run_in_threadpool(diagnostics.process_memory)
+
+
+# Endpoint to stop tracing allocations and drop the snapshots
+@diagnostics_routes.delete("/memory/tracing", status_code=204)
+async def stop_memory_tracing():
+    diagnostics.stop_tracing()
+
+
+# Endpoint to take a snapshot of the traced allocations
+@diagnostics_routes.post("/memory/snapshots", status_code=201)
+async def take_memory_snapshot():
+    try:
+        snapshot_id = await run_in_threadpool(diagnostics.take_snapshot)
+    except RuntimeError as error:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(error))
+    return diagnostics.snapshot_info(snapshot_id)
+
+
+# Endpoint to get the largest allocation sites of a snapshot
+@diagnostics_routes.get("/memory/snapshots/{snapshot_id}", status_code=200)
+async def get_memory_snapshot(snapshot_id: int, group_by: GroupBy = "lineno", limit: int = 20):
+    snapshot_or_404(snapshot_id)
+    top = await run_in_threadpool(diagnostics.top_allocations, snapshot_id, group_by, limit)
+    return {**diagnostics.snapshot_info(snapshot_id), "top": top}
+
+
+# Endpoint to get the allocation sites that grew the most between two snapshots
+@diagnostics_routes.get("/memory/snapshots/{snapshot_id}/diff/{previous_id}", status_code=200)
+async def diff_memory_snapshots(snapshot_id: int, previous_id: int, group_by: GroupBy = "lineno", limit: int = 20):
+    snapshot_or_404(snapshot_id)
+    snapshot_or_404(previous_id)
+    return await run_in_threadpool(diagnostics.diff_snapshots, previous_id, snapshot_id, group_by, limit)
+
+
+# Endpoint to get the peak allocation of the most recent sampled requests, largest first
+@diagnostics_routes.get("/memory/requests", status_code=200)
+async def get_request_samples(limit: int = 50):
+    samples = sorted(diagnostics.request_samples, key=lambda sample: sample["peak_kib"], reverse=True)
+    return samples[:limit]
@@ -0,0 +1,69 @@
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from app.crud import movie_crud_service
+from app.database import get_database_session
+from app.live import encode_event, movie_feed
+
+live_routes = APIRouter()
+
+# Idle streams send a comment this often so proxies keep the connection open
+KEEPALIVE_SECONDS = 15
+
+
+def ensure_movie_exists(db: Session, movie_id: int):
+    movie = movie_crud_service.get_movie_by_id(db, movie_id)
+    # Streams stay open for a long time, give the connection back to the pool right away
+    db.close()
+    return movie is not None
+
+
+# Endpoint to follow new comments, replies and rating averages of a movie over Server-Sent Events
+@live_routes.get("/{movie_id}/live", status_code=200)
+async def stream_movie_activity(movie_id: int, request: Request, db: Session = Depends(get_database_session)):
+    if not ensure_movie_exists(db, movie_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No Movie Found")
+
+    async def events():
+        # Subscribed once the response is streaming, a response dropped before it starts leaves nothing behind
+        subscription = movie_feed.subscribe(movie_id)
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscription.get(), timeout=KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {encode_event(event)}\n\n"
+        finally:
+            subscription.close()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# Endpoint to follow the same activity over a WebSocket
+@live_routes.websocket("/{movie_id}/live/ws")
+async def movie_activity_socket(movie_id: int, websocket: WebSocket, db: Session = Depends(get_database_session)):
+    if not ensure_movie_exists(db, movie_id):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="No Movie Found")
+        return
+
+    await websocket.accept()
+    subscription = movie_feed.subscribe(movie_id)
+
+    async def forward():
+        while True:
+            event = await subscription.get()
+            await websocket.send_text(encode_event(event))
+
+    forwarder = asyncio.create_task(forward())
+    try:
+        # Messages from the client are ignored, receiving only detects the disconnect
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        forwarder.cancel()
+        subscription.close()
@@ -0,0 +1,11 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from app.metrics import render_metrics
+
+metrics_routes = APIRouter()
+
+
+# Endpoint to scrape the in-process metrics in the Prometheus text format
+@metrics_routes.get("/", status_code=200, response_class=PlainTextResponse)
+async def get_metrics():
+    return render_metrics()
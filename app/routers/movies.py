@@ -1,31 +1,105 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import List, Literal
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from starlette.concurrency import run_in_threadpool
 from app.logger import custom_logger
 from app.auth import get_current_user
 from sqlalchemy.orm import Session
+import app.models as models
 import app.schemas as schemas
-from app.crud import movie_crud_service
+from app.crud import (
+    MOVIE_SORT_KEYS, count_crud_service, genre_crud_service, get_movie_shared, movie_card_crud_service, movie_crud_service,
+    ranking_crud_service,
+)
 from app.database import get_database_session
+from app.serialization import SerializedRoute
+from app.routers.params import movie_filters, parse_ids, parse_sort, set_total_count, sparse_fields
 
-movie_routes = APIRouter()
+movie_routes = APIRouter(route_class=SerializedRoute)
 
 
-# Endpoint to get a list of movies
+# Endpoint to list movies, or get the movies with the given ids (?ids=1,2,3).
+# Filters combine (?genre=Drama,Crime&year_from=1990&min_rating=7&sort=-avg_rating),
+# count=true adds an estimated X-Total-Count
 @movie_routes.get("/", status_code=200, response_model=List[schemas.Movie])
-async def get_movies(db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
-    movies = movie_crud_service.get_movies(
+async def get_movies(response: Response, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10,
+                     ids: str | None = None, fields=Depends(sparse_fields(schemas.Movie)), count: bool = False,
+                     filters: schemas.MovieFilter = Depends(movie_filters), sort: str = "id"):
+    if ids is not None:
+        return movie_crud_service.get_movies_by_ids(db, parse_ids(ids))
+    sort_keys = parse_sort(sort, MOVIE_SORT_KEYS)
+    if count:
+        if filters.model_dump(exclude_none=True):
+            query = movie_crud_service.filter_movies(db, filters)
+            set_total_count(response, count_crud_service.estimate_query_count(db, query), estimated=True)
+        else:
+            set_total_count(response, count_crud_service.estimate_table_count(db, models.Movie), estimated=True)
+    movies = movie_crud_service.search_movies(
         db,
+        filters,
+        sort=sort_keys,
         offset=offset,
-        limit=limit
+        limit=limit,
+        fields=fields
     )
     return movies
 
 
 
+def to_ranked_movies(rows):
+    # Flatten (movie, ranking) rows into a single ranked movie
+    return [
+        {
+            **schemas.Movie.model_validate(movie).model_dump(),
+            "avg_rating": ranking.avg_rating,
+            "rating_count": ranking.rating_count,
+            "weighted_rating": ranking.weighted_rating,
+            "trending_score": ranking.trending_score,
+        }
+        for movie, ranking in rows
+    ]
+
+
+# Endpoint to get the best rated movies
+@movie_routes.get("/top", status_code=200, response_model=List[schemas.RankedMovie])
+async def get_top_movies(db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
+    rows = ranking_crud_service.get_top_movies(db, offset=offset, limit=limit)
+    return to_ranked_movies(rows)
+
+
+# Endpoint to get the movies with the most recent rating activity
+@movie_routes.get("/trending", status_code=200, response_model=List[schemas.RankedMovie])
+async def get_trending_movies(db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
+    rows = ranking_crud_service.get_trending_movies(db, offset=offset, limit=limit)
+    return to_ranked_movies(rows)
+
+
+# Endpoint to browse the genre catalog with the number of movies in each genre
+@movie_routes.get("/genres", status_code=200, response_model=List[schemas.Genre])
+async def get_genres(db: Session = Depends(get_database_session), offset: int = 0, limit: int = 50):
+    return genre_crud_service.get_genres(db, offset=offset, limit=limit)
+
+
+# Endpoint to get the cards of the movies with the given ids (?ids=1,2,3): each movie with
+# its owner, average rating, rating count and comment count, a few seconds behind the writes
+@movie_routes.get("/cards", status_code=200, response_model=List[schemas.MovieCard])
+async def get_movie_cards(ids: str, db: Session = Depends(get_database_session)):
+    return movie_card_crud_service.get_movie_cards(db, parse_ids(ids))
+
+
+# Endpoint to get the card of a movie
+@movie_routes.get("/{movie_id}/card", status_code=200, response_model=schemas.MovieCard)
+async def get_movie_card(movie_id: int, db: Session = Depends(get_database_session)):
+    card = movie_card_crud_service.get_movie_card(db, movie_id)
+    if not card:
+        raise HTTPException(detail="No Movie Found",
+                            status_code=status.HTTP_404_NOT_FOUND)
+    return card
+
+
 # Endpoint to get a movie by its ID
 @movie_routes.get("/{movie_id}", status_code=200, response_model=schemas.Movie)
 async def get_movie_by_id(movie_id: str, db: Session = Depends(get_database_session)):
-    movie = movie_crud_service.get_movie_by_id(db, movie_id)
+    movie = await get_movie_shared(db, movie_id)
     if not movie:
         custom_logger.warning("Getting movie with wrong id....")
         raise HTTPException(detail="No Movie Found",
@@ -33,10 +107,39 @@ async def get_movie_by_id(movie_id: str, db: Session = Depends(get_database_sess
     return movie
 
 
-# Endpoint to get movies by genre
+# Endpoint to get the movies most like a given movie.
+# "ratings" uses co-ratings, "content" uses title, genre and description,
+# "auto" falls back to content for movies without co-ratings.
+@movie_routes.get("/{movie_id}/similar", status_code=200, response_model=List[schemas.ScoredMovie])
+async def get_similar_movies(movie_id: int, db: Session = Depends(get_database_session), limit: int = 10,
+                             source: Literal["auto", "ratings", "content"] = "auto"):
+    # Imported here so numpy isn't loaded with the app
+    from app.content_index import content_index
+    from app.recommendations import get_similarity_index, to_scored_movies
+    movie = movie_crud_service.get_movie_by_id(db, movie_id)
+    if not movie:
+        raise HTTPException(detail="No Movie Found",
+                            status_code=status.HTTP_404_NOT_FOUND)
+    scored = []
+    if source in ("auto", "ratings"):
+        index = get_similarity_index()
+        if index is not None:
+            scored = index.similar(movie_id, k=limit)
+    if source == "content" or (source == "auto" and not scored):
+        # A scan of the whole matrix, kept off the event loop
+        scored = await run_in_threadpool(content_index.similar, movie_id, limit)
+    return to_scored_movies(db, scored)
+
+
+# Endpoint to get movies by genre, matched case-insensitively.
+# count=true adds an exact X-Total-Count from the genre catalog
 @movie_routes.get("/genre/{genre}", status_code=200, response_model=List[schemas.Movie])
-async def get_movie_by_genre(genre: str, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
-    movie = movie_crud_service.get_movie_by_genre(db, genre, offset, limit)
+async def get_movie_by_genre(response: Response, genre: str, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10,
+                             fields=Depends(sparse_fields(schemas.Movie)), count: bool = False):
+    if count:
+        catalog_genre = genre_crud_service.get_genre(db, genre)
+        set_total_count(response, catalog_genre.movie_count if catalog_genre else 0)
+    movie = movie_crud_service.get_movie_by_genre(db, genre, offset, limit, fields=fields)
     if not movie:
         raise HTTPException(detail="No Movie Found",
                             status_code=status.HTTP_404_NOT_FOUND)
@@ -45,8 +148,9 @@ async def get_movie_by_genre(genre: str, db: Session = Depends(get_database_sess
 
 # Endpoint to get movies by title
 @movie_routes.get("/title/{movie_title}", status_code=200, response_model=List[schemas.Movie])
-async def get_movie_by_title(movie_title: str, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
-    movie = movie_crud_service.get_movie_by_title(db, movie_title, offset, limit)
+async def get_movie_by_title(movie_title: str, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10,
+                             fields=Depends(sparse_fields(schemas.Movie))):
+    movie = movie_crud_service.get_movie_by_title(db, movie_title, offset, limit, fields=fields)
     if not movie:
         custom_logger.info("Getting movie with wrong title...")
         raise HTTPException(detail="No Movie Found",
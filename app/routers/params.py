@@ -0,0 +1,77 @@
+from fastapi import HTTPException, Request, Response, status
+import app.schemas as schemas
+from app.serialization import parse_fields
+
+# Most ids a single multi-get request may ask for
+MAX_MULTI_GET_IDS = 100
+
+
+def parse_ids(ids: str):
+    # Parse a comma separated list of ids, keeping the order and dropping duplicates
+    try:
+        parsed = [int(value) for value in ids.split(",") if value.strip()]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="ids must be a comma separated list of integers")
+    if len(parsed) > MAX_MULTI_GET_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"At most {MAX_MULTI_GET_IDS} ids can be requested at once")
+    return list(dict.fromkeys(parsed))
+
+
+def sparse_fields(response_model):
+    # Dependency for the fields= query parameter (?fields=rating_value,user.username).
+    # The parsed fieldset trims the response and is passed on to the query.
+    def dependency(request: Request, fields: str | None = None):
+        if fields is None:
+            return None
+        try:
+            fieldset = parse_fields(fields, response_model)
+        except ValueError as error:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(error))
+        request.state.fields = fieldset
+        return fieldset
+    return dependency
+
+
+def check_include(include: str | None, fields: str | None):
+    # Compound documents have their own row shape, a fieldset can't be applied to it
+    if include is not None and fields is not None:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="fields can't be combined with include")
+
+
+def set_total_count(response: Response, total: int | None, estimated: bool = False):
+    # X-Total-Count for paginated lists, estimates are marked as such
+    if total is None:
+        return
+    response.headers["X-Total-Count"] = str(total)
+    if estimated:
+        response.headers["X-Total-Count-Estimated"] = "true"
+
+
+def parse_sort(sort: str, allowed):
+    # "-release_year,title" sorts by release year descending, then by title
+    keys = []
+    for value in sort.split(","):
+        value = value.strip()
+        if not value:
+            continue
+        descending = value.startswith("-")
+        key = value.lstrip("-")
+        if key not in allowed:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Unknown sort key: {key}, use one of {', '.join(sorted(allowed))}")
+        keys.append((key, descending))
+    return keys
+
+
+def movie_filters(genre: str | None = None, year_from: int | None = None, year_to: int | None = None,
+                  min_rating: float | None = None, owner_id: int | None = None, title: str | None = None):
+    # Dependency for the /movies filters, genre takes a comma separated list (?genre=Drama,Crime)
+    genres = [value.strip() for value in genre.split(",") if value.strip()] if genre else None
+    return schemas.MovieFilter(
+        genres=genres, year_from=year_from, year_to=year_to,
+        min_rating=min_rating, owner_id=owner_id, title=title)
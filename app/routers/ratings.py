@@ -1,62 +1,98 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import List, Literal
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from app.auth import get_current_user
 from app.logger import custom_logger
+import app.models as models
 import app.schemas as schemas
-from app.crud import rating_crud_service, movie_crud_service
+from app.crud import count_crud_service, get_average_rating_shared, get_included_users, rating_crud_service, movie_crud_service
 from sqlalchemy.orm import Session
 import app.schemas as schemas
 from app.database import get_database_session
+from app.serialization import SerializedRoute, serialize
+from app.routers.params import check_include, parse_ids, set_total_count, sparse_fields
 
-rating_routes = APIRouter()
+rating_routes = APIRouter(route_class=SerializedRoute)
 
+# With include=users the ratings come as a compound document (schemas.RatingDocument),
+# count=true adds an estimated X-Total-Count
 @rating_routes.get("/", status_code=200, response_model=List[schemas.Rating])
-async def get_ratings(db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
+async def get_ratings(request: Request, response: Response, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10,
+                      fields=Depends(sparse_fields(schemas.Rating)), include: Literal["users"] | None = None, count: bool = False):
+    check_include(include, fields)
+    if count:
+        set_total_count(response, count_crud_service.estimate_table_count(db, models.Rating), estimated=True)
     ratings = rating_crud_service.get_ratings(
         db,
         offset=offset,
-        limit=limit
+        limit=limit,
+        fields=fields
     )
+    if include == "users":
+        document = {"data": ratings, "included": {"users": get_included_users(db, ratings)}}
+        return serialize(request, schemas.RatingDocument, document)
     return ratings
 
 
+@rating_routes.get("/average_rating", status_code=200)
+async def get_movies_avg_rating(ids: str, db: Session = Depends(get_database_session)):
+    movies = movie_crud_service.get_movies_by_ids(db, parse_ids(ids))
+    avg_ratings = rating_crud_service.aggregate_ratings(db, [movie.id for movie in movies])
+    data = [
+        {
+            "movie_id": movie.id,
+            "movie_title": movie.title,
+            "owner_id": movie.user_id,
+            "avg_rating": avg_ratings[movie.id]
+        }
+        for movie in movies
+    ]
+
+    return {"message": "Success", "data": data}
+
+
+# The ratings endpoints by id take the rating's movie_id as an optional query parameter,
+# with PARTITIONING=movie it limits the lookup to the movie's partition
 @rating_routes.get("/{rating_id}", status_code=200, response_model=schemas.Rating)
-async def get_rating_by_id(rating_id: int, db: Session = Depends(get_database_session)):
+async def get_rating_by_id(rating_id: int, db: Session = Depends(get_database_session), movie_id: int | None = None):
     rating = rating_crud_service.get_rating_by_id(
         db,
-        rating_id=rating_id
+        rating_id=rating_id,
+        movie_id=movie_id
     )
     if not rating:
         raise HTTPException(status_code=404, detail="Rating not found")
     return rating
 
 
+# With include=users the ratings come as a compound document (schemas.RatingDocument),
+# count=true adds an exact X-Total-Count
 @rating_routes.get("/movie_id/{movie_id}", status_code=200, response_model=List[schemas.Rating])
-async def get_ratings_by_movie_id(movie_id: int, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
+async def get_ratings_by_movie_id(request: Request, response: Response, movie_id: int, db: Session = Depends(get_database_session),
+                                  offset: int = 0, limit: int = 10, fields=Depends(sparse_fields(schemas.Rating)),
+                                  include: Literal["users"] | None = None, count: bool = False):
+    check_include(include, fields)
     movie = movie_crud_service.get_movie_by_id(db, movie_id)
     if not movie:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No Movie Found")
+    if count:
+        set_total_count(response, count_crud_service.get_count(db, "movie", movie_id, "ratings"))
     ratings = rating_crud_service.get_ratings_by_movie_id(
         db,
         movie_id=movie_id,
         offset=offset,
-        limit=limit
+        limit=limit,
+        fields=fields
     )
+    if include == "users":
+        document = {"data": ratings, "included": {"users": get_included_users(db, ratings)}}
+        return serialize(request, schemas.RatingDocument, document)
     return ratings
 
 @rating_routes.get("/average_rating/{movie_id}", status_code=200)
 async def get_movie_avg_rating(movie_id: int, db: Session = Depends(get_database_session)):
-    movie = movie_crud_service.get_movie_by_id(db, movie_id)
-    if not movie:
+    data = await get_average_rating_shared(db, movie_id)
+    if data is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No Movie Found")
-    avg_rating = rating_crud_service.aggregate_rating(db, movie_id)
-    data = {
-        "movie_id": movie.id,
-        "movie_title": movie.title,
-        "owner_id": movie.user_id,
-        "avg_rating": avg_rating
-    }
-
     return {"message": "Success", "data": data}
 
 
@@ -85,27 +121,29 @@ async def rate_movie(movie_id: int, rating: schemas.RatingCreate, current_user:
 
 
 @rating_routes.put("/{rating_id}", status_code=200, response_model=schemas.Rating)
-async def update_rating(rating_id: int, payload: schemas.RatingUpdate, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_database_session)):
-    rating = rating_crud_service.get_rating_by_id(db, rating_id)
+async def update_rating(rating_id: int, payload: schemas.RatingUpdate, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_database_session),
+                        movie_id: int | None = None):
+    rating = rating_crud_service.get_rating_by_id(db, rating_id, movie_id)
     if not rating:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Rating not found")
     if rating.user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized")
    
-    update_rating = rating_crud_service.update_rating(db,rating_payload=payload, rating_id=rating_id)
+    update_rating = rating_crud_service.update_rating(db,rating_payload=payload, rating_id=rating_id, movie_id=movie_id)
 
     return update_rating
 
 
 @rating_routes.delete("/{rating_id}", status_code=200)
-async def delete_rating(rating_id: int, db: Session = Depends(get_database_session), current_user: schemas.User = Depends(get_current_user)):
-    rating = rating_crud_service.get_rating_by_id(db, rating_id=rating_id)
+async def delete_rating(rating_id: int, db: Session = Depends(get_database_session), current_user: schemas.User = Depends(get_current_user),
+                        movie_id: int | None = None):
+    rating = rating_crud_service.get_rating_by_id(db, rating_id=rating_id, movie_id=movie_id)
     if not rating:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Rating not found")
     if rating.user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized")
 
-    rating_crud_service.delete_rating(db, rating_id=rating_id)
+    rating_crud_service.delete_rating(db, rating_id=rating_id, movie_id=movie_id)
     return {"message": "Success"}
\ No newline at end of file
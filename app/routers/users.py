@@ -1,22 +1,32 @@
 from typing import List
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Response, status
 from app.auth import get_current_user
 from app.logger import custom_logger
+import app.models as models
 import app.schemas as schemas
-from app.crud import user_service
+from app.crud import count_crud_service, rating_crud_service, user_service
 from sqlalchemy.orm import Session
 import app.schemas as schemas
 from app.database import get_database_session
+from app.serialization import SerializedRoute
+from app.routers.params import parse_ids, set_total_count, sparse_fields
 
-user_router = APIRouter()
+user_router = APIRouter(route_class=SerializedRoute)
 
-# Endpoint to get a list of users
+# Endpoint to get a list of users, or the users with the given ids (?ids=1,2,3)
+# count=true adds an estimated X-Total-Count
 @user_router.get("/", status_code=200, response_model=List[schemas.User])
-async def get_users(db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10):
+async def get_users(response: Response, db: Session = Depends(get_database_session), offset: int = 0, limit: int = 10,
+                    ids: str | None = None, fields=Depends(sparse_fields(schemas.User)), count: bool = False):
+    if ids is not None:
+        return user_service.get_users_by_ids(db, parse_ids(ids))
+    if count:
+        set_total_count(response, count_crud_service.estimate_table_count(db, models.User), estimated=True)
     users = user_service.get_users(
         db,
         offset=offset,
-        limit=limit
+        limit=limit,
+        fields=fields
     )
     return users
 
@@ -29,6 +39,22 @@ async def get_user_by_id(user_id: str, db: Session = Depends(get_database_sessio
             status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     return user
 
+# Endpoint to get movie recommendations from a user's ratings, only for that user
+@user_router.get("/{user_id}/recommendations", status_code=200, response_model=List[schemas.ScoredMovie])
+async def get_user_recommendations(user_id: int, current_user: schemas.User = Depends(get_current_user),
+                                   db: Session = Depends(get_database_session), limit: int = 10):
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed")
+    # Imported here so numpy isn't loaded with the app
+    from app.recommendations import get_similarity_index, to_scored_movies
+    index = get_similarity_index()
+    if index is None:
+        return []
+    ratings = rating_crud_service.get_all_ratings_by_user(db, user_id)
+    rated = {rating.movie_id: rating.rating_value for rating in ratings}
+    return to_scored_movies(db, index.recommend(rated, k=limit))
+
 # Endpoint to get a single user by username
 @user_router.get("/name/{username}", status_code=200, response_model=schemas.User)
 async def get_user_by_username(username: str, db: Session = Depends(get_database_session)):
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Dict, List, Literal, Optional
 from datetime import datetime
 from pydantic import BaseModel, EmailStr, Field
 
@@ -54,6 +54,56 @@ class Movie(MovieBase):
         from_attributes = True
 
 
+class Genre(BaseModel):
+    id: int
+    name: str
+    movie_count: int
+
+    class Config:
+        from_attributes = True
+
+
+class MovieFilter(BaseModel):
+    # Filters of the /movies listing, every one that is set must match
+    genres: Optional[List[str]] = None
+    year_from: Optional[int] = None
+    year_to: Optional[int] = None
+    min_rating: Optional[float] = None
+    owner_id: Optional[int] = None
+    title: Optional[str] = None
+
+
+class RankedMovie(Movie):
+    avg_rating: float
+    rating_count: int
+    weighted_rating: float
+    trending_score: float
+
+
+class MovieCard(BaseModel):
+    # Everything a movie card shows, from the movie_cards projection
+    movie_id: int
+    title: str
+    genre: str
+    description: Optional[str] = None
+    release_year: Optional[int] = None
+    created_at: datetime
+    owner_id: Optional[int] = None
+    owner_username: Optional[str] = None
+    owner_full_name: Optional[str] = None
+    avg_rating: float
+    rating_count: int
+    comment_count: int
+
+    class Config:
+        from_attributes = True
+
+
+class ScoredMovie(BaseModel):
+    movie: Movie
+    score: float
+
+
 class RatingBase(BaseModel):
     rating_value: int = Field(ge=1, le=10)
 
@@ -66,17 +116,20 @@ class RatingUpdate(RatingBase):
     pass
 
 
-class Rating(RatingBase):
+class RatingRow(RatingBase):
     id: int
     user_id: int
     movie_id: int
     created_at: datetime
-    user: User
 
     class Config:
         from_attributes = True
 
 
+class Rating(RatingRow):
+    user: User
+
+
 class CommentBase(BaseModel):
     comment: str
 
@@ -89,18 +142,25 @@ class CommentUpdate(BaseModel):
     comment: Optional[str] = None
 
 
-class Comment(CommentBase):
+class CommentRow(CommentBase):
     id: int
     user_id: int
     movie_id: int
     created_at: datetime
     parent_id: Optional[int]
-    author: User
 
     class Config:
         from_attributes = True
 
 
+class Comment(CommentRow):
+    author: User
+
+
+class CommentSummaryRow(CommentRow):
+    replies: int
+
+
 class AuthorResponse(BaseModel):
     id: int
     username: str
@@ -126,4 +186,35 @@ class CommentResponse(BaseModel):
 
 class CommentOut(BaseModel):
     Comment: Comment
-    replies: int
\ No newline at end of file
+    replies: int
+
+
+# Compound documents: rows reference their user by user_id and each
+# distinct user is sent once in included.users (?include=users)
+class IncludedUsers(BaseModel):
+    users: Dict[int, User]
+
+
+class RatingDocument(BaseModel):
+    data: List[RatingRow]
+    included: IncludedUsers
+
+
+class CommentDocument(BaseModel):
+    data: List[CommentRow]
+    included: IncludedUsers
+
+
+class CommentSummaryDocument(BaseModel):
+    data: List[CommentSummaryRow]
+    included: IncludedUsers
+
+
+class BatchItem(BaseModel):
+    # A GET under /movies or /users, with its query string, e.g. "/movies/ratings/movie_id/1?limit=5"
+    method: Literal["GET"] = "GET"
+    path: str
+
+
+class BatchRequest(BaseModel):
+    requests: List[BatchItem] = Field(min_length=1)
@@ -0,0 +1,253 @@
+import asyncio
+import inspect
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from functools import lru_cache, wraps
+from typing import List, Optional, Union, get_args, get_origin
+import msgpack
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, ConfigDict, TypeAdapter, create_model
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from app.profiling import call_in_thread
+
+# Response encoding. Every route of the resource routers serializes its response model
+# with a TypeAdapter built once per model and encodes the result with orjson, or with
+# msgpack when the client prefers it (Accept: application/msgpack).
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+# Media types a client may ask for, mapped to the type that is served
+MEDIA_TYPES = {
+    "application/json": JSON_MEDIA_TYPE,
+    "application/msgpack": MSGPACK_MEDIA_TYPE,
+    "application/x-msgpack": MSGPACK_MEDIA_TYPE,
+}
+
+# Parameters the route class adds to its endpoint wrapper when the endpoint doesn't declare them
+REQUEST_PARAM = "serialization_request"
+RESPONSE_PARAM = "serialization_response"
+
+
+def negotiate_media_type(accept: str | None):
+    # Pick the supported media type with the highest quality, JSON wins ties and wildcards
+    if not accept:
+        return JSON_MEDIA_TYPE
+    best, best_quality = JSON_MEDIA_TYPE, 0.0
+    for entry in accept.split(","):
+        media_type, _, params = entry.strip().partition(";")
+        media_type = media_type.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        served = MEDIA_TYPES.get(media_type)
+        if served is None and media_type in ("*/*", "application/*"):
+            served = JSON_MEDIA_TYPE
+        if served is None or quality <= 0:
+            continue
+        if quality > best_quality or (quality == best_quality and served == JSON_MEDIA_TYPE):
+            best, best_quality = served, quality
+    return best
+
+
+def encode_default(value):
+    # msgpack has no native date, time or decimal types, send them as JSON would
+    if isinstance(value, datetime) and value.utcoffset() == timedelta(0):
+        return value.replace(tzinfo=None).isoformat() + "Z"
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def encode_json(content):
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z)
+
+
+def encode_msgpack(content):
+    return msgpack.packb(content, default=encode_default, datetime=False)
+
+
+ENCODERS = {
+    JSON_MEDIA_TYPE: encode_json,
+    MSGPACK_MEDIA_TYPE: encode_msgpack,
+}
+
+
+def serialize(request: Request, model, content, status_code: int = 200):
+    # For endpoints that answer with another model than their route's, e.g. compound documents
+    return get_serializer(model).response(content, request, status_code)
+
+
+# Sparse fieldsets. A fieldset is a tuple of (field, nested fieldset or None) pairs,
+# parsed from ?fields=rating_value,user.username and checked against the response model.
+# Fields are kept once each and in the model's order, so every spelling of a fieldset maps
+# to the same cached model, and the caches are bounded: a client can't grow them at will.
+
+SPARSE_CACHE_SIZE = 256
+
+def item_model(model):
+    # The model of a single item of a list response, or of an optional nested object
+    while get_origin(model) in (list, List, Union, Optional):
+        args = [arg for arg in get_args(model) if arg is not type(None)]
+        if len(args) != 1:
+            return None
+        model = args[0]
+    if isinstance(model, type) and issubclass(model, BaseModel):
+        return model
+    return None
+
+
+def parse_fields(value: str, model):
+    model = item_model(model)
+    tree = {}
+    for path in value.split(","):
+        path = path.strip()
+        if not path:
+            continue
+        node, current = tree, model
+        names = path.split(".")
+        for depth, name in enumerate(names):
+            if current is None or name not in current.model_fields:
+                raise ValueError(f"Unknown field: {path}")
+            if depth == len(names) - 1:
+                # Asking for the whole object wins over asking for some of its fields
+                node[name] = None
+                break
+            child = node.get(name, {})
+            if child is None:
+                break
+            node[name] = child
+            node, current = child, item_model(current.model_fields[name].annotation)
+    if not tree:
+        raise ValueError("fields must name at least one field")
+    return freeze_fields(tree, model)
+
+
+def freeze_fields(tree: dict, model):
+    return tuple(
+        (name, None if tree[name] is None else freeze_fields(tree[name], item_model(field.annotation)))
+        for name, field in model.model_fields.items() if name in tree
+    )
+
+
+@lru_cache(maxsize=SPARSE_CACHE_SIZE)
+def sparse_model(model, fields):
+    # The response model trimmed to the fieldset, built once per model and fieldset
+    if fields is None:
+        return model
+    if get_origin(model) in (list, List):
+        return List[sparse_model(item_model(model), fields)]
+    model = item_model(model)
+    definitions = {}
+    for name, children in fields:
+        field = model.model_fields[name]
+        annotation = field.annotation
+        if children is not None:
+            nested = sparse_model(item_model(annotation), children)
+            annotation = Optional[nested] if type(None) in get_args(annotation) else nested
+        definitions[name] = (annotation, field)
+    return create_model(
+        f"{model.__name__}Fields",
+        __config__=ConfigDict(from_attributes=True),
+        **definitions
+    )
+
+
+class Serializer:
+
+    def __init__(self, response_model=None, **dump_options):
+        # Without a response model the content is encoded the way FastAPI would
+        self.adapter = TypeAdapter(response_model) if response_model is not None else None
+        self.dump_options = dump_options
+
+    def dump(self, content):
+        if self.adapter is None:
+            return jsonable_encoder(content)
+        value = self.adapter.validate_python(content, from_attributes=True)
+        return self.adapter.dump_python(value, **self.dump_options)
+
+    def encode(self, content, media_type: str = JSON_MEDIA_TYPE):
+        return ENCODERS[media_type](self.dump(content))
+
+    def response(self, content, request: Request, status_code: int | None = None):
+        media_type = negotiate_media_type(request.headers.get("accept"))
+        response = Response(
+            self.encode(content, media_type),
+            status_code=status_code or 200,
+            media_type=media_type,
+        )
+        response.headers["Vary"] = "Accept"
+        return response
+
+
+# Route models and the sparse models in use
+@lru_cache(maxsize=2 * SPARSE_CACHE_SIZE)
+def get_serializer(response_model, **dump_options):
+    return Serializer(response_model, **dump_options)
+
+
+class SerializedRoute(APIRoute):
+    # Route class for the resource routers: the endpoint is wrapped in one that turns its
+    # result into a Response, which FastAPI sends as it is, skipping its generic
+    # jsonable_encoder pass. The wrapper declares the Request and Response parameters it
+    # needs in its signature, like any endpoint would.
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        # response_model_include and response_model_exclude are left to FastAPI
+        if kwargs.get("response_model_include") is None and kwargs.get("response_model_exclude") is None:
+            endpoint = self.serialized(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    def serialized(self, endpoint):
+        signature = inspect.signature(endpoint, eval_str=True)
+        parameters = list(signature.parameters.values())
+        request_param = next((parameter.name for parameter in parameters if is_subclass(parameter.annotation, Request)), None)
+        response_param = next((parameter.name for parameter in parameters if is_subclass(parameter.annotation, Response)), None)
+        if request_param is None:
+            parameters.append(inspect.Parameter(REQUEST_PARAM, inspect.Parameter.KEYWORD_ONLY, annotation=Request))
+        if response_param is None:
+            parameters.append(inspect.Parameter(RESPONSE_PARAM, inspect.Parameter.KEYWORD_ONLY, annotation=Response))
+        is_coroutine = asyncio.iscoroutinefunction(endpoint)
+
+        @wraps(endpoint)
+        async def call(**values):
+            request = values[request_param] if request_param else values.pop(REQUEST_PARAM)
+            sub_response = values[response_param] if response_param else values.pop(RESPONSE_PARAM)
+            if is_coroutine:
+                content = await endpoint(**values)
+            else:
+                content = await run_in_threadpool(call_in_thread, endpoint, **values)
+            # A Response the endpoint returned is sent as it is, as FastAPI does
+            if isinstance(content, Response):
+                return content
+            dump_options = dict(
+                by_alias=self.response_model_by_alias,
+                exclude_unset=self.response_model_exclude_unset,
+                exclude_defaults=self.response_model_exclude_defaults,
+                exclude_none=self.response_model_exclude_none,
+            )
+            fields = getattr(request.state, "fields", None)
+            response_model = self.response_model if fields is None else sparse_model(self.response_model, fields)
+            response = get_serializer(response_model, **dump_options).response(
+                content, request, sub_response.status_code or self.status_code)
+            # Headers set on the endpoint's Response parameter
+            response.headers.raw.extend(sub_response.headers.raw)
+            return response
+
+        call.__signature__ = signature.replace(parameters=parameters)
+        return call
+
+
+def is_subclass(annotation, cls):
+    return isinstance(annotation, type) and issubclass(annotation, cls)
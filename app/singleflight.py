@@ -0,0 +1,60 @@
+import asyncio
+import threading
+from starlette.concurrency import run_in_threadpool
+from app.metrics import counter, gauge
+from app.profiling import call_in_thread
+
+# Request coalescing for hot reads. While a read for a key runs in the threadpool,
+# every identical read awaits the same result instead of running its own query.
+# Only calls that overlap are coalesced, nothing is kept once the read finished.
+
+singleflight_calls = counter("checkflix_singleflight_calls_total", "Coalesced reads per flight, run (leader) or shared")
+singleflight_ratio = gauge("checkflix_singleflight_coalescing_ratio", "Share of the reads per flight that got a running read's result")
+
+
+class SingleFlight:
+
+    def __init__(self, name: str):
+        self.name = name
+        # key -> future of the running read; keys start with the id the read is about
+        self.flights = {}
+        # Invalidation handlers forget flights from other threads
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key, function, *args):
+        # The read runs in its own task, so a caller that goes away doesn't cancel it for the others
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = asyncio.ensure_future(run_in_threadpool(call_in_thread, function, *args))
+                self.flights[key] = flight
+                flight.add_done_callback(lambda done: self.finish(key, done))
+        self.count(leader)
+        return await asyncio.shield(flight)
+
+    def finish(self, key, flight):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        # Retrieved here, so an error nobody awaited anymore isn't logged as lost
+        if not flight.cancelled():
+            flight.exception()
+
+    def forget(self, entity_id):
+        # Reads that start after a change don't join a read that may predate it
+        with self.lock:
+            for key in [key for key in self.flights if key[0] == entity_id]:
+                del self.flights[key]
+
+    def count(self, leader: bool):
+        with self.lock:
+            if leader:
+                self.leaders += 1
+            else:
+                self.shared += 1
+            ratio = self.shared / (self.leaders + self.shared)
+        singleflight_calls.inc(flight=self.name, role="leader" if leader else "shared")
+        singleflight_ratio.set(round(ratio, 4), flight=self.name)
@@ -0,0 +1,394 @@
+import argparse
+import csv
+import io
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.orm import Session
+import app.models as models
+from app.config import get_settings
+from app.database import Base
+from app.genres import genre_key
+from app.movie_cards import rebuild_cards
+from app.partitions import create_partitioned_tables, ensure_partitions
+from app.passwords import get_password_context
+
+# Seeded synthetic data at production scale: users, movies with skewed genres,
+# ratings with power-law popularity per movie, and comments with deep reply
+# threads. The same arguments always produce the same rows. Rows are written with
+# COPY on PostgreSQL and executemany elsewhere, and the derived tables (genre
+# counts, activity counters, rankings) are filled so the API serves it as is.
+#
+#   python -m app.synthetic_data --users 1000000 --movies 200000 --ratings 10000000 --comments 2000000
+
+# Genres from most to least common, their share falls off as a power law
+GENRES = [
+    "Drama", "Comedy", "Action", "Thriller", "Romance", "Horror", "Crime", "Documentary", "Adventure",
+    "Sci-Fi", "Animation", "Fantasy", "Mystery", "Family", "Biography", "War", "Musical", "Western",
+]
+FIRST_NAMES = [
+    "Ada", "Ben", "Chioma", "Dara", "Emeka", "Fatima", "Grace", "Hassan", "Ifeoma", "Jon", "Kemi", "Lena",
+    "Musa", "Nia", "Omar", "Priya", "Quinn", "Rosa", "Sade", "Tomi", "Uche", "Vera", "Wale", "Yusuf", "Zara",
+]
+LAST_NAMES = [
+    "Adeyemi", "Brown", "Chen", "Diallo", "Eze", "Garcia", "Haruna", "Ibrahim", "Johnson", "Kim", "Lopez",
+    "Mensah", "Nwosu", "Okafor", "Patel", "Rossi", "Smith", "Tanaka", "Usman", "Williams",
+]
+TITLE_WORDS = [
+    ["The", "A", "Last", "Silent", "Broken", "Golden", "Hidden", "Lost", "Midnight", "Red"],
+    ["River", "City", "Garden", "Empire", "Letter", "Storm", "Harbor", "Promise", "Shadow", "Road"],
+    ["", "", "", " Returns", " Rising", " of Lagos", " in Winter", " II", " Forever", " Unbound"],
+]
+COMMENT_PHRASES = [
+    "Loved it.", "Not for me.", "The ending surprised me.", "Great soundtrack.", "Too long.",
+    "The lead was brilliant.", "Watched it twice.", "Better than the book.", "Agreed!", "I disagree.",
+    "Worth it for the last act.", "The pacing dragged in the middle.",
+]
+
+# Power-law exponents: movie popularity, user activity and genre share
+MOVIE_POPULARITY_EXPONENT = 1.1
+USER_ACTIVITY_EXPONENT = 0.8
+GENRE_EXPONENT = 1.0
+
+# Share of comments that start a thread, and of replies that answer the latest comment of the movie
+TOP_LEVEL_SHARE = 0.35
+CHAIN_SHARE = 0.7
+
+
+def power_law(count: int, exponent: float, rng=None):
+    # Probabilities that fall off with rank. Given a generator the ranks are shuffled,
+    # so ids don't follow popularity.
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    weights /= weights.sum()
+    return rng.permutation(weights) if rng is not None else weights
+
+
+def spread_times(count: int, start: float, end: float, rng):
+    # Sorted unix seconds, denser towards the end as activity grows
+    return np.sort(start + (end - start) * np.sqrt(rng.random(count)))
+
+
+def generate_users(count: int, start: float, end: float, rng):
+    first = rng.integers(0, len(FIRST_NAMES), count)
+    last = rng.integers(0, len(LAST_NAMES), count)
+    return {
+        "id": np.arange(1, count + 1),
+        "first": first,
+        "last": last,
+        "created_at": spread_times(count, start, end, rng),
+    }
+
+
+def generate_movies(count: int, user_count: int, start: float, end: float, rng):
+    # Up to three genres each, drawn with the skewed shares, repeats dropped
+    genre_counts = rng.choice([1, 2, 3], size=count, p=[0.6, 0.3, 0.1])
+    candidates = rng.choice(len(GENRES), size=(count, 3), p=power_law(len(GENRES), GENRE_EXPONENT))
+    genres = []
+    for genre_count, drawn in zip(genre_counts.tolist(), candidates.tolist()):
+        genres.append(list(dict.fromkeys(drawn[:genre_count])))
+    return {
+        "id": np.arange(1, count + 1),
+        "title_words": [rng.integers(0, len(words), count) for words in TITLE_WORDS],
+        "release_year": rng.integers(1950, 2025, count),
+        "user_id": rng.choice(user_count, size=count, p=power_law(user_count, USER_ACTIVITY_EXPONENT, rng)) + 1,
+        "genres": genres,
+        "quality": rng.normal(6.5, 1.3, count),
+        "created_at": spread_times(count, start, end, rng),
+    }
+
+
+def generate_ratings(count: int, movie_quality, user_count: int, start: float, end: float, rng):
+    # One rating per user and movie: pairs are drawn from the popularity and activity
+    # distributions, duplicates dropped and more drawn until there are enough
+    movie_count = len(movie_quality)
+    count = min(count, movie_count * user_count)
+    movie_p = power_law(movie_count, MOVIE_POPULARITY_EXPONENT, rng)
+    user_p = power_law(user_count, USER_ACTIVITY_EXPONENT, rng)
+    keys = np.empty(0, dtype=np.int64)
+    while len(keys) < count:
+        needed = int((count - len(keys)) * 1.2) + 16
+        movies = rng.choice(movie_count, size=needed, p=movie_p).astype(np.int64)
+        users = rng.choice(user_count, size=needed, p=user_p).astype(np.int64)
+        keys = np.unique(np.concatenate([keys, movies * user_count + users]))
+    keys = rng.permutation(keys)[:count]
+    movie_index, user_index = keys // user_count, keys % user_count
+
+    user_bias = rng.normal(0, 0.8, user_count)
+    values = movie_quality[movie_index] + user_bias[user_index] + rng.normal(0, 1.5, count)
+    return {
+        "id": np.arange(1, count + 1),
+        "movie_id": movie_index + 1,
+        "user_id": user_index + 1,
+        "rating_value": np.clip(np.rint(values), 1, 10).astype(np.int64),
+        "created_at": spread_times(count, start, end, rng),
+    }
+
+
+def generate_comments(count: int, movie_count: int, user_count: int, start: float, end: float, rng):
+    movie_index = rng.choice(movie_count, size=count, p=power_law(movie_count, MOVIE_POPULARITY_EXPONENT, rng))
+    user_index = rng.choice(user_count, size=count, p=power_law(user_count, USER_ACTIVITY_EXPONENT, rng))
+    created_at = spread_times(count, start, end, rng)
+
+    # Ids follow time. Grouped by movie (keeping time order), a comment's position in its
+    # group says how many earlier comments of the movie it could answer.
+    order = np.argsort(movie_index, kind="stable")
+    grouped_movies = movie_index[order]
+    group_start = np.searchsorted(grouped_movies, grouped_movies, side="left")
+    position = np.arange(count) - group_start
+
+    replies = (position > 0) & (rng.random(count) >= TOP_LEVEL_SHARE)
+    chained = rng.random(count) < CHAIN_SHARE
+    earlier = group_start + np.floor(rng.random(count) * np.maximum(position, 1)).astype(np.int64)
+    parent_in_group = np.where(chained, np.arange(count) - 1, earlier)
+    parent_ids = np.zeros(count, dtype=np.int64)
+    parent_ids[order[replies]] = order[parent_in_group[replies]] + 1
+    return {
+        "id": np.arange(1, count + 1),
+        "movie_id": movie_index + 1,
+        "user_id": user_index + 1,
+        "phrase": rng.integers(0, len(COMMENT_PHRASES), count),
+        "parent_id": parent_ids,
+        "created_at": created_at,
+    }
+
+
+class BulkWriter:
+    # COPY ... FROM STDIN on PostgreSQL. SQLite gets a plain executemany of tuples,
+    # other databases go through SQLAlchemy's insert.
+
+    def __init__(self, connection, batch_size: int):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.dialect = connection.dialect.name
+        self.written = {}
+
+    def timestamps(self, seconds):
+        values = (np.asarray(seconds) * 1e6).astype("datetime64[us]")
+        if self.dialect == "postgresql":
+            return np.datetime_as_string(values, unit="us", timezone="UTC").tolist()
+        if self.dialect == "sqlite":
+            # The format SQLAlchemy stores and parses SQLite datetimes in
+            return [value.replace("T", " ") for value in np.datetime_as_string(values, unit="us").tolist()]
+        return [value.replace(tzinfo=timezone.utc) for value in values.tolist()]
+
+    def write(self, table, columns: list[str], count: int, make_rows):
+        # make_rows(start, stop) returns the rows of that slice as a list of tuples
+        names = ", ".join(columns)
+        for start in range(0, count, self.batch_size):
+            rows = make_rows(start, min(start + self.batch_size, count))
+            if self.dialect == "postgresql":
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(rows)
+                buffer.seek(0)
+                cursor = self.connection.connection.cursor()
+                cursor.copy_expert(f"COPY {table.name} ({names}) FROM STDIN WITH (FORMAT csv)", buffer)
+                cursor.close()
+            elif self.dialect == "sqlite":
+                cursor = self.connection.connection.cursor()
+                cursor.executemany(f"INSERT INTO {table.name} ({names}) VALUES ({', '.join('?' * len(columns))})", rows)
+                cursor.close()
+            else:
+                self.connection.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+        self.written[table.name] = self.written.get(table.name, 0) + count
+
+
+def column(values, start: int, stop: int):
+    return values[start:stop].tolist()
+
+
+def write_users(writer: BulkWriter, users, hashed_password: str):
+    def rows(start, stop):
+        first = [FIRST_NAMES[index] for index in column(users["first"], start, stop)]
+        last = [LAST_NAMES[index] for index in column(users["last"], start, stop)]
+        ids = column(users["id"], start, stop)
+        usernames = [f"{name.lower()}{user_id}" for name, user_id in zip(first, ids)]
+        return list(zip(
+            ids, [f"{username}@example.com" for username in usernames], usernames,
+            [f"{first_name} {last_name}" for first_name, last_name in zip(first, last)],
+            [hashed_password] * len(ids), writer.timestamps(users["created_at"][start:stop]),
+        ))
+
+    columns = ["id", "email", "username", "full_name", "hashed_password", "created_at"]
+    writer.write(models.User.__table__, columns, len(users["id"]), rows)
+
+
+def write_movies(writer: BulkWriter, movies):
+    def rows(start, stop):
+        words = [column(index, start, stop) for index in movies["title_words"]]
+        titles = [
+            f"{TITLE_WORDS[0][first]} {TITLE_WORDS[1][second]}{TITLE_WORDS[2][third]}"
+            for first, second, third in zip(*words)
+        ]
+        genres = [", ".join(GENRES[index] for index in names) for names in movies["genres"][start:stop]]
+        descriptions = [f"A {genre.split(',')[0].lower()} about {title.lower()}." for genre, title in zip(genres, titles)]
+        return list(zip(
+            column(movies["id"], start, stop), titles, genres, descriptions,
+            column(movies["release_year"], start, stop), column(movies["user_id"], start, stop),
+            writer.timestamps(movies["created_at"][start:stop]),
+        ))
+
+    columns = ["id", "title", "genre", "description", "release_year", "user_id", "created_at"]
+    writer.write(models.Movie.__table__, columns, len(movies["id"]), rows)
+
+    movie_counts = Counter(index for names in movies["genres"] for index in names)
+    writer.write(models.Genre.__table__, ["id", "name", "key", "movie_count"], len(GENRES), lambda start, stop: [
+        (index + 1, GENRES[index], genre_key(GENRES[index]), movie_counts[index]) for index in range(start, stop)
+    ])
+    links = [(movie_id, index + 1) for movie_id, names in zip(movies["id"].tolist(), movies["genres"]) for index in names]
+    writer.write(models.MovieGenre.__table__, ["movie_id", "genre_id"], len(links), lambda start, stop: links[start:stop])
+
+
+def write_ratings(writer: BulkWriter, ratings):
+    def rows(start, stop):
+        return list(zip(
+            column(ratings["id"], start, stop), column(ratings["user_id"], start, stop),
+            column(ratings["movie_id"], start, stop), column(ratings["rating_value"], start, stop),
+            writer.timestamps(ratings["created_at"][start:stop]),
+        ))
+
+    columns = ["id", "user_id", "movie_id", "rating_value", "created_at"]
+    writer.write(models.Rating.__table__, columns, len(ratings["id"]), rows)
+
+
+def write_comments(writer: BulkWriter, comments):
+    def rows(start, stop):
+        return list(zip(
+            column(comments["id"], start, stop), column(comments["user_id"], start, stop),
+            column(comments["movie_id"], start, stop),
+            [COMMENT_PHRASES[index] for index in column(comments["phrase"], start, stop)],
+            [parent_id or None for parent_id in column(comments["parent_id"], start, stop)],
+            writer.timestamps(comments["created_at"][start:stop]),
+        ))
+
+    columns = ["id", "user_id", "movie_id", "comment", "parent_id", "created_at"]
+    writer.write(models.Comment.__table__, columns, len(comments["id"]), rows)
+
+
+def write_rankings(writer: BulkWriter, ratings, movie_count: int, min_votes: int, refreshed_at: float):
+    # The same figures RankingCRUDService.refresh_rankings computes, straight from the arrays
+    counts = np.bincount(ratings["movie_id"], minlength=movie_count + 1)
+    sums = np.bincount(ratings["movie_id"], weights=ratings["rating_value"], minlength=movie_count + 1).astype(np.int64)
+    rated = np.nonzero(counts)[0]
+    if not len(rated):
+        return
+    global_mean = sums.sum() / counts.sum()
+    averages = np.round(sums[rated] / counts[rated], 2)
+    weights = counts[rated] / (counts[rated] + min_votes)
+    weighted = np.round(weights * averages + (1 - weights) * global_mean, 4)
+    updated_at = writer.timestamps([refreshed_at])[0]
+
+    def rows(start, stop):
+        return [
+            (movie_id, count, total, average, weighted_rating, 0.0, False, updated_at)
+            for movie_id, count, total, average, weighted_rating in zip(
+                column(rated, start, stop), column(counts[rated], start, stop), column(sums[rated], start, stop),
+                column(averages, start, stop), column(weighted, start, stop))
+        ]
+
+    columns = ["movie_id", "rating_count", "rating_sum", "avg_rating", "weighted_rating", "trending_score", "dirty", "updated_at"]
+    writer.write(models.MovieRanking.__table__, columns, len(rated), rows)
+
+
+def write_activity_counts(writer: BulkWriter, ratings, comments):
+    # Counter rows for every (scope, counted) pair CountCRUDService maintains
+    sources = [
+        ("movie", "ratings", ratings["movie_id"]),
+        ("movie", "comments", comments["movie_id"]),
+        ("user", "ratings", ratings["user_id"]),
+        ("user", "comments", comments["user_id"]),
+        ("comment", "replies", comments["parent_id"][comments["parent_id"] > 0]),
+    ]
+    for scope, counted, ids in sources:
+        counts = np.bincount(ids) if len(ids) else np.zeros(0, dtype=np.int64)
+        scope_ids = np.nonzero(counts)[0]
+        writer.write(models.ActivityCount.__table__, ["scope", "scope_id", "counted", "count"], len(scope_ids),
+                     lambda start, stop: [(scope, scope_id, counted, count) for scope_id, count in zip(
+                         column(scope_ids, start, stop), column(counts[scope_ids], start, stop))])
+
+
+def reset_sequences(connection):
+    # Rows were written with explicit ids, move the serial sequences past them
+    if connection.dialect.name != "postgresql":
+        return
+    for table in ("users", "movies", "genres", "ratings", "comments"):
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT COALESCE(MAX(id), 1) FROM {table}))"))
+
+
+def generate(engine, users: int, movies: int, ratings: int, comments: int, seed: int = 42,
+             end: datetime | None = None, days: int = 365, password: str = "password",
+             batch_size: int = 10000, log=print):
+    end = end or datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    end_seconds = end.timestamp()
+    start_seconds = end_seconds - timedelta(days=days).total_seconds()
+    # Movies are listed in the first half of the window, ratings and comments follow
+    middle_seconds = (start_seconds + end_seconds) / 2
+    rng = np.random.default_rng(seed)
+    timings = {}
+
+    def step(name, run):
+        started = time.perf_counter()
+        result = run()
+        timings[name] = time.perf_counter() - started
+        log(f"{name:<12} {timings[name]:7.1f}s")
+        return result
+
+    settings = get_settings()
+    create_partitioned_tables(engine, settings)
+    Base.metadata.create_all(bind=engine)
+    with engine.connect() as connection:
+        if connection.execute(select(func.count()).select_from(models.User.__table__)).scalar():
+            raise ValueError("The database already has users, generate into an empty database")
+
+    user_rows = step("users", lambda: generate_users(users, start_seconds, middle_seconds, rng))
+    movie_rows = step("movies", lambda: generate_movies(movies, users, start_seconds, middle_seconds, rng))
+    rating_rows = step("ratings", lambda: generate_ratings(ratings, movie_rows["quality"], users, middle_seconds, end_seconds, rng))
+    comment_rows = step("comments", lambda: generate_comments(comments, movies, users, middle_seconds, end_seconds, rng))
+    # Every user gets the same password, hashed once
+    hashed_password = get_password_context().hash(password)
+
+    with engine.begin() as connection:
+        # Monthly partitions for the whole window, when ratings and comments are partitioned by time
+        ensure_partitions(connection, settings, start=datetime.fromtimestamp(start_seconds, timezone.utc).date())
+        writer = BulkWriter(connection, batch_size)
+        step("write users", lambda: write_users(writer, user_rows, hashed_password))
+        step("write movies", lambda: write_movies(writer, movie_rows))
+        step("write ratings", lambda: write_ratings(writer, rating_rows))
+        step("write comments", lambda: write_comments(writer, comment_rows))
+        step("write derived", lambda: (
+            write_rankings(writer, rating_rows, movies, settings.ranking_min_votes, end_seconds),
+            write_activity_counts(writer, rating_rows, comment_rows),
+        ))
+        reset_sequences(connection)
+    # The movie_cards projection, from the rows just written
+    with Session(engine) as db:
+        writer.written["movie_cards"] = step("write cards", lambda: rebuild_cards(db))
+    with engine.connect() as connection:
+        connection.execute(text("ANALYZE"))
+        connection.commit()
+    return writer.written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill an empty database with seeded synthetic data")
+    parser.add_argument("--url", help="defaults to DATABASE_URL")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--movies", type=int, default=5000)
+    parser.add_argument("--ratings", type=int, default=500000)
+    parser.add_argument("--comments", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--end", type=datetime.fromisoformat, help="time of the latest activity, defaults to today 00:00 UTC")
+    parser.add_argument("--days", type=int, default=365, help="length of the activity window")
+    parser.add_argument("--password", default="password", help="password of every generated user")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    end = args.end.replace(tzinfo=args.end.tzinfo or timezone.utc) if args.end else None
+    engine = create_engine(args.url or get_settings().database_url)
+    started = time.perf_counter()
+    written = generate(engine, args.users, args.movies, args.ratings, args.comments, seed=args.seed, end=end,
+                       days=args.days, password=args.password, batch_size=args.batch_size)
+    engine.dispose()
+    print(", ".join(f"{count} {table}" for table, count in written.items()), f"in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,36 @@
+import pytest
+from fastapi.testclient import TestClient
+import app.config as config
+import app.database as database
+from app.config import Settings
+from app.main import create_app
+
+
+@pytest.fixture
+def settings():
+    previous = config.current_settings
+    yield Settings(database_url="sqlite:///./test_app.db", run_background_jobs=False)
+    config.configure(previous)
+
+
+def test_create_app_has_no_side_effects(settings):
+    app = create_app(settings)
+    assert app.state.settings is settings
+    assert database.engine is None
+
+
+def test_lifespan_creates_and_disposes_engine(settings):
+    app = create_app(settings)
+    with TestClient(app) as client:
+        assert database.engine is not None
+        assert str(database.engine.url) == settings.database_url
+        response = client.get("/")
+        assert response.status_code == 200
+    assert database.engine is None
+
+
+def test_missing_database_url_fails_at_startup(settings):
+    app = create_app(Settings(database_url=None, run_background_jobs=False))
+    with pytest.raises(ValueError):
+        with TestClient(app):
+            pass
@@ -0,0 +1,146 @@
+import threading
+import time
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+import app.config as config
+import app.schemas as schemas
+from app.auth import generate_access_token
+from app.config import Settings
+from app.crud import movie_crud_service, user_service
+from app.database import Base, get_database_session
+from app.models import Movie
+from app.main import app, create_app
+from app.middleware import classify_route
+from app.routers.batch import batch_items
+
+# A file database, concurrent sub-requests each take a connection of their own
+engine = create_engine("sqlite:///./test_batch.db", connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture
+def client():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    owner = user_service.create_user(db, schemas.UserCreate(
+        email="owner@example.com", username="owner", full_name="Owner", password="x"), hashed_password="x")
+    for title in ("Alien", "Heat"):
+        movie_crud_service.create_movie(db, schemas.MovieCreate(title=title, genre="Drama", release_year=1979), owner.id)
+    db.close()
+
+    def override_get_db():
+        session = TestingSessionLocal()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    overrides = dict(app.dependency_overrides)
+    app.dependency_overrides[get_database_session] = override_get_db
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+    app.dependency_overrides.update(overrides)
+    Base.metadata.drop_all(bind=engine)
+
+
+def batch(client, paths, **kwargs):
+    return client.post("/batch", json={"requests": [{"path": path} for path in paths]}, **kwargs)
+
+
+def test_responses_in_order_with_their_status(client):
+    response = batch(client, ["/movies/2", "/movies/404", "/movies/1", "/users/name/owner", "/movies/?limit=1"])
+    assert response.status_code == 200
+    items = response.json()["responses"]
+    assert [item["status"] for item in items] == [200, 404, 200, 200, 200]
+    assert items[0]["body"]["title"] == "Heat"
+    assert items[1]["body"] == {"detail": "No Movie Found"}
+    assert items[2]["body"]["title"] == "Alien"
+    assert items[3]["body"]["username"] == "owner"
+    assert len(items[4]["body"]) == 1
+
+
+def test_item_errors_stay_in_their_item(client):
+    before = batch_items.values.get((("status_code", 400),), 0)
+    items = batch(client, ["/movies/1", "/metrics", "/movies/1/live", "/movies/1/similar?limit=x"]).json()["responses"]
+    assert [item["status"] for item in items] == [200, 400, 400, 422]
+    assert batch_items.values[(("status_code", 400),)] == before + 2
+
+
+def test_token_checked_once_for_the_batch(client):
+    token = generate_access_token(data={"sub": "owner@example.com"})
+    response = batch(client, ["/movies/1", "/movies/2"], headers={"Authorization": f"Bearer {token}"})
+    assert [item["status"] for item in response.json()["responses"]] == [200, 200]
+
+    response = batch(client, ["/movies/1"], headers={"Authorization": "Bearer invalid"})
+    assert response.status_code == 401
+
+
+def test_rejects_oversized_and_non_get_batches(client):
+    assert batch(client, ["/movies/1"] * 51).status_code == 422
+    assert batch(client, []).status_code == 422
+    response = client.post("/batch", json={"requests": [{"method": "DELETE", "path": "/movies/1"}]})
+    assert response.status_code == 422
+
+
+def test_sub_requests_overlap(client):
+    active, most = [0], [0]
+    lock = threading.Lock()
+
+    def slow_statement(*args):
+        with lock:
+            active[0] += 1
+            most[0] = max(most[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+
+    event.listen(engine, "before_cursor_execute", slow_statement)
+    try:
+        items = batch(client, ["/movies/1", "/movies/2"]).json()["responses"]
+    finally:
+        event.remove(engine, "before_cursor_execute", slow_statement)
+    assert [item["status"] for item in items] == [200, 200]
+    # Movie reads wait on the threadpool, the batch's loop starts the next one meanwhile
+    assert most[0] > 1
+
+
+def test_sub_requests_take_a_read_slot_each(client):
+    previous = config.current_settings
+    # The batch holds one of the two slots, its first sub-request the other
+    settings = Settings(database_url="sqlite:///./test_batch.db", run_background_jobs=False,
+                        admission_read_concurrency=2, admission_read_max_wait_seconds=0)
+    try:
+        with TestClient(create_app(settings)) as limited:
+            items = batch(limited, ["/movies/1", "/movies/2", "/movies/1"]).json()["responses"]
+    finally:
+        config.configure(previous)
+    assert [item["status"] for item in items] == [200, 503, 503]
+    assert items[1]["headers"]["Retry-After"] == "1"
+
+
+def test_write_marker_reaches_the_sub_requests(client):
+    replica = create_engine("sqlite:///./test_batch_replica.db")
+    Base.metadata.create_all(bind=replica)
+    db = sessionmaker(bind=replica)()
+    db.add(Movie(id=1, title="Alien (stale)", genre="Drama", user_id=1))
+    db.commit()
+    db.close()
+    previous = config.current_settings
+    settings = Settings(database_url="sqlite:///./test_batch.db", database_replica_url="sqlite:///./test_batch_replica.db",
+                        run_background_jobs=False)
+    try:
+        with TestClient(create_app(settings)) as routed:
+            assert batch(routed, ["/movies/1"]).json()["responses"][0]["body"]["title"] == "Alien (stale)"
+            # Right after a write the client's reads, batched or not, go to the primary
+            response = batch(routed, ["/movies/1"], headers={"X-Last-Write": str(time.time())})
+            assert response.json()["responses"][0]["body"]["title"] == "Alien"
+    finally:
+        config.configure(previous)
+        Base.metadata.drop_all(bind=replica)
+        replica.dispose()
+
+
+def test_batch_is_a_read():
+    assert classify_route("POST", "/batch") == "read"
@@ -4,7 +4,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from app.main import app
 from app.database import get_database_session, Base
-from app.models import User
+from app.models import Comment, User
 from app.auth import generate_access_token
 import os
 from app.tests.test_db import test_db
@@ -70,3 +70,74 @@ def test_get_comments_by_user(client, auth_token):
     comments = response.json()
     assert len(comments) > 0
     assert comments[0]["user_id"] == 1
+
+
+def test_get_comments_with_included_users(client, auth_token):
+    client.post("/movies/comments/1", json={"comment": "Second comment"}, headers={"Authorization": auth_token})
+
+    response = client.get("/movies/comments/movie/1?include=users")
+    assert response.status_code == 200
+    document = response.json()
+    assert len(document["data"]) >= 2
+    assert "author" not in document["data"][0]
+    user_id = document["data"][0]["user_id"]
+    # Each author is sent once, keyed by id
+    assert list(document["included"]["users"]) == [str(user_id)]
+    assert document["included"]["users"][str(user_id)]["id"] == user_id
+
+    response = client.get("/movies/comments/?include=users")
+    assert response.status_code == 200
+    assert response.json()["data"][0]["replies"] == 0
+    assert str(user_id) in response.json()["included"]["users"]
+
+    response = client.get("/movies/comments/?include=users&fields=comment")
+    assert response.status_code == 422
+
+
+def test_comment_total_counts(client, auth_token, test_db):
+    before = int(client.get("/movies/comments/movie/1?count=true").headers["x-total-count"])
+    created = client.post("/movies/comments/1", json={"comment": "Counted"}, headers={"Authorization": auth_token}).json()
+    reply = client.post(f"/movies/comments/reply_comment/{created['id']}", json={"comment": "Counted reply"},
+                        headers={"Authorization": auth_token}).json()
+
+    response = client.get("/movies/comments/movie/1?count=true")
+    assert response.headers["x-total-count"] == str(before + 2)
+    assert "x-total-count-estimated" not in response.headers
+    assert test_db.query(Comment).filter(Comment.movie_id == 1).count() == before + 2
+
+    response = client.get(f"/movies/comments/replies/{created['id']}?count=true")
+    assert response.headers["x-total-count"] == "1"
+
+    client.delete(f"/movies/comments/{reply['id']}", headers={"Authorization": auth_token})
+    response = client.get("/movies/comments/movie/1?count=true")
+    assert response.headers["x-total-count"] == str(before + 1)
+
+    response = client.get("/movies/comments/?count=true")
+    assert response.headers["x-total-count-estimated"] == "true"
+    assert int(response.headers["x-total-count"]) >= before + 1
+    assert "x-total-count" not in client.get("/movies/comments/").headers
+
+
+def test_lookups_by_id_filter_on_the_movie(client, auth_token):
+    created = client.post("/movies/comments/1", json={"comment": "Pruned"}, headers={"Authorization": auth_token}).json()
+    assert client.get(f"/movies/comments/{created['id']}?movie_id=1").json()["Comment"]["comment"] == "Pruned"
+    # The wrong movie names another partition, the comment isn't in it
+    assert client.get(f"/movies/comments/{created['id']}?movie_id=2").status_code == 404
+    response = client.put(f"/movies/comments/{created['id']}?movie_id=1", json={"comment": "Pruned twice"},
+                          headers={"Authorization": auth_token})
+    assert response.json()["comment"] == "Pruned twice"
+
+
+def test_live_comment_feed(client, auth_token):
+    with client.websocket_connect("/movies/1/live/ws") as websocket:
+        response = client.post(
+            "/movies/comments/1",
+            json={"comment": "Live comment", "parent_id": None},
+            headers={"Authorization": auth_token}
+        )
+        assert response.status_code == 201
+
+        event = websocket.receive_json()
+        assert event["type"] == "comment"
+        assert event["data"]["comment"] == "Live comment"
+        assert event["data"]["movie_id"] == 1
@@ -0,0 +1,55 @@
+from app.content_index import ContentIndex
+
+
+def make_index():
+    index = ContentIndex(dimensions=256, capacity=2)
+    index.add(1, "Space Wars", "Sci-Fi", "Rebels fight an empire across the galaxy.")
+    index.add(2, "Galaxy Rebels", "Sci-Fi", "A rebel fleet fights the empire in space.")
+    index.add(3, "Tea Time", "Comedy", "Two aunts run a tea shop in a small village.")
+    return index
+
+
+def test_similar_movies_by_content():
+    index = make_index()
+    similar = index.similar(1, k=2)
+    assert similar[0][0] == 2
+    assert all(movie_id != 1 for movie_id, _ in similar)
+    assert index.similar(99) == []
+
+
+def test_similar_batch():
+    index = make_index()
+    results = index.similar_batch([1, 99, 2], k=1)
+    assert results[0][0][0] == 2
+    assert results[1] == []
+    assert results[2][0][0] == 1
+
+
+def test_update_and_remove_movie():
+    index = make_index()
+    index.add(3, "Space Rebels", "Sci-Fi", "The empire and the rebels meet in the galaxy.")
+    assert len(index) == 3
+    assert index.similar(3, k=1)[0][0] in (1, 2)
+
+    index.remove(1)
+    assert len(index) == 2
+    assert index.similar(1) == []
+    assert all(movie_id != 1 for movie_id, _ in index.similar(2))
+
+
+def test_weights_do_not_depend_on_insertion_order():
+    movies = [
+        (1, "Space Wars", "Sci-Fi", "Rebels fight an empire across the galaxy."),
+        (2, "Galaxy Rebels", "Sci-Fi", "A rebel fleet fights the empire in space."),
+        (3, "Tea Time", "Comedy", "Two aunts run a tea shop in a small village."),
+        (4, "Space Tea", "Comedy", "An empire of tea shops."),
+    ]
+    forward, backward = ContentIndex(dimensions=256, capacity=2), ContentIndex(dimensions=256, capacity=2)
+    for movie in movies:
+        forward.add(*movie, reweight=False)
+    for movie in reversed(movies):
+        backward.add(*movie, reweight=False)
+    forward.reweight()
+    backward.reweight()
+    for movie_id, *_ in movies:
+        assert forward.similar(movie_id, k=3) == backward.similar(movie_id, k=3)
@@ -0,0 +1,89 @@
+import time
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import app.database as database
+from app.config import Settings, get_settings
+from app.middleware import ReadYourWritesMiddleware
+
+# Two local SQLite databases stand in for the primary and the replica
+primary_engine = create_engine("sqlite:///./test_primary.db", connect_args={"check_same_thread": False})
+replica_engine = create_engine("sqlite:///./test_replica.db", connect_args={"check_same_thread": False})
+
+PrimarySession = sessionmaker(autocommit=False, autoflush=False, bind=primary_engine)
+ReplicaSession = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+
+
+def make_request(method: str, token: str = "Bearer token", headers=()):
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": "/movies/",
+        "headers": [(b"authorization", token.encode()), *headers],
+        "client": ("127.0.0.1", 1234),
+    }
+    return Request(scope)
+
+
+@pytest.fixture(autouse=True)
+def split_sessions(monkeypatch):
+    monkeypatch.setattr(database, "SessionLocal", PrimarySession)
+    monkeypatch.setattr(database, "ReplicaSessionLocal", ReplicaSession)
+
+
+def test_reads_go_to_replica():
+    session_gen = database.get_database_session(make_request("GET"))
+    db = next(session_gen)
+    assert db.get_bind() is replica_engine
+    session_gen.close()
+
+
+def test_writes_go_to_primary():
+    session_gen = database.get_database_session(make_request("POST"))
+    db = next(session_gen)
+    assert db.get_bind() is primary_engine
+    session_gen.close()
+
+
+def test_reads_after_write_stay_on_primary():
+    marker = database.write_marker()
+    by_header = make_request("GET", headers=[(b"x-last-write", marker.encode())])
+    by_cookie = make_request("GET", headers=[(b"cookie", f"last_write={marker}".encode())])
+    assert database.choose_session_factory(by_header) is PrimarySession
+    assert database.choose_session_factory(by_cookie) is PrimarySession
+    # Clients without a marker keep reading from the replica
+    assert database.choose_session_factory(make_request("GET")) is ReplicaSession
+
+
+def test_read_your_writes_window_expires():
+    window = get_settings().read_your_writes_seconds
+    request = make_request("GET", headers=[(b"x-last-write", database.write_marker(now=1000).encode())])
+    assert database.wrote_recently(request, now=1000 + window - 1)
+    assert not database.wrote_recently(request, now=1000 + window + 1)
+    # A marker from far in the future or that isn't a time doesn't pin the client
+    assert not database.wrote_recently(request, now=1000 - window - 1)
+    assert not database.wrote_recently(make_request("GET", headers=[(b"x-last-write", b"soon")]))
+
+
+def test_write_responses_carry_the_marker():
+    app = FastAPI()
+
+    @app.get("/movies/")
+    async def read():
+        return []
+
+    @app.post("/movies/")
+    async def write():
+        return {}
+
+    app.add_middleware(ReadYourWritesMiddleware, settings=Settings(read_your_writes_seconds=5))
+    client = TestClient(app)
+    assert "x-last-write" not in client.get("/movies/").headers
+
+    before = time.time()
+    response = client.post("/movies/")
+    assert before <= float(response.headers["x-last-write"]) <= time.time()
+    assert response.cookies["last_write"] == response.headers["x-last-write"]
+    assert "Max-Age=5" in response.headers["set-cookie"]
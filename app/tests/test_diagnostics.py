@@ -0,0 +1,81 @@
+import tracemalloc
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+import app.config as config
+import app.diagnostics as diagnostics
+from app.config import Settings
+from app.database import SessionLocal
+from app.main import create_app
+
+HEADERS = {"X-Diagnostics-Token": "admin-secret"}
+
+
+@pytest.fixture
+def client():
+    previous = config.current_settings
+    settings = Settings(database_url="sqlite:///./test_diagnostics.db", run_background_jobs=False,
+                        diagnostics_token="admin-secret", memory_trace_frames=5, memory_sample_rate=1.0)
+    with TestClient(create_app(settings)) as client:
+        yield client
+    diagnostics.stop_tracing()
+    diagnostics.request_samples.clear()
+    config.configure(previous)
+
+
+def test_requires_token(client):
+    assert client.get("/diagnostics/memory").status_code == 403
+    assert client.get("/diagnostics/memory", headers={"X-Diagnostics-Token": "wrong"}).status_code == 403
+
+
+def test_diagnostics_are_not_served_without_token():
+    previous = config.current_settings
+    app = create_app(Settings(database_url="sqlite:///./test_diagnostics.db", run_background_jobs=False))
+    config.configure(previous)
+    assert not any(route.path.startswith("/diagnostics") for route in app.routes)
+
+
+def test_snapshot_diff_and_request_peaks(client):
+    memory = client.get("/diagnostics/memory", headers=HEADERS).json()
+    assert memory["tracing"] is True
+    assert memory["traceback_frames"] == 5
+
+    first = client.post("/diagnostics/memory/snapshots", headers=HEADERS)
+    assert first.status_code == 201
+    retained = [bytearray(64 * 1024) for _ in range(16)]
+    for _ in range(3):
+        assert client.get("/movies/").status_code == 200
+    second = client.post("/diagnostics/memory/snapshots", headers=HEADERS).json()
+
+    top = client.get(f"/diagnostics/memory/snapshots/{second['id']}?limit=5", headers=HEADERS).json()
+    assert len(top["top"]) <= 5 and top["top"][0]["size_kib"] > 0
+
+    diff = client.get(f"/diagnostics/memory/snapshots/{second['id']}/diff/{first.json()['id']}", headers=HEADERS).json()
+    assert any("test_diagnostics.py" in diff_entry["site"][0] and diff_entry["size_diff_kib"] >= 1000
+               for diff_entry in diff)
+    del retained
+
+    samples = client.get("/diagnostics/memory/requests", headers=HEADERS).json()
+    movie_samples = [sample for sample in samples if sample["route"] == "/movies/"]
+    assert len(movie_samples) == 3
+    assert all(sample["status_code"] == 200 and sample["peak_kib"] > 0 for sample in movie_samples)
+
+    assert client.get("/diagnostics/memory/snapshots/999", headers=HEADERS).status_code == 404
+
+
+def test_stop_tracing(client):
+    assert client.delete("/diagnostics/memory/tracing", headers=HEADERS).status_code == 204
+    assert not tracemalloc.is_tracing()
+    assert client.post("/diagnostics/memory/snapshots", headers=HEADERS).status_code == 409
+    assert client.post("/diagnostics/memory/tracing?frames=3", headers=HEADERS).json()["traceback_frames"] == 3
+
+
+def test_closed_sessions_are_not_counted(client):
+    db_session = SessionLocal()
+    db_session.execute(text("SELECT 1"))
+    assert db_session in diagnostics.live_sessions
+    db_session.commit()
+    assert db_session not in diagnostics.live_sessions
+    db_session.execute(text("SELECT 1"))
+    db_session.close()
+    assert db_session not in diagnostics.live_sessions
@@ -0,0 +1,207 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import app.database as database
+from app.auth import generate_access_token
+from app.config import Settings
+from app.database import Base
+from app.idempotency import IdempotencyMiddleware, claim, client_identity, idempotency_requests, key_digest, purge_expired, CLAIMED
+from app.models import IdempotencyKey, User
+
+engine = create_engine(
+    "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture
+def test_db(monkeypatch):
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(database, "SessionLocal", TestingSessionLocal)
+    db = TestingSessionLocal()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+def make_app(calls, release=None, **settings):
+    app = FastAPI()
+
+    @app.post("/items", status_code=201)
+    async def create_item(item: dict):
+        calls.append(item)
+        if release is not None:
+            await release.wait()
+        return {"id": len(calls), **item}
+
+    @app.post("/fails")
+    async def fails():
+        calls.append(None)
+        raise HTTPException(status_code=503, detail="Try again")
+
+    @app.post("/login")
+    async def login():
+        calls.append("login")
+        return {"access_token": str(len(calls))}
+
+    app.add_middleware(IdempotencyMiddleware, settings=Settings(**settings))
+    return app
+
+
+def run(app, scenario, address=("127.0.0.1", 123)):
+    async def with_client():
+        transport = httpx.ASGITransport(app=app, client=address)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await scenario(client)
+    return asyncio.run(with_client())
+
+
+def test_retry_replays_the_stored_response(test_db):
+    calls = []
+    replayed_before = idempotency_requests.get(outcome="replayed")
+
+    async def scenario(client):
+        headers = {"Idempotency-Key": "abc"}
+        first = await client.post("/items", json={"name": "Alien"}, headers=headers)
+        second = await client.post("/items", json={"name": "Alien"}, headers=headers)
+        other = await client.post("/items", json={"name": "Alien"}, headers={"Idempotency-Key": "def"})
+        return first, second, other
+
+    first, second, other = run(make_app(calls), scenario)
+    assert len(calls) == 2
+    assert first.status_code == second.status_code == 201
+    assert second.json() == first.json() == {"id": 1, "name": "Alien"}
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.headers["content-type"] == "application/json"
+    assert other.json()["id"] == 2
+    assert idempotency_requests.get(outcome="replayed") == replayed_before + 1
+
+
+def test_keys_are_scoped_to_the_client(test_db):
+    calls = []
+
+    async def scenario(client):
+        await client.post("/items", json={}, headers={"Idempotency-Key": "abc", "Authorization": "Bearer one"})
+        await client.post("/items", json={}, headers={"Idempotency-Key": "abc", "Authorization": "Bearer two"})
+
+    run(make_app(calls), scenario)
+    assert len(calls) == 2
+
+
+def test_keys_follow_the_user_not_the_token(test_db):
+    test_db.add(User(email="ann@example.com", username="ann", full_name="Ann", hashed_password="x"))
+    test_db.commit()
+    by_email = f"Bearer {generate_access_token(data={'sub': 'ann@example.com'})}"
+    by_username = f"Bearer {generate_access_token(data={'sub': 'ann'})}"
+    assert client_identity(by_email, None) == client_identity(by_username, None) == "user:1"
+    assert client_identity("Bearer invalid", None) == "token:Bearer invalid"
+
+    calls = []
+    app = make_app(calls)
+
+    async def scenario(client):
+        return await client.post("/items", json={}, headers={"Idempotency-Key": "abc"})
+
+    # Anonymous clients at different addresses never share a key
+    run(app, scenario, address=("10.0.0.1", 1))
+    run(app, scenario, address=("10.0.0.2", 1))
+    assert run(app, scenario, address=("10.0.0.1", 2)).headers["Idempotent-Replayed"] == "true"
+    assert len(calls) == 2
+
+
+def test_reused_key_with_another_body_is_rejected(test_db):
+    calls = []
+
+    async def scenario(client):
+        await client.post("/items", json={"name": "Alien"}, headers={"Idempotency-Key": "abc"})
+        return await client.post("/items", json={"name": "Aliens"}, headers={"Idempotency-Key": "abc"})
+
+    response = run(make_app(calls), scenario)
+    assert response.status_code == 422
+    assert len(calls) == 1
+
+
+def test_concurrent_duplicate_waits_for_the_original(test_db):
+    calls = []
+    release = asyncio.Event()
+
+    async def scenario(client):
+        headers = {"Idempotency-Key": "abc"}
+        first = asyncio.create_task(client.post("/items", json={"name": "Alien"}, headers=headers))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(client.post("/items", json={"name": "Alien"}, headers=headers))
+        await asyncio.sleep(0.05)
+        release.set()
+        return await first, await second
+
+    first, second = run(make_app(calls, release), scenario)
+    assert len(calls) == 1
+    assert second.json() == first.json()
+    assert second.headers["Idempotent-Replayed"] == "true"
+
+
+def test_duplicate_gives_up_waiting(test_db):
+    calls = []
+    release = asyncio.Event()
+
+    async def scenario(client):
+        headers = {"Idempotency-Key": "abc"}
+        first = asyncio.create_task(client.post("/items", json={}, headers=headers))
+        await asyncio.sleep(0.05)
+        second = await client.post("/items", json={}, headers=headers)
+        release.set()
+        return await first, second
+
+    first, second = run(make_app(calls, release, idempotency_wait_seconds=0.1), scenario)
+    assert first.status_code == 201
+    assert second.status_code == 409
+    assert len(calls) == 1
+
+
+def test_server_errors_release_the_key(test_db):
+    calls = []
+
+    async def scenario(client):
+        await client.post("/fails", headers={"Idempotency-Key": "abc"})
+        return await client.post("/fails", headers={"Idempotency-Key": "abc"})
+
+    response = run(make_app(calls), scenario)
+    assert response.status_code == 503
+    assert len(calls) == 2
+    assert test_db.query(IdempotencyKey).count() == 0
+
+
+def test_login_and_requests_without_a_key_always_run(test_db):
+    calls = []
+
+    async def scenario(client):
+        await client.post("/items", json={})
+        await client.post("/items", json={})
+        first = await client.post("/login", headers={"Idempotency-Key": "abc"})
+        second = await client.post("/login", headers={"Idempotency-Key": "abc"})
+        return first, second
+
+    first, second = run(make_app(calls), scenario)
+    assert len(calls) == 4
+    assert first.json() != second.json()
+
+
+def test_abandoned_and_expired_keys(test_db):
+    settings = Settings()
+    key = key_digest("", "POST", "/items", "abc")
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    test_db.add(IdempotencyKey(key=key, fingerprint=b"f" * 32, locked_until=past,
+                               expires_at=datetime.now(timezone.utc) + timedelta(hours=1)))
+    test_db.add(IdempotencyKey(key=b"k" * 32, fingerprint=b"f" * 32, status_code=201, body=b"",
+                               locked_until=past, expires_at=past))
+    test_db.commit()
+
+    # The request holding the first key died, a retry takes it over
+    assert claim(key, b"f" * 32, settings) == (CLAIMED, None)
+    assert purge_expired() == 1
+    assert test_db.query(IdempotencyKey).count() == 1
@@ -0,0 +1,101 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import app.database as database
+import app.invalidation as invalidation
+from app.cache import MISSING, LocalCache, rating_average_cache
+from app.crud import user_service
+from app.database import Base
+from app.models import CacheInvalidation, Movie, User
+
+# Create a mock SQLite database for testing
+engine = create_engine(
+    "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture
+def test_db(monkeypatch):
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(database, "SessionLocal", TestingSessionLocal)
+    db = TestingSessionLocal()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def received(monkeypatch):
+    changes = []
+    monkeypatch.setitem(invalidation.handlers, "test_entity", [(changes.append, True)])
+    return changes
+
+
+def test_committed_change_is_applied_locally_and_recorded(test_db):
+    rating_average_cache.for_bind(engine).set(7, 4.5)
+    invalidation.record_change(test_db, "rating", 1, movie_id=7)
+    test_db.commit()
+
+    assert rating_average_cache.for_bind(engine).get(7) is MISSING
+    row = test_db.query(CacheInvalidation).one()
+    assert (row.entity, row.entity_id, row.movie_id, row.origin) == ("rating", 1, 7, invalidation.ORIGIN)
+
+
+def test_rolled_back_change_is_not_applied(test_db, received):
+    invalidation.record_change(test_db, "test_entity", 1)
+    test_db.rollback()
+    assert received == []
+    assert test_db.query(CacheInvalidation).count() == 0
+
+
+def test_polling_applies_changes_from_other_workers(test_db, received):
+    test_db.add(CacheInvalidation(entity="test_entity", entity_id=1, origin=invalidation.ORIGIN))
+    test_db.add(CacheInvalidation(entity="test_entity", entity_id=2, origin="other-worker"))
+    test_db.commit()
+
+    last_id = invalidation.poll_once(0)
+    assert last_id == 2
+    assert [change["id"] for change in received] == [2]
+
+    # Nothing new since the last poll
+    assert invalidation.poll_once(last_id) == last_id
+    assert len(received) == 1
+
+
+def test_values_read_before_an_eviction_are_not_stored():
+    cache = LocalCache("test", max_entries=2)
+    version = cache.version()
+    cache.evict(1)
+    cache.set(1, "stale", version=version)
+    assert cache.get(1) is MISSING
+    cache.set(2, "fresh", version=version)
+    assert cache.get(2) == "fresh"
+
+    # Once the eviction of a key is forgotten, reads older than it are still refused
+    version = cache.version()
+    for key in (3, 4, 5):
+        cache.evict(key)
+    cache.set(3, "stale", version=version)
+    assert cache.get(3) is MISSING
+
+
+def test_rating_averages_are_cached_per_engine():
+    replica = create_engine("sqlite://")
+    rating_average_cache.for_bind(replica).set(8, 3.0)
+    assert rating_average_cache.for_bind(engine).get(8) is MISSING
+    rating_average_cache.evict(8)
+    assert rating_average_cache.for_bind(replica).get(8) is MISSING
+
+
+def test_deleting_a_user_notifies_for_its_movies(test_db):
+    owner = User(email="o@example.com", username="o", full_name="O", hashed_password="x")
+    test_db.add(owner)
+    test_db.flush()
+    test_db.add_all([Movie(title="Alien", genre="Horror", user_id=owner.id), Movie(title="Heat", genre="Crime")])
+    test_db.commit()
+
+    user_service.delete_user(test_db, owner.id)
+    rows = test_db.query(CacheInvalidation).all()
+    assert [(row.entity, row.entity_id, row.movie_id) for row in rows] == [("user", owner.id, 1)]
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from starlette.requests import Request
+from app.database import Base
+from app.live import Broker, SUBSCRIBER_QUEUE_SIZE, movie_feed
+from app.models import Movie
+from app.routers.live import stream_movie_activity
+
+
+def test_publish_fans_out_to_topic_subscribers():
+    async def scenario():
+        broker = Broker()
+        first = broker.subscribe(1)
+        second = broker.subscribe(1)
+        other = broker.subscribe(2)
+
+        broker.publish(1, {"type": "comment", "data": {"id": 1}})
+        assert (await first.get())["data"]["id"] == 1
+        assert (await second.get())["data"]["id"] == 1
+        assert other.queue.empty()
+
+        for subscription in (first, second, other):
+            subscription.close()
+        assert not broker.has_subscribers(1)
+        assert broker.topics == {}
+
+    asyncio.run(scenario())
+
+
+def test_publish_from_another_thread():
+    async def scenario():
+        broker = Broker()
+        subscription = broker.subscribe(1)
+        thread = threading.Thread(target=broker.publish, args=(1, {"type": "rating_average", "data": {}}))
+        thread.start()
+        event = await asyncio.wait_for(subscription.get(), timeout=1)
+        thread.join()
+        assert event["type"] == "rating_average"
+
+    asyncio.run(scenario())
+
+
+def test_slow_subscriber_drops_oldest_events():
+    async def scenario():
+        broker = Broker()
+        subscription = broker.subscribe(1)
+        for number in range(SUBSCRIBER_QUEUE_SIZE + 5):
+            broker.publish(1, {"type": "comment", "data": {"id": number}})
+        assert subscription.queue.qsize() == SUBSCRIBER_QUEUE_SIZE
+        assert (await subscription.get())["data"]["id"] == 5
+
+    asyncio.run(scenario())
+
+
+def test_publish_while_other_threads_subscribe():
+    async def scenario():
+        broker = Broker()
+        broker.subscribe(1)
+        stop = threading.Event()
+        errors = []
+
+        def publish():
+            try:
+                while not stop.is_set():
+                    broker.publish(1, {"type": "comment", "data": {}})
+            except Exception as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=publish)
+        thread.start()
+        for _ in range(2000):
+            broker.subscribe(1).close()
+            await asyncio.sleep(0)
+        stop.set()
+        thread.join()
+        assert errors == []
+
+    asyncio.run(scenario())
+
+
+def test_stream_subscribes_only_once_it_runs():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add(Movie(id=1, title="Alien", genre="Horror"))
+    db.commit()
+
+    async def scenario():
+        async def receive():
+            await asyncio.Event().wait()
+
+        request = Request({"type": "http", "method": "GET", "path": "/movies/1/live", "headers": []}, receive)
+        # The client went away before the response started, the stream is never iterated
+        response = await stream_movie_activity(1, request, db)
+        assert not movie_feed.has_subscribers(1)
+        stream = response.body_iterator
+        first = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0.01)
+        assert movie_feed.has_subscribers(1)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await stream.aclose()
+        assert not movie_feed.has_subscribers(1)
+
+    asyncio.run(scenario())
+    engine.dispose()
@@ -0,0 +1,44 @@
+import asyncio
+import httpx
+from fastapi import FastAPI
+from app.config import Settings
+from app.metrics import render_metrics
+from app.middleware import AdmissionControlMiddleware, admission_shed, classify_route
+
+
+def test_classify_route():
+    assert classify_route("POST", "/login") == "auth"
+    assert classify_route("POST", "/register/") == "auth"
+    assert classify_route("PUT", "/movies/1") == "write"
+    assert classify_route("GET", "/movies/1") == "read"
+
+
+def test_requests_over_budget_are_shed():
+    release = asyncio.Event()
+    app = FastAPI()
+
+    @app.get("/slow")
+    async def slow():
+        await release.wait()
+        return {"message": "Success"}
+
+    settings = Settings(admission_read_concurrency=1, admission_read_max_wait_seconds=0.05,
+                        admission_retry_after_seconds=3)
+    app.add_middleware(AdmissionControlMiddleware, settings=settings)
+    shed_before = admission_shed.get(route_class="read")
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            first = asyncio.create_task(client.get("/slow"))
+            await asyncio.sleep(0.01)
+            second = await client.get("/slow")
+            release.set()
+            return await first, second
+
+    first, second = asyncio.run(scenario())
+    assert first.status_code == 200
+    assert second.status_code == 503
+    assert second.headers["Retry-After"] == "3"
+    assert admission_shed.get(route_class="read") == shed_before + 1
+    assert 'checkflix_admission_shed_total{route_class="read"}' in render_metrics()
@@ -0,0 +1,136 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import app.schemas as schemas
+from app.crud import comment_crud_service, movie_card_crud_service, movie_crud_service, rating_crud_service, user_service
+from app.database import Base
+from app.models import MovieCard, OutboxEvent
+from app.movie_cards import check_cards, rebuild_cards, repair_cards
+from app.outbox import emit, relay
+
+engine = create_engine(
+    "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+def make_user(db, name):
+    return user_service.create_user(db, schemas.UserCreate(
+        email=f"{name}@example.com", username=name, full_name=name.title(), password="x"), hashed_password="x")
+
+
+def make_movie(db, owner, title="Alien"):
+    return movie_crud_service.create_movie(db, schemas.MovieCreate(title=title, genre="Horror", release_year=1979), owner.id)
+
+
+def is_consistent(report):
+    return not (report["missing"] or report["orphaned"] or report["mismatched"])
+
+
+def test_write_paths_maintain_the_card(test_db):
+    owner, fan = make_user(test_db, "owner"), make_user(test_db, "fan")
+    movie = make_movie(test_db, owner)
+    rating = rating_crud_service.rate_movie_by_id(test_db, schemas.RatingCreate(rating_value=6), fan.id, movie.id)
+    rating_crud_service.rate_movie_by_id(test_db, schemas.RatingCreate(rating_value=9), owner.id, movie.id)
+    comment = comment_crud_service.create_comment(test_db, schemas.CommentCreate(comment="Great"), movie.id, fan.id)
+    comment_crud_service.reply_comment(comment.id, test_db, schemas.CommentBase(comment="Agreed"), owner.id)
+
+    # Nothing is projected until the relay runs
+    assert movie_card_crud_service.get_movie_card(test_db, movie.id) is None
+    assert relay(test_db) == 5
+    card = movie_card_crud_service.get_movie_card(test_db, movie.id)
+    assert (card.title, card.owner_username, card.owner_full_name) == ("Alien", "owner", "Owner")
+    assert (card.rating_count, card.avg_rating, card.comment_count) == (2, 7.5, 2)
+
+    rating_crud_service.update_rating(test_db, schemas.RatingUpdate(rating_value=10), rating.id)
+    comment_crud_service.delete_comment(test_db, comment.id)
+    movie_crud_service.update_movie(test_db, schemas.MovieUpdate(title="Aliens"), movie.id)
+    user_service.update_user(test_db, owner.id, schemas.UserUpdate(full_name="The Owner"))
+    assert relay(test_db) == 4
+    test_db.expire_all()
+    card = movie_card_crud_service.get_movie_card(test_db, movie.id)
+    assert (card.title, card.owner_full_name) == ("Aliens", "The Owner")
+    assert (card.rating_count, card.avg_rating, card.comment_count) == (2, 9.5, 1)
+    assert is_consistent(check_cards(test_db))
+
+    rating_crud_service.delete_rating(test_db, rating.id)
+    movie_crud_service.delete_movie(test_db, movie.id)
+    relay(test_db)
+    assert test_db.query(MovieCard).count() == 0
+    assert test_db.query(OutboxEvent).count() == 0
+
+
+def test_deleted_owner_leaves_the_cards_consistent(test_db):
+    owner, fan = make_user(test_db, "owner"), make_user(test_db, "fan")
+    movie = make_movie(test_db, owner)
+    make_movie(test_db, fan, title="Heat")
+    relay(test_db)
+    user_service.delete_user(test_db, owner.id)
+    relay(test_db)
+    test_db.expire_all()
+
+    card = movie_card_crud_service.get_movie_card(test_db, movie.id)
+    assert (card.owner_id, card.owner_username, card.owner_full_name) == (None, None, None)
+    assert is_consistent(check_cards(test_db))
+
+
+def test_rolled_back_writes_emit_nothing(test_db):
+    emit(test_db, "movie_saved", 1)
+    test_db.rollback()
+    assert relay(test_db) == 0
+
+
+def test_cards_in_order_of_ids(test_db):
+    owner = make_user(test_db, "owner")
+    first, second = make_movie(test_db, owner, "Alien"), make_movie(test_db, owner, "Heat")
+    relay(test_db)
+    cards = movie_card_crud_service.get_movie_cards(test_db, [second.id, 99, first.id])
+    assert [card.title for card in cards] == ["Heat", "Alien"]
+
+
+def test_rebuild_replaces_cards_and_pending_events(test_db):
+    owner = make_user(test_db, "owner")
+    movie = make_movie(test_db, owner)
+    relay(test_db)
+    test_db.query(MovieCard).delete()
+    test_db.commit()
+    rating_crud_service.rate_movie_by_id(test_db, schemas.RatingCreate(rating_value=8), owner.id, movie.id)
+
+    # The rating's event is dropped, the rebuilt card already counts the rating
+    assert rebuild_cards(test_db) == 1
+    assert test_db.query(OutboxEvent).count() == 0
+    card = movie_card_crud_service.get_movie_card(test_db, movie.id)
+    assert (card.rating_count, card.rating_sum, card.avg_rating) == (1, 8, 8.0)
+    assert is_consistent(check_cards(test_db))
+
+
+def test_check_reports_and_repairs_drift(test_db):
+    owner = make_user(test_db, "owner")
+    drifted, missing, pending = (make_movie(test_db, owner, title) for title in ("Alien", "Heat", "Ran"))
+    relay(test_db)
+    test_db.get(MovieCard, drifted.id).comment_count = 5
+    test_db.query(MovieCard).filter(MovieCard.movie_id == missing.id).delete()
+    test_db.add(MovieCard(movie_id=404, title="Gone", genre="Drama", created_at=drifted.created_at))
+    test_db.commit()
+    comment_crud_service.create_comment(test_db, schemas.CommentCreate(comment="Soon"), pending.id, owner.id)
+
+    report = check_cards(test_db)
+    assert report["checked"] == 2 and report["skipped"] == 1
+    assert report["missing"] == [missing.id]
+    assert report["orphaned"] == [404]
+    assert report["mismatched"] == [{"movie_id": drifted.id, "fields": {"comment_count": [5, 0]}}]
+
+    repair_cards(test_db, report)
+    relay(test_db)
+    assert is_consistent(check_cards(test_db))
+    assert movie_card_crud_service.get_movie_card(test_db, pending.id).comment_count == 1
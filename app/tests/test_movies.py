@@ -1,12 +1,16 @@
+import msgpack
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from app.main import app
 from app.database import get_database_session
-from app.models import User
+from app.models import Movie, MovieGenre, User
 from app.auth import generate_access_token
 from app.logger import custom_logger
+from app.crud import genre_crud_service, movie_crud_service
+from app.movie_cards import rebuild_cards
+from sqlalchemy import event
 
 import os
 from app.tests.test_db import test_db
@@ -76,6 +80,48 @@ def test_get_movie_by_id(client, setup_movies):
     movie = response.json()
     assert movie["title"] == "Action Man"
 
+def test_get_movie_cards(client, test_db, setup_movies):
+    # The seeded movie predates the outbox, the rebuild makes every card
+    rebuild_cards(test_db)
+    response = client.get("/movies/2/card")
+    assert response.status_code == 200
+    card = response.json()
+    assert (card["title"], card["rating_count"], card["avg_rating"], card["comment_count"]) == ("Action Man", 0, 0.0, 0)
+    assert card["owner_username"] == test_db.query(User).first().username
+
+    response = client.get("/movies/cards?ids=3,2")
+    assert [card["title"] for card in response.json()] == ["Tree", "Action Man"]
+    assert client.get("/movies/999/card").status_code == 404
+
+
+def test_get_movies_by_ids(client, setup_movies):
+    response = client.get("/movies/?ids=3,99,2")
+    assert response.status_code == 200
+    movies = response.json()
+    assert [movie["id"] for movie in movies] == [3, 2]
+
+    response = client.get("/movies/?ids=1,abc")
+    assert response.status_code == 422
+
+def test_movie_lookups_are_batched(test_db, setup_movies):
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    test_db.commit()
+    event.listen(test_db.get_bind(), "before_cursor_execute", count_statement)
+    try:
+        movies = movie_crud_service.get_movies_by_ids(test_db, [1, 2, 3])
+        assert movie_crud_service.get_movie_by_id(test_db, 2) is movies[1]
+        assert movie_crud_service.get_movie_by_id(test_db, "3") is movies[2]
+        assert movie_crud_service.get_movie_by_id(test_db, 99) is None
+        assert movie_crud_service.get_movie_by_id(test_db, 99) is None
+    finally:
+        event.remove(test_db.get_bind(), "before_cursor_execute", count_statement)
+    # One IN query for the batch and one for the missing movie
+    assert len(statements) == 2
+
 def test_get_movie_by_genre(client, setup_movies):
     response = client.get("/movies/genre/Action")
     assert response.status_code == 200
@@ -97,6 +143,13 @@ def test_create_movie(client, auth_token):
     movie = response.json()
     assert movie["title"] == "Superhero"
 
+def test_get_similar_movies_by_content(client, setup_movies):
+    response = client.get("/movies/4/similar?source=content")
+    assert response.status_code == 200
+    similar = response.json()
+    assert similar[0]["movie"]["title"] == "Action Man"
+
+
 def test_update_movie(client, setup_movies, auth_token):
     updated_movie = {"title": "Action Man Updated", "genre": "Action", "description": "Updated description."}
     response = client.put("/movies/2", json=updated_movie, headers={"Authorization": auth_token})
@@ -112,3 +165,81 @@ def test_delete_movie(client, setup_movies, auth_token):
     # Verify that the movie was deleted
     response = client.get("/movies/2")
     assert response.status_code == 404
+
+def test_get_movies_as_msgpack(client, setup_movies):
+    json_response = client.get("/movies/?offset=0&limit=10")
+    response = client.get("/movies/?offset=0&limit=10", headers={"Accept": "application/msgpack"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/msgpack"
+    assert response.headers["vary"] == "Accept"
+    assert msgpack.unpackb(response.content) == json_response.json()
+
+def test_filter_and_sort_movies(client, auth_token):
+    for title, genre, year in [("Rio Bravo", "Western", 1959), ("Unforgiven", "Western", 1992),
+                               ("Laura", "Noir", 1944), ("Chinatown", "Noir", 1974)]:
+        response = client.post("/movies/", json={"title": title, "genre": genre, "release_year": year},
+                               headers={"Authorization": auth_token})
+        assert response.status_code == 201
+
+    response = client.get("/movies/?genre=Western,Noir&year_from=1950&sort=-release_year")
+    assert response.status_code == 200
+    assert [movie["title"] for movie in response.json()] == ["Unforgiven", "Chinatown", "Rio Bravo"]
+
+    response = client.get("/movies/?genre=Noir&year_to=1950")
+    assert [movie["title"] for movie in response.json()] == ["Laura"]
+
+    response = client.get("/movies/?genre=Western&sort=title&limit=1&offset=1")
+    assert [movie["title"] for movie in response.json()] == ["Unforgiven"]
+
+    # Movies without ratings have no average and are left out by min_rating
+    response = client.get("/movies/?genre=Western&min_rating=1")
+    assert response.json() == []
+
+    response = client.get("/movies/?sort=-password")
+    assert response.status_code == 422
+
+
+def test_genres_are_canonical_and_counted(client, auth_token):
+    for title, genre in [("Detour", "Film Noir"), ("Gilda", " film  noir"), ("Vertigo", "Thriller, FILM NOIR")]:
+        response = client.post("/movies/", json={"title": title, "genre": genre}, headers={"Authorization": auth_token})
+        assert response.status_code == 201
+    assert response.json()["genre"] == "Thriller, Film Noir"
+
+    response = client.get("/movies/genre/film noir?count=true")
+    assert [movie["title"] for movie in response.json()] == ["Detour", "Gilda", "Vertigo"]
+    assert response.headers["x-total-count"] == "3"
+
+    response = client.get("/movies/?genre=thriller&title=Vertigo")
+    assert [movie["title"] for movie in response.json()] == ["Vertigo"]
+
+    genres = {genre["name"]: genre["movie_count"] for genre in client.get("/movies/genres").json()}
+    assert genres["Film Noir"] == 3
+
+    movie_id = response.json()[0]["id"]
+    client.put(f"/movies/{movie_id}", json={"genre": "Thriller"}, headers={"Authorization": auth_token})
+    genres = {genre["name"]: genre["movie_count"] for genre in client.get("/movies/genres").json()}
+    assert genres["Film Noir"] == 2
+
+
+def test_migrate_movies_links_existing_genres(test_db):
+    test_db.add(Movie(title="Legacy", genre="drama ", user_id=1))
+    test_db.commit()
+
+    # The fixture data was inserted without genres too
+    assert genre_crud_service.migrate_movies(test_db) >= 1
+    movie = test_db.query(Movie).filter(Movie.title == "Legacy").one()
+    assert movie.genre == "Drama"
+    assert [genre.key for genre in movie.genres] == ["drama"]
+    assert genre_crud_service.get_genre(test_db, "DRAMA").movie_count == test_db.query(MovieGenre).filter(
+        MovieGenre.genre_id == movie.genres[0].id).count()
+    assert genre_crud_service.migrate_movies(test_db) == 0
+
+
+def test_get_or_create_genres_reads_back_existing_keys(test_db):
+    created = genre_crud_service.get_or_create_genres(test_db, ["Space Opera", "Drama"])
+    test_db.commit()
+    # Inserting a key that is already there is skipped, not an error
+    again = genre_crud_service.get_or_create_genres(test_db, ["space  opera", "Mumblecore"])
+    test_db.commit()
+    assert again[0].id == created[0].id
+    assert [genre.name for genre in again] == ["Space Opera", "Mumblecore"]
@@ -0,0 +1,131 @@
+from datetime import date
+from types import SimpleNamespace
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
+import app.config as config
+import app.models as models
+from app.config import Settings
+from app.crud import count_crud_service, movie_crud_service
+from app.database import Base
+from app.partitions import (
+    add_months, archive_partitions, create_partitioned_tables, ensure_partitions, maintain_partitions,
+    month_partition_name, partition_month, partitioned_table, PARTITIONED_MODELS,
+)
+
+
+def ddl(table):
+    return str(CreateTable(table).compile(dialect=postgresql.dialect()))
+
+
+def test_time_partitioned_ddl():
+    statement = ddl(partitioned_table(models.Comment.__table__, "time"))
+    assert "PRIMARY KEY (id, created_at)" in statement
+    assert "PARTITION BY RANGE (created_at)" in statement
+    # Nothing can reference a partitioned table by id alone
+    assert "REFERENCES comments" not in statement
+    assert "REFERENCES movies (id)" in statement
+
+
+def test_hash_partitioned_ddl():
+    table = partitioned_table(models.Rating.__table__, "movie")
+    statement = ddl(table)
+    assert "PRIMARY KEY (id, movie_id)" in statement
+    assert "movie_id INTEGER NOT NULL" in statement
+    assert "PARTITION BY HASH (movie_id)" in statement
+    assert {index.name for index in table.indexes} == {index.name for index in models.Rating.__table__.indexes}
+
+
+def test_models_keep_their_tables():
+    partitioned_table(models.Comment.__table__, "time")
+    assert list(models.Comment.__table__.primary_key.columns.keys()) == ["id"]
+    assert any(key.column.table is models.Comment.__table__ for key in models.Comment.__table__.foreign_keys)
+
+
+def test_month_helpers():
+    assert add_months(date(2024, 11, 1), 3) == date(2025, 2, 1)
+    assert add_months(date(2024, 1, 1), -1) == date(2023, 12, 1)
+    assert month_partition_name("ratings", date(2024, 7, 1)) == "ratings_p2024_07"
+    assert partition_month("ratings_p2024_07") == date(2024, 7, 1)
+    assert partition_month("ratings_h3") is None
+
+
+def test_sqlite_keeps_plain_tables(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'plain.db'}")
+    settings = Settings(partitioning="time")
+    assert create_partitioned_tables(engine, settings) == []
+    assert maintain_partitions(engine, settings) == ([], [])
+    engine.dispose()
+
+
+class FakeConnection:
+    # Answers the catalog queries of app.partitions and records the DDL it is sent
+
+    dialect = SimpleNamespace(name="postgresql")
+
+    def __init__(self, partitions):
+        self.partitions = partitions
+        self.statements = []
+
+    def execute(self, statement, parameters=None):
+        sql = str(statement)
+        if "pg_partitioned_table" in sql:
+            return SimpleNamespace(scalar=lambda: True)
+        if "pg_inherits" in sql:
+            names = sorted(self.partitions[parameters["table"]])
+            return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: names))
+        self.statements.append(sql)
+        return None
+
+
+def test_ensure_creates_missing_months():
+    connection = FakeConnection({"ratings": {"ratings_p2024_07"}, "comments": set()})
+    created = ensure_partitions(connection, Settings(partitioning="time", partition_months_ahead=1), today=date(2024, 7, 15))
+    assert created == ["ratings_p2024_08", "comments_p2024_07", "comments_p2024_08"]
+    assert "FOR VALUES FROM ('2024-08-01 00:00:00+00') TO ('2024-09-01 00:00:00+00')" in connection.statements[0]
+
+
+def test_archive_detaches_old_months():
+    connection = FakeConnection({
+        "ratings": {"ratings_p2024_05", "ratings_p2024_06", "ratings_p2024_07"},
+        "comments": {"comments_p2024_06"},
+    })
+    assert archive_partitions(connection, date(2024, 7, 1)) == ["ratings_p2024_05", "ratings_p2024_06", "comments_p2024_06"]
+    assert connection.statements[0] == "ALTER TABLE ratings DETACH PARTITION ratings_p2024_05"
+
+
+def test_delete_movie_with_movie_partitions(tmp_path):
+    # The partitioned tables' NOT NULL movie_id, on SQLite, refuses the ORM's SET NULL of the children
+    engine = create_engine(f"sqlite:///{tmp_path / 'hash.db'}")
+    partitioned = {model.__tablename__ for model in PARTITIONED_MODELS}
+    Base.metadata.create_all(engine, tables=[table for table in Base.metadata.sorted_tables if table.name not in partitioned])
+    for model in PARTITIONED_MODELS:
+        table = partitioned_table(model.__table__, "movie")
+        # SQLite has no autoincrement on a composite key, the rows below set their ids
+        table.c.id.autoincrement = False
+        table.create(engine)
+    previous = config.current_settings
+    config.configure(Settings(partitioning="movie"))
+    db = sessionmaker(autoflush=False, bind=engine)()
+    try:
+        db.add(models.User(id=1, email="a@example.com", username="a", full_name="A", hashed_password="x"))
+        db.add_all([models.Movie(id=1, title="Alien", genre="Horror", user_id=1),
+                    models.Movie(id=2, title="Heat", genre="Crime", user_id=1)])
+        db.add_all([models.Rating(id=1, movie_id=1, user_id=1, rating_value=8),
+                    models.Rating(id=2, movie_id=2, user_id=1, rating_value=6)])
+        db.add_all([models.Comment(id=1, movie_id=1, user_id=1, comment="Great"),
+                    models.Comment(id=2, movie_id=1, user_id=1, comment="Agreed", parent_id=1)])
+        db.commit()
+        # The user's rating counter starts from the two ratings
+        count_crud_service.change_count(db, "user", 1, "ratings", 0)
+        db.commit()
+
+        movie_crud_service.delete_movie(db, 1)
+        assert db.query(models.Rating.id).all() == [(2,)]
+        assert db.query(models.Comment).count() == 0
+        assert count_crud_service.get_count(db, "user", 1, "ratings") == 1
+    finally:
+        db.close()
+        config.configure(previous)
+        engine.dispose()
@@ -0,0 +1,115 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import app.config as config
+from app.auth import verify_user_credentials
+from app.config import Settings
+from app.crud import user_service
+from app.database import Base, get_database_session
+from app.main import app
+from app.passwords import build_password_context, calibrate, get_password_context
+from app.schemas import UserCreate
+
+# One shared connection, login verifies passwords in a worker thread
+engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Cheap costs, the tests hash a lot
+FAST = dict(bcrypt_rounds=5, argon2_time_cost=1, argon2_memory_kib=1024, argon2_parallelism=1)
+
+
+@pytest.fixture
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def use_settings():
+    previous = config.current_settings
+
+    def use(**values):
+        return config.configure(Settings(**{**FAST, **values}))
+
+    yield use
+    config.configure(previous)
+
+
+@pytest.fixture
+def client(test_db):
+    app.dependency_overrides[get_database_session] = lambda: test_db
+    yield TestClient(app)
+    app.dependency_overrides.pop(get_database_session, None)
+
+
+def create_user(db, hashed_password: str):
+    user = UserCreate(username="hasher", email="hasher@example.com", full_name="Hash Er", password="secret")
+    return user_service.create_user(db, user, hashed_password=hashed_password)
+
+
+def test_login_upgrades_bcrypt_cost(client, test_db, use_settings):
+    old_hash = build_password_context(Settings(**{**FAST, "bcrypt_rounds": 4})).hash("secret")
+    user = create_user(test_db, old_hash)
+    use_settings(bcrypt_rounds=5)
+
+    response = client.post("/login", data={"username": "hasher", "password": "secret"})
+    assert response.status_code == 200
+    test_db.refresh(user)
+    assert user.hashed_password.startswith("$2b$05$")
+    assert not get_password_context().needs_update(user.hashed_password)
+
+
+def test_login_migrates_bcrypt_to_argon2(test_db, use_settings):
+    use_settings(password_scheme="bcrypt")
+    user = create_user(test_db, get_password_context().hash("secret"))
+
+    use_settings(password_scheme="argon2")
+    assert verify_user_credentials(test_db, "hasher", "secret") is user
+    test_db.refresh(user)
+    assert user.hashed_password.startswith("$argon2id$")
+    upgraded = user.hashed_password
+
+    # Already current, nothing is rewritten
+    assert verify_user_credentials(test_db, "hasher@example.com", "secret") is user
+    test_db.refresh(user)
+    assert user.hashed_password == upgraded
+
+
+def test_argon2_cost_change_is_an_update(use_settings):
+    use_settings(password_scheme="argon2")
+    hashed_password = get_password_context().hash("secret")
+    use_settings(password_scheme="argon2", argon2_time_cost=2)
+    assert get_password_context().needs_update(hashed_password)
+
+
+def test_failed_login_keeps_the_hash(test_db, use_settings):
+    use_settings(bcrypt_rounds=4)
+    user = create_user(test_db, get_password_context().hash("secret"))
+    old_hash = user.hashed_password
+
+    use_settings(bcrypt_rounds=5)
+    assert verify_user_credentials(test_db, "hasher", "wrong") is False
+    assert verify_user_credentials(test_db, "nobody", "secret") is False
+    test_db.refresh(user)
+    assert user.hashed_password == old_hash
+
+
+def test_unknown_hash_format_is_rejected(test_db, use_settings):
+    use_settings()
+    create_user(test_db, "fakehashedpassword")
+    assert verify_user_credentials(test_db, "hasher", "secret") is False
+
+
+def test_calibrate_stays_within_target(use_settings):
+    settings = use_settings()
+    costs, seconds = calibrate(settings, target_seconds=0.05, samples=1)
+    assert 4 <= costs["bcrypt_rounds"] <= 31
+    assert seconds <= 0.05 or costs["bcrypt_rounds"] == 4
+
+    costs, seconds = calibrate(settings.model_copy(update={"password_scheme": "argon2"}), target_seconds=0.01, samples=1)
+    assert costs["argon2_time_cost"] >= 1
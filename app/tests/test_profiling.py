@@ -0,0 +1,79 @@
+import os
+import time
+from fastapi import APIRouter, FastAPI
+from fastapi.testclient import TestClient
+from app.config import Settings
+from app.profiling import ProfilingMiddleware, write_profile
+from app.serialization import SerializedRoute
+
+
+def busy(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def make_client(directory, **values):
+    router = APIRouter(route_class=SerializedRoute)
+
+    @router.get("/sync/{item_id}")
+    def sync_endpoint(item_id: int):
+        busy(0.05)
+        return {"item_id": item_id}
+
+    @router.get("/async")
+    async def async_endpoint():
+        busy(0.05)
+        return {"ok": True}
+
+    settings = Settings(profiling_dir=str(directory), profiling_interval_ms=1, **values)
+    app = FastAPI()
+    app.include_router(router)
+    app.add_middleware(ProfilingMiddleware, settings=settings)
+    return TestClient(app)
+
+
+def read_profiles(directory):
+    return {name: open(os.path.join(directory, name)).read() for name in os.listdir(directory)}
+
+
+def test_token_profiles_threadpool_endpoint(tmp_path):
+    client = make_client(tmp_path, profiling_token="secret")
+    assert client.get("/sync/1", headers={"X-Profile": "secret"}).status_code == 200
+
+    profiles = read_profiles(tmp_path)
+    assert len(profiles) == 1
+    name, content = profiles.popitem()
+    assert "-GET-sync_item_id-" in name and name.endswith(".folded")
+    lines = content.splitlines()
+    assert any("sync_endpoint;" in line and "busy" in line for line in lines)
+    # Folded format: stack, a space, the sample count
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0 and ";" in stack
+
+
+def test_token_profiles_event_loop_endpoint(tmp_path):
+    client = make_client(tmp_path, profiling_token="secret")
+    client.get("/async", headers={"X-Profile": "secret"})
+    (content,) = read_profiles(tmp_path).values()
+    assert "async_endpoint" in content
+
+
+def test_requests_are_not_profiled_without_token(tmp_path):
+    client = make_client(tmp_path, profiling_token="secret")
+    client.get("/sync/1")
+    client.get("/sync/1", headers={"X-Profile": "wrong"})
+    assert not os.path.exists(tmp_path) or not os.listdir(tmp_path)
+
+
+def test_sample_rate(tmp_path):
+    client = make_client(tmp_path, profiling_sample_rate=1.0)
+    client.get("/sync/2")
+    assert len(read_profiles(tmp_path)) == 1
+
+
+def test_profiles_are_pruned(tmp_path):
+    for index in range(5):
+        write_profile(str(tmp_path), f"{index}.folded", "a;b 1\n", max_files=3)
+        os.utime(tmp_path / f"{index}.folded", (index, index))
+    assert sorted(os.listdir(tmp_path)) == ["2.folded", "3.folded", "4.folded"]
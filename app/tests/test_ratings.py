@@ -1,11 +1,14 @@
+from datetime import datetime, timedelta, timezone
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from app.main import app
 from app.database import get_database_session, Base
-from app.models import User, Movie, Rating
+from app.models import User, Movie, MovieRanking, Rating
 from app.auth import generate_access_token
+import app.crud as crud
+from app.crud import ranking_crud_service
 import os
 from app.tests.test_db import test_db
 
@@ -81,6 +84,36 @@ def test_get_ratings_by_movie_id(client, auth_token):
     assert ratings[0]["rating_value"] == 5
 
 
+def test_get_ratings_with_sparse_fields(client, test_db):
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    test_db.commit()
+    event.listen(test_db.get_bind(), "before_cursor_execute", record_statement)
+    try:
+        response = client.get("/movies/ratings/movie_id/1?fields=rating_value,user.username")
+    finally:
+        event.remove(test_db.get_bind(), "before_cursor_execute", record_statement)
+    assert response.status_code == 200
+    assert response.json()[0] == {"rating_value": 5, "user": {"username": response.json()[0]["user"]["username"]}}
+
+    # Only the requested columns are selected
+    rating_query = next(statement for statement in statements if "FROM ratings" in statement)
+    user_query = next(statement for statement in statements if "FROM users" in statement)
+    assert "ratings.created_at" not in rating_query
+    assert "users.username" in user_query and "users.full_name" not in user_query
+
+    response = client.get("/movies/ratings/?fields=rating_value")
+    assert list(response.json()[0]) == ["rating_value"]
+
+
+def test_get_ratings_with_unknown_field(client):
+    response = client.get("/movies/ratings/?fields=rating_value,user.password")
+    assert response.status_code == 422
+
+
 def test_get_movie_avg_rating(client, auth_token):
     response = client.get("/movies/ratings/average_rating/1", headers={"Authorization": auth_token})
     assert response.status_code == 200
@@ -89,6 +122,31 @@ def test_get_movie_avg_rating(client, auth_token):
     assert data["data"]["avg_rating"] == 5
 
 
+def test_get_movies_avg_rating(client):
+    response = client.get("/movies/ratings/average_rating?ids=1,99")
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert len(data) == 1
+    assert data[0]["avg_rating"] == 5
+
+
+def test_top_and_trending_movies(client, test_db):
+    ranking_crud_service.refresh_rankings(test_db)
+
+    response = client.get("/movies/top")
+    assert response.status_code == 200
+    movies = response.json()
+    assert movies[0]["id"] == 1
+    assert movies[0]["avg_rating"] == 5
+    assert movies[0]["rating_count"] == 1
+
+    response = client.get("/movies/trending")
+    assert response.status_code == 200
+    movies = response.json()
+    assert movies[0]["id"] == 1
+    assert movies[0]["trending_score"] == 5
+
+
 def test_update_rating(client, auth_token):
     updated_rating_data = {
         "rating_value": 4
@@ -108,3 +166,41 @@ def test_delete_rating(client, auth_token):
     response = client.delete("/movies/ratings/1", headers={"Authorization": auth_token})
     assert response.status_code == 200
     assert response.json()["message"] == "Success"
+
+
+def test_trending_refresh_is_incremental(test_db):
+    movie = Movie(title="Heat", genre="Crime")
+    test_db.add(movie)
+    test_db.commit()
+    # Marking twice updates the row the first call inserted
+    ranking_crud_service.mark_dirty(test_db, movie.id)
+    ranking_crud_service.mark_dirty(test_db, movie.id)
+    test_db.add(Rating(rating_value=7, user_id=1, movie_id=movie.id))
+    test_db.commit()
+    ranking_crud_service.refresh_rankings(test_db, full=True)
+    assert test_db.get(MovieRanking, movie.id).trending_score == 7
+
+    # The rating leaves the window without a write marking the movie dirty
+    window = timedelta(hours=crud.get_settings().trending_window_hours)
+    crud.trending_cutoff = datetime.now(timezone.utc) - window - timedelta(hours=1)
+    test_db.query(Rating).filter(Rating.movie_id == movie.id).update(
+        {"created_at": datetime.now(timezone.utc) - window - timedelta(minutes=30)})
+    test_db.commit()
+    ranking_crud_service.refresh_rankings(test_db)
+    test_db.expire_all()
+    assert test_db.get(MovieRanking, movie.id).trending_score == 0
+
+
+def test_counter_upsert_increments(test_db):
+    movie = Movie(title="Ronin", genre="Crime")
+    test_db.add(movie)
+    test_db.commit()
+    counts = crud.count_crud_service
+    # The first change creates the counter from the rows there, later ones add to it
+    test_db.add(Rating(rating_value=6, user_id=1, movie_id=movie.id))
+    counts.change_count(test_db, "movie", movie.id, "ratings", 1)
+    assert counts.get_count(test_db, "movie", movie.id, "ratings") == 1
+    test_db.add(Rating(rating_value=8, user_id=2, movie_id=movie.id))
+    counts.change_count(test_db, "movie", movie.id, "ratings", 1)
+    test_db.commit()
+    assert counts.get_count(test_db, "movie", movie.id, "ratings") == 2
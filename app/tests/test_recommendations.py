@@ -0,0 +1,134 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import app.recommendations as recommendations
+from app.config import Settings
+from app.database import Base
+from app.models import User, Movie, Rating, SimilarityChange
+from app.recommendations import SimilarityIndex, build_lock, read_version, refresh_similarity_index
+
+# Create a mock SQLite database for testing
+SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:?check_same_thread=False"
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture(scope="module")
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+
+    # Users 1 and 2 like movies 1 and 2 together, user 3 only rated movie 3
+    for user_id in (1, 2, 3):
+        db.add(User(id=user_id, username=f"user{user_id}", email=f"user{user_id}@example.com",
+                    full_name="Test User", hashed_password="fakehashedpassword"))
+    for movie_id in (1, 2, 3, 4):
+        db.add(Movie(id=movie_id, title=f"Movie {movie_id}", genre="Drama"))
+    db.add_all([
+        Rating(id=1, user_id=1, movie_id=1, rating_value=9),
+        Rating(id=2, user_id=1, movie_id=2, rating_value=8),
+        Rating(id=3, user_id=2, movie_id=1, rating_value=7),
+        Rating(id=4, user_id=2, movie_id=2, rating_value=9),
+        Rating(id=5, user_id=3, movie_id=3, rating_value=6),
+    ])
+    db.commit()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+def test_similar_movies(test_db):
+    index = SimilarityIndex.build(test_db, k=5)
+    similar = index.similar(1)
+    assert [movie_id for movie_id, _ in similar] == [2]
+    assert similar[0][1] > 0.9
+    assert index.similar(3) == []
+    assert index.similar(99) == []
+
+
+def test_recommendations_skip_rated_movies(test_db):
+    index = SimilarityIndex.build(test_db, k=5)
+    assert [movie_id for movie_id, _ in index.recommend({1: 8})] == [2]
+    assert index.recommend({1: 8, 2: 9}) == []
+
+
+def test_save_and_load_memory_mapped(test_db, tmp_path):
+    index = SimilarityIndex.build(test_db, k=5)
+    for _ in range(3):
+        index.save(str(tmp_path))
+
+    loaded = SimilarityIndex.load(str(tmp_path))
+    assert loaded.similar(1) == index.similar(1)
+    assert loaded.last_rating_id == 5
+    assert loaded.version == index.version
+    # Versions older than the one the pointer moved from are cleaned up
+    assert len([entry for entry in tmp_path.iterdir() if entry.is_dir()]) == 2
+
+
+def test_one_builder_at_a_time(tmp_path):
+    with build_lock(str(tmp_path)) as first:
+        with build_lock(str(tmp_path)) as second:
+            assert first and not second
+    with build_lock(str(tmp_path)) as again:
+        assert again
+
+
+def test_incremental_refresh(test_db):
+    index = SimilarityIndex.build(test_db, k=5)
+
+    # User 3 now also rates movie 4, linking it to movie 3
+    test_db.add(Rating(id=6, user_id=3, movie_id=4, rating_value=6))
+    test_db.commit()
+
+    refreshed = index.refresh(test_db)
+    assert refreshed.last_rating_id == 6
+    assert [movie_id for movie_id, _ in refreshed.similar(4)] == [3]
+    assert [movie_id for movie_id, _ in refreshed.similar(3)] == [4]
+    assert refreshed.similar(1) == index.similar(1)
+    assert refreshed.refresh(test_db) is refreshed
+
+
+def assert_same_neighbours(index, built):
+    for movie_id in (1, 2, 3, 4):
+        assert [neighbour for neighbour, _ in index.similar(movie_id)] == [neighbour for neighbour, _ in built.similar(movie_id)]
+        assert [score for _, score in index.similar(movie_id)] == pytest.approx([score for _, score in built.similar(movie_id)])
+
+
+def test_refresh_applies_changed_and_deleted_ratings(test_db):
+    index = SimilarityIndex.build(test_db, k=5)
+
+    # User 1 changes their mind about movie 2, which moves its similarity with movie 1
+    test_db.get(Rating, 2).rating_value = 1
+    test_db.add(SimilarityChange(movie_id=2))
+    test_db.commit()
+    refreshed = index.refresh(test_db)
+    assert refreshed.last_change_id > index.last_change_id
+    assert_same_neighbours(refreshed, SimilarityIndex.build(test_db, k=5))
+
+    # Without raters left, movie 2 is nobody's neighbour
+    test_db.query(Rating).filter(Rating.movie_id == 2).delete()
+    test_db.add(SimilarityChange(movie_id=2))
+    test_db.commit()
+    refreshed = refreshed.refresh(test_db)
+    assert refreshed.similar(1) == []
+    assert_same_neighbours(refreshed, SimilarityIndex.build(test_db, k=5))
+
+
+def test_refresh_job_publishes_and_purges_changes(test_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(recommendations, "get_settings", lambda: Settings(recommendation_index_dir=str(tmp_path)))
+    monkeypatch.setattr(recommendations, "similarity_index", None)
+    index = refresh_similarity_index(test_db)
+    assert index.version == read_version(str(tmp_path))
+
+    test_db.add(SimilarityChange(movie_id=1))
+    test_db.commit()
+    refreshed = refresh_similarity_index(test_db)
+    assert refreshed.version != index.version
+    assert test_db.query(SimilarityChange).count() == 0
+
+    # A worker that doesn't get the build lock serves the published index
+    monkeypatch.setattr(recommendations, "similarity_index", None)
+    with build_lock(str(tmp_path)):
+        assert refresh_similarity_index(test_db).version == refreshed.version
@@ -0,0 +1,82 @@
+from datetime import datetime, timezone
+import msgpack
+import orjson
+from fastapi import APIRouter, FastAPI, Request, Response
+from fastapi.testclient import TestClient
+import app.schemas as schemas
+from app.serialization import (
+    JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE, SPARSE_CACHE_SIZE, SerializedRoute, get_serializer, negotiate_media_type,
+    parse_fields, sparse_model,
+)
+
+
+class MovieRow:
+    # Stands in for an ORM row
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+def test_negotiate_media_type():
+    assert negotiate_media_type(None) == JSON_MEDIA_TYPE
+    assert negotiate_media_type("*/*") == JSON_MEDIA_TYPE
+    assert negotiate_media_type("application/msgpack") == MSGPACK_MEDIA_TYPE
+    assert negotiate_media_type("application/x-msgpack") == MSGPACK_MEDIA_TYPE
+    assert negotiate_media_type("application/json, application/msgpack") == JSON_MEDIA_TYPE
+    assert negotiate_media_type("application/json;q=0.5, application/msgpack") == MSGPACK_MEDIA_TYPE
+    assert negotiate_media_type("application/msgpack;q=0, */*") == JSON_MEDIA_TYPE
+    assert negotiate_media_type("text/html") == JSON_MEDIA_TYPE
+
+
+def test_serializer_is_built_once_per_model():
+    assert get_serializer(schemas.Movie) is get_serializer(schemas.Movie)
+
+
+def test_serializer_encodes_orm_rows():
+    created_at = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+    row = MovieRow(id=1, title="Tree", genre="Drama", description=None,
+                   release_year=2001, created_at=created_at, user_id=3)
+    serializer = get_serializer(list[schemas.Movie])
+
+    as_json = orjson.loads(serializer.encode([row], JSON_MEDIA_TYPE))
+    as_msgpack = msgpack.unpackb(serializer.encode([row], MSGPACK_MEDIA_TYPE))
+
+    assert as_json == [{
+        "id": 1, "title": "Tree", "genre": "Drama", "description": None,
+        "release_year": 2001, "created_at": "2024-05-01T12:30:00Z",
+    }]
+    assert as_msgpack == as_json
+
+
+def test_fieldsets_are_canonical():
+    fields = parse_fields("user.username,rating_value,id,rating_value", schemas.Rating)
+    assert fields == (("rating_value", None), ("id", None), ("user", (("username", None),)))
+    assert parse_fields("id,user.username,rating_value", schemas.Rating) == fields
+    assert sparse_model(list[schemas.Rating], fields) is sparse_model(list[schemas.Rating], parse_fields("rating_value,user.username,id", schemas.Rating))
+    assert sparse_model.cache_info().maxsize == SPARSE_CACHE_SIZE
+    assert get_serializer.cache_info().maxsize is not None
+
+
+def test_serialized_route_applies_the_sub_response():
+    router = APIRouter(route_class=SerializedRoute)
+
+    @router.get("/created", response_model=schemas.Genre)
+    async def created(response: Response):
+        response.status_code = 201
+        response.headers["X-Trace"] = "1"
+        return {"id": 1, "name": "Drama", "movie_count": 2}
+
+    @router.get("/returned")
+    def returned(request: Request, response: Response):
+        # The endpoint's own Response keeps its status
+        response.status_code = 201
+        return Response(request.url.path, status_code=202)
+
+    app = FastAPI()
+    app.include_router(router)
+    client = TestClient(app)
+    response = client.get("/created", headers={"Accept": "application/msgpack"})
+    assert (response.status_code, response.headers["x-trace"]) == (201, "1")
+    assert msgpack.unpackb(response.content) == {"id": 1, "name": "Drama", "movie_count": 2}
+    response = client.get("/returned")
+    assert (response.status_code, response.text) == (202, "/returned")
+    assert "serialization_request" not in str(app.openapi())
@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from app.cache import rating_average_cache
+from app.crud import get_average_rating_shared
+from app.database import Base
+from app.metrics import render_metrics
+from app.models import Movie, Rating, User
+from app.singleflight import SingleFlight, singleflight_calls
+
+
+def blocking_read(started, release, result="movie"):
+    calls = []
+
+    def read(movie_id):
+        calls.append(movie_id)
+        started.set()
+        release.wait(5)
+        return f"{result} {movie_id}"
+
+    return read, calls
+
+
+def test_overlapping_reads_share_one_call():
+    flights = SingleFlight("test_shared")
+    started, release = threading.Event(), threading.Event()
+    read, calls = blocking_read(started, release)
+
+    async def scenario():
+        first = asyncio.create_task(flights.do((1,), read, 1))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        others = [asyncio.create_task(flights.do((1,), read, 1)) for _ in range(4)]
+        other_movie = asyncio.create_task(flights.do((2,), read, 2))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(first, *others, other_movie)
+
+    results = asyncio.run(scenario())
+    assert results == ["movie 1"] * 5 + ["movie 2"]
+    assert calls == [1, 2]
+    assert flights.flights == {}
+    assert singleflight_calls.get(flight="test_shared", role="shared") == 4
+    assert 'checkflix_singleflight_coalescing_ratio{flight="test_shared"} 0.6667' in render_metrics()
+
+    # Nothing is kept once the read is done
+    assert asyncio.run(flights.do((1,), lambda movie_id: "fresh", 1)) == "fresh"
+
+
+def test_errors_reach_every_caller():
+    flights = SingleFlight("test_errors")
+    started, release = threading.Event(), threading.Event()
+
+    def read(movie_id):
+        started.set()
+        release.wait(5)
+        raise LookupError(movie_id)
+
+    async def scenario():
+        first = asyncio.create_task(flights.do((1,), read, 1))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        second = asyncio.create_task(flights.do((1,), read, 1))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(first, second, return_exceptions=True)
+
+    assert [type(result) for result in asyncio.run(scenario())] == [LookupError, LookupError]
+
+
+def test_a_cancelled_caller_does_not_cancel_the_read():
+    flights = SingleFlight("test_cancel")
+    started, release = threading.Event(), threading.Event()
+    read, calls = blocking_read(started, release)
+
+    async def scenario():
+        first = asyncio.create_task(flights.do((1,), read, 1))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        second = asyncio.create_task(flights.do((1,), read, 1))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        release.set()
+        return await second
+
+    assert asyncio.run(scenario()) == "movie 1"
+    assert calls == [1]
+
+
+def test_reads_after_a_change_start_their_own_call():
+    flights = SingleFlight("test_forget")
+    started, release = threading.Event(), threading.Event()
+    read, calls = blocking_read(started, release)
+
+    async def scenario():
+        first = asyncio.create_task(flights.do((1, "primary"), read, 1))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        flights.forget(1)
+        second = asyncio.create_task(flights.do((1, "primary"), read, 1))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(first, second)
+
+    assert asyncio.run(scenario()) == ["movie 1", "movie 1"]
+    assert calls == [1, 1]
+
+
+@pytest.fixture
+def db_session():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    user = User(username="owner", email="owner@example.com", full_name="Owner", hashed_password="x")
+    db.add(user)
+    db.flush()
+    movie = Movie(title="Alien", genre="Horror", user_id=user.id)
+    db.add(movie)
+    db.flush()
+    db.add_all([Rating(user_id=user.id, movie_id=movie.id, rating_value=value) for value in (6, 9)])
+    db.commit()
+    rating_average_cache.evict(movie.id)
+    yield db, engine, movie.id
+    db.close()
+    engine.dispose()
+
+
+def test_concurrent_average_rating_reads_run_one_query_each(db_session):
+    db, engine, movie_id = db_session
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    async def scenario():
+        return await asyncio.gather(*(get_average_rating_shared(db, movie_id) for _ in range(10)))
+
+    results = asyncio.run(scenario())
+    assert all(result == {"movie_id": movie_id, "movie_title": "Alien", "owner_id": 1, "avg_rating": 7.5}
+               for result in results)
+    # One read of the movie and one of its ratings, for all ten callers
+    assert len(statements) == 2
+
+
+def test_the_read_does_not_use_the_callers_session(db_session):
+    db, engine, movie_id = db_session
+    db.close()
+
+    async def scenario():
+        return await get_average_rating_shared(db, movie_id)
+
+    assert asyncio.run(scenario())["avg_rating"] == 7.5
+    # Closing the caller's session mid-read can't fail the callers sharing it
+    assert not db.in_transaction()
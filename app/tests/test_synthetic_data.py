@@ -0,0 +1,96 @@
+from datetime import datetime, timezone
+import pytest
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import Session
+import app.models as models
+from app.movie_cards import check_cards
+from app.synthetic_data import generate
+
+END = datetime(2024, 7, 1, tzinfo=timezone.utc)
+
+
+def make_database(path, seed=7):
+    engine = create_engine(f"sqlite:///{path}")
+    written = generate(engine, users=200, movies=50, ratings=3000, comments=800, seed=seed, end=END,
+                       batch_size=500, log=lambda line: None)
+    return engine, written
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    engine, written = make_database(tmp_path_factory.mktemp("synthetic") / "data.db")
+    with Session(engine) as db:
+        yield db, written
+    engine.dispose()
+
+
+def test_row_counts(database):
+    db, written = database
+    assert written["users"] == 200 and written["movies"] == 50
+    assert db.query(models.Rating).count() == 3000
+    assert db.query(models.Comment).count() == 800
+
+
+def test_same_seed_same_rows(database, tmp_path):
+    db, _ = database
+    engine, _ = make_database(tmp_path / "again.db")
+    with Session(engine) as again:
+        columns = (models.Rating.user_id, models.Rating.movie_id, models.Rating.rating_value, models.Rating.created_at)
+        assert again.query(*columns).order_by(models.Rating.id).all() == db.query(*columns).order_by(models.Rating.id).all()
+        assert again.query(models.Comment.parent_id).order_by(models.Comment.id).all() == \
+            db.query(models.Comment.parent_id).order_by(models.Comment.id).all()
+    engine.dispose()
+
+
+def test_one_rating_per_user_and_movie(database):
+    db, _ = database
+    pairs = db.query(models.Rating.user_id, models.Rating.movie_id).distinct().count()
+    assert pairs == 3000
+    lowest, highest = db.query(func.min(models.Rating.rating_value), func.max(models.Rating.rating_value)).one()
+    assert 1 <= lowest and highest <= 10
+
+
+def test_ratings_are_skewed(database):
+    db, _ = database
+    counts = sorted((count for _, count in db.query(models.Rating.movie_id, func.count()).group_by(models.Rating.movie_id)), reverse=True)
+    # The most popular tenth of the movies gets far more than a tenth of the ratings
+    assert sum(counts[:5]) > 0.2 * 3000
+
+
+def test_reply_threads(database):
+    db, _ = database
+    comments = {comment.id: comment for comment in db.query(models.Comment)}
+    depths = {}
+    for comment in comments.values():
+        if comment.parent_id is not None:
+            parent = comments[comment.parent_id]
+            assert parent.id < comment.id and parent.movie_id == comment.movie_id
+            assert parent.created_at <= comment.created_at
+        depth, current = 0, comment
+        while current.parent_id is not None:
+            depth, current = depth + 1, comments[current.parent_id]
+        depths[comment.id] = depth
+    assert max(depths.values()) >= 10
+    assert 0.2 < sum(depth == 0 for depth in depths.values()) / len(depths) < 0.6
+
+
+def test_derived_tables_match(database):
+    db, _ = database
+    for genre in db.query(models.Genre):
+        assert genre.movie_count == db.query(models.MovieGenre).filter(models.MovieGenre.genre_id == genre.id).count()
+    for ranking in db.query(models.MovieRanking).limit(10):
+        count, total = db.query(func.count(), func.sum(models.Rating.rating_value)).filter(
+            models.Rating.movie_id == ranking.movie_id).one()
+        assert (ranking.rating_count, ranking.rating_sum) == (count, total)
+    counter = db.query(models.ActivityCount).filter_by(scope="movie", counted="comments").first()
+    assert counter.count == db.query(models.Comment).filter(models.Comment.movie_id == counter.scope_id).count()
+    report = check_cards(db)
+    assert report["checked"] == 50
+    assert not (report["missing"] or report["orphaned"] or report["mismatched"])
+
+
+def test_refuses_a_database_with_users(database, tmp_path):
+    engine, _ = make_database(tmp_path / "full.db")
+    with pytest.raises(ValueError):
+        generate(engine, users=1, movies=1, ratings=0, comments=0, end=END, log=lambda line: None)
+    engine.dispose()
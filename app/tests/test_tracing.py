@@ -0,0 +1,112 @@
+import json
+import pytest
+from fastapi.testclient import TestClient
+import app.config as config
+import app.tracing as tracing
+from app.config import Settings
+from app.main import create_app
+from app.tracing import NdjsonExporter, OtlpHttpExporter, Span, SpanExporter, init_tracing, parse_traceparent
+
+
+class MemoryExporter(SpanExporter):
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+@pytest.fixture
+def exporter():
+    previous = config.current_settings
+    exporter = MemoryExporter()
+    settings = Settings(database_url="sqlite:///./test_tracing.db", run_background_jobs=False, tracing_exporter="ndjson")
+    init_tracing(settings, exporter)
+    with TestClient(create_app(settings)) as client:
+        exporter.client = client
+        yield exporter
+    assert tracing.tracer is None
+    config.configure(previous)
+
+
+def get_spans(exporter, response):
+    tracing.tracer.flush()
+    trace_id = response.headers["traceparent"].split("-")[1]
+    return [span for span in exporter.spans if f"{span.trace_id:032x}" == trace_id]
+
+
+def test_request_crud_and_sql_spans(exporter):
+    response = exporter.client.get("/movies/1")
+    assert response.status_code == 404
+    spans = get_spans(exporter, response)
+    by_name = {span.name: span for span in spans}
+
+    server = by_name["GET /movies/{movie_id}"]
+    assert server.kind == "server" and server.parent_id is None
+    assert server.attributes["http.route"] == "/movies/{movie_id}"
+    assert server.attributes["http.status_code"] == 404
+
+    # The route's read is coalesced, it runs get_movie_by_id in the threadpool
+    shared = by_name["MovieCRUDService.get_movie_data"]
+    assert shared.parent_id == server.span_id
+    crud = by_name["MovieCRUDService.get_movie_by_id"]
+    assert crud.parent_id == shared.span_id
+    sql = [span for span in spans if span.name == "sql"]
+    assert sql and all(span.parent_id == crud.span_id for span in sql)
+    assert "FROM movies" in sql[0].attributes["db.statement"]
+    assert sql[0].attributes["db.system"] == "sqlite"
+
+
+def test_incoming_traceparent_is_continued(exporter):
+    parent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+    response = exporter.client.get("/", headers={"traceparent": parent})
+    trace_id, span_id = response.headers["traceparent"].split("-")[1:3]
+    assert trace_id == "0af7651916cd43dd8448eb211c80319c"
+    (server,) = get_spans(exporter, response)
+    assert server.parent_id == 0xb7ad6b7169203331
+    assert f"{server.span_id:016x}" == span_id
+
+    # The caller decided not to sample
+    response = exporter.client.get("/", headers={"traceparent": parent[:-2] + "00"})
+    assert "traceparent" not in response.headers
+
+
+def test_parse_traceparent():
+    assert parse_traceparent("00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01") == (
+        0x0af7651916cd43dd8448eb211c80319c, 0xb7ad6b7169203331, True)
+    assert parse_traceparent("00-00000000000000000000000000000000-b7ad6b7169203331-01") is None
+    assert parse_traceparent("ff-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01") is None
+    assert parse_traceparent("garbage") is None
+    assert parse_traceparent(None) is None
+
+
+def finished_span():
+    span = Span(0x0af7651916cd43dd8448eb211c80319c, 0xb7ad6b7169203331, "sql", "client", {"db.rows": 3})
+    span.end_ns = span.start_ns + 1_500_000
+    return span
+
+
+def test_ndjson_exporter(tmp_path):
+    path = tmp_path / "traces.ndjson"
+    NdjsonExporter(str(path)).export([finished_span(), finished_span()])
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(lines) == 2
+    assert lines[0]["trace_id"] == "0af7651916cd43dd8448eb211c80319c"
+    assert lines[0]["parent_id"] == "b7ad6b7169203331"
+    assert lines[0]["duration_ms"] == 1.5
+
+
+def test_otlp_encoding():
+    body = OtlpHttpExporter("http://collector:4318/v1/traces", "checkflix").encode([finished_span()])
+    resource_spans = body["resourceSpans"][0]
+    assert resource_spans["resource"]["attributes"][0] == {"key": "service.name", "value": {"stringValue": "checkflix"}}
+    (span,) = resource_spans["scopeSpans"][0]["spans"]
+    assert span["kind"] == 3
+    assert span["parentSpanId"] == "b7ad6b7169203331"
+    assert span["attributes"] == [{"key": "db.rows", "value": {"intValue": "3"}}]
+
+
+def test_exporters_must_implement_export():
+    with pytest.raises(TypeError):
+        SpanExporter()
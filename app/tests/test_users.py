@@ -55,6 +55,13 @@ def test_get_users(client, test_db, create_test_user):
     assert response.status_code == 200
     assert len(response.json()) > 0
 
+# Test: Get users by IDs
+def test_get_users_by_ids(client, test_db):
+    test_user = user_service.get_user_by_username(test_db, "testuser")
+    response = client.get(f"/users/?ids={test_user.id},999")
+    assert response.status_code == 200
+    assert [user["username"] for user in response.json()] == ["testuser"]
+
 # Test: Get user by ID
 def test_get_user_by_id(client, test_db):
     test_user = user_service.get_user_by_username(test_db, "testuser")
@@ -70,6 +77,20 @@ def test_get_user_by_username(client, test_db):
     assert response.status_code == 200
     assert response.json()["username"] == "testuser"
 
+# Test: Recommendations are only served to their user
+def test_recommendations_need_their_user(client, test_db):
+    test_user = user_service.get_user_by_username(test_db, "testuser")
+    assert client.get(f"/users/{test_user.id}/recommendations").status_code == 401
+
+    app.dependency_overrides[get_current_user] = lambda: test_user
+    try:
+        assert client.get(f"/users/{test_user.id + 1}/recommendations").status_code == 403
+        response = client.get(f"/users/{test_user.id}/recommendations")
+    finally:
+        del app.dependency_overrides[get_current_user]
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
+
 # Test: Update user by ID
 def test_update_user(client, test_db):
     test_user = user_service.get_user_by_username(test_db, "testuser")
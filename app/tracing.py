@@ -0,0 +1,345 @@
+import functools
+import json
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from app.config import Settings
+from app.logger import custom_logger
+from app.metrics import counter
+
+# Request tracing. The tracing middleware opens a server span per request (named
+# after its route template) and continues the trace of an incoming W3C traceparent.
+# CRUD service methods and SQL statements open child spans of the current span,
+# which a context variable carries across awaits and into the threadpool. Nothing
+# is recorded outside a sampled request. Finished spans are handed to an exporter
+# in batches by a background thread.
+
+TRACEPARENT_HEADER = b"traceparent"
+TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# Longest SQL statement kept on a span
+MAX_STATEMENT_LENGTH = 2000
+
+spans_dropped = counter("checkflix_trace_spans_dropped_total", "Finished spans dropped because the export queue was full")
+exports_failed = counter("checkflix_trace_exports_failed_total", "Span batches the exporter failed to send")
+
+# The span of the code that is running, None outside a sampled request
+current_span = ContextVar("current_span", default=None)
+
+# Set by init_tracing when the application starts
+tracer = None
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "attributes", "start_ns", "end_ns", "error")
+
+    def __init__(self, trace_id: int, parent_id: int | None, name: str, kind: str = "internal", attributes: dict | None = None):
+        self.trace_id = trace_id
+        self.span_id = random.getrandbits(64) or 1
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set_error(self, error: BaseException):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def traceparent(self):
+        return f"00-{self.trace_id:032x}-{self.span_id:016x}-01"
+
+    def to_dict(self):
+        return {
+            "trace_id": f"{self.trace_id:032x}",
+            "span_id": f"{self.span_id:016x}",
+            "parent_id": f"{self.parent_id:016x}" if self.parent_id else None,
+            "name": self.name,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def parse_traceparent(value: str | None):
+    # (trace id, parent span id, sampled) or None when absent or malformed
+    match = TRACEPARENT.match(value.strip().lower()) if value else None
+    if match is None or match.group(1) == "ff":
+        return None
+    trace_id, parent_id = int(match.group(2), 16), int(match.group(3), 16)
+    if not trace_id or not parent_id:
+        return None
+    return trace_id, parent_id, bool(int(match.group(4), 16) & 1)
+
+
+# Exporters
+
+class SpanExporter(ABC):
+    # Receives lists of finished spans from the export thread
+
+    @abstractmethod
+    def export(self, spans: list[Span]):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class NdjsonExporter(SpanExporter):
+    # One JSON object per span and line, appended to a local file
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list[Span]):
+        with open(self.path, "a") as trace_file:
+            trace_file.writelines(json.dumps(span.to_dict(), default=str) + "\n" for span in spans)
+
+
+OTLP_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpHttpExporter(SpanExporter):
+    # OTLP/HTTP with the JSON encoding, accepted by the OpenTelemetry Collector, Jaeger and Tempo
+
+    def __init__(self, endpoint: str, service_name: str, timeout: float = 5):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def encode(self, spans: list[Span]):
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": otlp_value(self.service_name)}]},
+            "scopeSpans": [{
+                "scope": {"name": "app.tracing"},
+                "spans": [{
+                    "traceId": f"{span.trace_id:032x}",
+                    "spanId": f"{span.span_id:016x}",
+                    "parentSpanId": f"{span.parent_id:016x}" if span.parent_id else "",
+                    "name": span.name,
+                    "kind": OTLP_KINDS[span.kind],
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns),
+                    "attributes": [{"key": key, "value": otlp_value(value)} for key, value in span.attributes.items()],
+                    "status": {"code": 2, "message": span.error} if span.error else {"code": 0},
+                } for span in spans],
+            }],
+        }]}
+
+    def export(self, spans: list[Span]):
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(self.encode(spans)).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+class Tracer:
+
+    def __init__(self, exporter: SpanExporter, sample_rate: float = 1.0,
+                 max_queue_size: int = 2048, batch_size: int = 512, flush_seconds: float = 1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = threading.Thread(target=self.run, name="trace-exporter", daemon=True)
+        self.thread.start()
+
+    def start_trace(self, name: str, traceparent: str | None = None, attributes: dict | None = None):
+        # The server span of a request, or None when the request isn't sampled
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+            if not sampled:
+                return None
+        elif self.sample_rate >= 1 or random.random() < self.sample_rate:
+            trace_id, parent_id = random.getrandbits(128) or 1, None
+        else:
+            return None
+        return Span(trace_id, parent_id, name, "server", attributes)
+
+    def end(self, span: Span):
+        span.end_ns = time.time_ns()
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            spans_dropped.inc()
+
+    def run(self):
+        batch, deadline = [], time.monotonic() + self.flush_seconds
+        while True:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+            if isinstance(item, Span):
+                batch.append(item)
+                if len(batch) < self.batch_size and time.monotonic() < deadline:
+                    continue
+            if batch:
+                self.export(batch)
+                batch = []
+            deadline = time.monotonic() + self.flush_seconds
+            # A flush or shutdown request, everything queued before it has been exported
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is StopIteration:
+                return
+
+    def export(self, batch: list[Span]):
+        try:
+            self.exporter.export(batch)
+        except Exception:
+            exports_failed.inc()
+            custom_logger.exception(f"Exporting {len(batch)} spans failed")
+
+    def flush(self, timeout: float = 5):
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def shutdown(self):
+        self.queue.put(StopIteration)
+        self.thread.join(timeout=5)
+        self.exporter.shutdown()
+
+
+def make_exporter(settings: Settings):
+    if settings.tracing_exporter == "ndjson":
+        return NdjsonExporter(settings.tracing_file)
+    if settings.tracing_exporter == "otlp":
+        return OtlpHttpExporter(settings.tracing_otlp_endpoint, settings.tracing_service_name)
+    return None
+
+
+def init_tracing(settings: Settings, exporter: SpanExporter | None = None):
+    # Any SpanExporter can be passed in place of the configured one
+    global tracer
+    exporter = exporter or make_exporter(settings)
+    if exporter is None or tracer is not None:
+        return tracer
+    tracer = Tracer(exporter, settings.tracing_sample_rate)
+    return tracer
+
+
+def shutdown_tracing():
+    global tracer
+    if tracer is None:
+        return
+    tracer.shutdown()
+    tracer = None
+
+
+# Child spans
+
+def start_span(name: str, kind: str = "internal", attributes: dict | None = None):
+    # A child of the current span, None outside a sampled request
+    parent = current_span.get()
+    if parent is None or tracer is None:
+        return None
+    return Span(parent.trace_id, parent.span_id, name, kind, attributes)
+
+
+def end_span(span: Span, error: BaseException | None = None):
+    if error is not None:
+        span.set_error(error)
+    if tracer is not None:
+        tracer.end(span)
+
+
+def traced(name: str):
+    # Runs the function in a child span of the current span
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            span = start_span(name)
+            if span is None:
+                return func(*args, **kwargs)
+            reset = current_span.set(span)
+            try:
+                return func(*args, **kwargs)
+            except BaseException as error:
+                span.set_error(error)
+                raise
+            finally:
+                current_span.reset(reset)
+                end_span(span)
+        return wrapper
+    return decorator
+
+
+def traced_service(cls):
+    # Class decorator for the CRUD services: a span per static method call
+    for name, value in list(vars(cls).items()):
+        if isinstance(value, staticmethod):
+            setattr(cls, name, staticmethod(traced(f"{cls.__name__}.{name}")(value.__func__)))
+    return cls
+
+
+class TracingMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or tracer is None:
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for name, value in scope["headers"]:
+            if name == TRACEPARENT_HEADER:
+                traceparent = value.decode("latin-1")
+                break
+        span = tracer.start_trace(scope["method"], traceparent, {
+            "http.method": scope["method"],
+            "http.target": scope["path"],
+        })
+        if span is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                span.attributes["http.status_code"] = message["status"]
+                message["headers"] = [*message.get("headers", []), (TRACEPARENT_HEADER, span.traceparent().encode())]
+            await send(message)
+
+        reset = current_span.set(span)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException as error:
+            span.set_error(error)
+            raise
+        finally:
+            current_span.reset(reset)
+            # The route is known once the router has matched the request
+            route = scope.get("route")
+            if route is not None:
+                span.name = f"{scope['method']} {route.path}"
+                span.attributes["http.route"] = route.path
+            if span.attributes.get("http.status_code", 200) >= 500 and span.error is None:
+                span.error = f"HTTP {span.attributes['http.status_code']}"
+            end_span(span)
@@ -0,0 +1,55 @@
+# Benchmark the content-based similar-movie index on a synthetic catalog.
+#
+#   python -m benchmarks.content_index --movies 1000000
+import argparse
+import random
+import time
+import numpy as np
+from app.content_index import ContentIndex
+
+GENRES = ["Drama", "Comedy", "Action", "Thriller", "Horror", "Romance", "Sci-Fi", "Documentary", "Animation", "Crime"]
+
+
+def synthetic_movies(count: int, seed: int = 42):
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(20000)]
+    for movie_id in range(1, count + 1):
+        title = " ".join(rng.choices(vocabulary[:5000], k=rng.randint(1, 4)))
+        description = " ".join(rng.choices(vocabulary, k=rng.randint(8, 30)))
+        yield movie_id, title, rng.choice(GENRES), description
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--movies", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    index = ContentIndex()
+    started = time.perf_counter()
+    for movie in synthetic_movies(args.movies):
+        index.add(*movie)
+    elapsed = time.perf_counter() - started
+    print(f"indexed {args.movies} movies in {elapsed:.1f}s ({args.movies / elapsed:,.0f} movies/s), "
+          f"matrix {index.term_freq[:len(index)].nbytes / 2**20:.0f} MiB")
+
+    rng = np.random.default_rng(0)
+    query_ids = rng.integers(1, args.movies + 1, size=args.queries).tolist()
+
+    started = time.perf_counter()
+    for movie_id in query_ids:
+        index.similar(movie_id, k=args.k)
+    elapsed = time.perf_counter() - started
+    print(f"single queries: {elapsed / args.queries * 1000:.1f} ms/query")
+
+    started = time.perf_counter()
+    for start in range(0, len(query_ids), args.batch):
+        index.similar_batch(query_ids[start:start + args.batch], k=args.k)
+    elapsed = time.perf_counter() - started
+    print(f"batched queries ({args.batch}/batch): {elapsed / args.queries * 1000:.1f} ms/query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Benchmark the /movies filter and sort engine on a synthetic catalog.
+#
+#   python -m benchmarks.movie_filters --movies 200000
+#   python -m benchmarks.movie_filters --url postgresql://localhost/checkflix_bench
+import argparse
+import os
+import random
+import tempfile
+import time
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.orm import Session
+import app.models as models
+import app.schemas as schemas
+from app.crud import movie_crud_service
+from app.database import Base
+from app.genres import genre_key
+
+GENRES = ["Drama", "Comedy", "Action", "Thriller", "Horror", "Romance", "Sci-Fi", "Documentary", "Animation", "Crime"]
+
+# (label, filters, sort)
+CASES = [
+    ("no filters", schemas.MovieFilter(), [("id", False)]),
+    ("genre", schemas.MovieFilter(genres=["Drama"]), [("id", False)]),
+    ("genre set + years", schemas.MovieFilter(genres=["Drama", "Crime"], year_from=1990, year_to=1999), [("id", False)]),
+    ("years, newest first", schemas.MovieFilter(year_from=2010), [("release_year", True)]),
+    ("owner", schemas.MovieFilter(owner_id=7), [("id", False)]),
+    ("min rating", schemas.MovieFilter(min_rating=8.5), [("avg_rating", True)]),
+    ("genre + min rating", schemas.MovieFilter(genres=["Horror"], min_rating=7), [("weighted_rating", True)]),
+    ("title", schemas.MovieFilter(title="movie 4242"), [("id", False)]),
+]
+
+
+def populate(engine, count: int, seed: int = 42):
+    rng = random.Random(seed)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(insert(models.User), [
+            {"id": user_id, "email": f"user{user_id}@example.com", "username": f"user{user_id}",
+             "full_name": f"User {user_id}", "hashed_password": "x"}
+            for user_id in range(1, 101)
+        ])
+        connection.execute(insert(models.Genre), [
+            {"id": genre_id, "name": name, "key": genre_key(name), "movie_count": 0}
+            for genre_id, name in enumerate(GENRES, start=1)
+        ])
+        for start in range(1, count + 1, 10000):
+            ids = range(start, min(start + 10000, count + 1))
+            genres = {movie_id: rng.randint(1, len(GENRES)) for movie_id in ids}
+            connection.execute(insert(models.Movie), [
+                {"id": movie_id, "title": f"movie {movie_id}", "genre": GENRES[genres[movie_id] - 1],
+                 "release_year": rng.randint(1920, 2024), "user_id": rng.randint(1, 100)}
+                for movie_id in ids
+            ])
+            connection.execute(insert(models.MovieGenre), [
+                {"movie_id": movie_id, "genre_id": genre_id} for movie_id, genre_id in genres.items()
+            ])
+            # About half of the movies have been rated
+            connection.execute(insert(models.MovieRanking), [
+                {"movie_id": movie_id, "rating_count": votes, "rating_sum": votes * 6,
+                 "avg_rating": round(rng.uniform(1, 10), 2), "weighted_rating": round(rng.uniform(1, 10), 2),
+                 "trending_score": 0.0, "dirty": False}
+                for movie_id in ids if (votes := rng.randint(0, 40)) > 20
+            ])
+        connection.execute(text("ANALYZE"))
+
+
+def explain(session: Session, query):
+    compiled = query.statement.compile(
+        dialect=session.get_bind().dialect, compile_kwargs={"render_postcompile": True})
+    if session.get_bind().dialect.name == "sqlite":
+        parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+        rows = session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", parameters)
+        return "; ".join(row[-1] for row in rows)
+    rows = session.connection().exec_driver_sql(f"EXPLAIN {compiled}", compiled.params)
+    return rows.first()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--movies", type=int, default=200_000)
+    parser.add_argument("--url", help="database to fill, a temporary SQLite file by default")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    url = args.url or f"sqlite:///{os.path.join(directory.name, 'movies.db')}"
+    engine = create_engine(url)
+    started = time.perf_counter()
+    populate(engine, args.movies)
+    print(f"loaded {args.movies} movies in {time.perf_counter() - started:.1f}s")
+
+    with Session(engine) as session:
+        for label, filters, sort in CASES:
+            query = movie_crud_service.filter_movies(session, filters, sort)
+            timings = []
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                query.offset(0).limit(args.limit).all()
+                timings.append(time.perf_counter() - started)
+                session.expunge_all()
+            timings.sort()
+            print(f"{label:<22} median {timings[len(timings) // 2] * 1000:7.2f} ms   {explain(session, query.limit(args.limit))}")
+
+    engine.dispose()
+    directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Benchmark cold-start cost: importing app.main in a fresh interpreter, then running
+# the lifespan startup and shutdown against a throwaway SQLite database.
+#
+#   python -m benchmarks.startup --runs 10
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+IMPORT_SNIPPET = """
+import time
+started = time.perf_counter()
+import app.main
+print(time.perf_counter() - started)
+"""
+
+STARTUP_SNIPPET = """
+import sys
+import time
+from fastapi.testclient import TestClient
+from app.config import Settings
+from app.main import create_app
+
+app = create_app(Settings(database_url=sys.argv[1], run_background_jobs=False))
+started = time.perf_counter()
+with TestClient(app):
+    ready = time.perf_counter()
+print(ready - started, time.perf_counter() - ready)
+"""
+
+
+def run(snippet: str, *args):
+    output = subprocess.run(
+        [sys.executable, "-c", snippet, *args], check=True, capture_output=True, text=True
+    ).stdout
+    return [float(value) for value in output.split()[-2:] if value]
+
+
+def summary(label: str, samples):
+    print(f"{label}: median {statistics.median(samples) * 1000:.1f} ms, "
+          f"min {min(samples) * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    imports = [run(IMPORT_SNIPPET)[-1] for _ in range(args.runs)]
+    summary("import app.main", imports)
+
+    startups, shutdowns = [], []
+    with tempfile.TemporaryDirectory() as directory:
+        for run_number in range(args.runs):
+            startup, shutdown = run(STARTUP_SNIPPET, f"sqlite:///{directory}/startup{run_number}.db")
+            startups.append(startup)
+            shutdowns.append(shutdown)
+    summary("lifespan startup", startups)
+    summary("lifespan shutdown", shutdowns)
+
+    started = time.perf_counter()
+    run(IMPORT_SNIPPET)
+    print(f"fresh interpreter + import, wall clock: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()